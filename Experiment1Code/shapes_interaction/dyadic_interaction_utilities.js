@@ -100,6 +100,7 @@ info so we also pass in the full command (a javascript dictionary)
 command_code can be many different things:
     PairID: code to use in audio pairing with partner
     PartnerDropout: your partner has dropped out
+    DuplicateParticipant: you have already taken part
     EndExperiment: quit, you have finished the experiment
     WaitingRoom: puts client in waiting room
     Instructions: Show instructions
@@ -118,7 +119,7 @@ progress with the experiment.
 function handle_server_command(command_code,command) {
   //just for safety I like to check that the command code is one of the legal ones,
   //might give minimal protection against malicious connections
-  var possible_commands = ["PartnerDropout","EndExperiment",
+  var possible_commands = ["PartnerDropout","EndExperiment","DuplicateParticipant",
                             "WaitingRoomPairing","WaitingRoomAfterTraining",
                             "PairID",
                             "Instructions","Director","WaitForPartner","Matcher","Feedback",
@@ -137,6 +138,9 @@ function handle_server_command(command_code,command) {
       case "PartnerDropout": //PartnerDropout: your partner has dropped out
         partner_dropout() //direct client to a screen allowing them to exit the experiment cleanly
         break;
+      case "DuplicateParticipant": //DuplicateParticipant: server has seen this participant_id before
+        duplicate_participant() //direct client to the screen telling them they have already taken part
+        break;
       case "EndExperiment": //EndExperiment: you have finished the experiment
         end_experiment('clean') //direct client to the final screen of the experiment
         break;
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Running each pair's work in order, and different pairs side by side
+##############
+
+# An Actor is a mailbox: tasks told to it run one at a time, in the order they
+# were told, so whatever runs on an actor never needs a lock for the state only
+# that actor touches. Actors run on a bounded pool of worker threads, so many
+# actors can make progress at once but no more threads are used however many
+# actors there are. interaction_engine.py gives each pair an actor, and one
+# actor to matchmaking, so messages from both members of a pair are handled in
+# order, by one thread at a time, while other pairs carry on in parallel.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import logging
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Worker threads shared by all actors
+DEFAULT_WORKERS = 8
+
+# Tasks an actor runs before letting the actors queued behind it have a turn
+DEFAULT_BATCH = 16
+
+
+class Actor(object):
+    """A mailbox whose tasks run one at a time, in order, on its ActorPool."""
+    __slots__ = ('name', 'pool', '_tasks', '_scheduled', '_lock')
+
+    def __init__(self, name, pool):
+        self.name = name
+        self.pool = pool
+        self._tasks = deque()
+        self._scheduled = False
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return 'Actor(%r)' % (self.name,)
+
+    def tell(self, fn, *args):
+        """Queues fn(*args) to run on this actor after everything told to it before."""
+        if self.pool.workers == 0:
+            self.pool.run_task(self, fn, args)
+            return
+        with self._lock:
+            self._tasks.append((fn, args))
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self.pool.schedule(self)
+
+
+class ActorPool(object):
+    """
+    The worker threads actors run on. With workers=0 there are no threads:
+    tell() runs each task straight away, in the caller's thread, for servers
+    that already run callbacks one at a time (AsyncWebsocketServer).
+
+    on_error(actor, fn) is called, from inside the except block, when a task
+    raises; the actor then carries on with its next task.
+    """
+
+    def __init__(self, workers=DEFAULT_WORKERS, batch=DEFAULT_BATCH, on_error=None):
+        self.workers = workers
+        self.batch = batch
+        self.on_error = on_error
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def actor(self, name):
+        return Actor(name, self)
+
+    def schedule(self, actor):
+        self._executor_for_this_process().submit(self._run, actor)
+
+    def run_task(self, actor, fn, args):
+        try:
+            fn(*args)
+        except Exception:
+            if self.on_error is None:
+                logger.exception("Task %r on %r failed" % (fn, actor))
+            else:
+                self.on_error(actor, fn)
+
+    def _run(self, actor):
+        for _i in range(self.batch):
+            with actor._lock:
+                if not actor._tasks:
+                    actor._scheduled = False
+                    return
+                fn, args = actor._tasks.popleft()
+            self.run_task(actor, fn, args)
+        # give the worker to the actors waiting for one; this actor is still
+        # scheduled, so goes to the back of the queue with its remaining tasks
+        self.schedule(actor)
+
+    def _executor_for_this_process(self):
+        # a process forked from this one (a ShardedWebsocketServer worker)
+        # does not inherit the threads, so starts its own
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='actor')
+                    self._pid = os.getpid()
+        return self._executor
+
+    def close(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
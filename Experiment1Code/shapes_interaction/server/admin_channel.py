@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### A live stream of the session's progress, for admins
+##############
+
+# An admin can watch a session as it happens by connecting a websocket to the
+# server, on the same port as participants, and sending
+#     {"response_type": "ADMIN_SUBSCRIBE", "token": "<the token>"}
+# where the token is in the token file next to the server script (made, with a random
+# token readable only by its owner, the first time the server starts). They are sent
+# a snapshot of every pair as it stands, then an event as each thing happens:
+#     pair      two participants have been paired (or a pair resumed after a restart)
+#     phase     a participant has moved to a new phase
+#     roles     a pair's Director and Matcher have been chosen, or have swapped
+#     trial     a pair has started a trial (trial_counter is the pair's shared counter)
+#     dropout   a participant has disconnected before the end of the experiment
+# as JSON commands with command_type AdminEvent, the event, its time, and a sequence
+# number one higher than the event before (the snapshot has the number of the last
+# event before it).
+
+# Events are handed to a thread of their own, so the handler raising one only
+# appends it to a queue, and nothing at all when no admin is subscribed. That
+# thread encodes each event once, as a complete websocket frame, and sends the
+# same frame to every admin. Sending only ever queues the frame for the admin's
+# connection (see OutboundQueue in websocket_server.py), so an admin that reads
+# slowly holds up no one, and is disconnected, like any client, if it falls too
+# far behind.
+
+# Not used with the ShardedWebsocketServer, where each worker process only sees
+# its own pairs.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import hmac
+import os
+import queue
+import secrets
+import threading
+import time
+
+from websocket_server import encode_frame
+
+# What is queued for the publishing thread
+PUBLISH, SUBSCRIBE, UNSUBSCRIBE = 'publish', 'subscribe', 'unsubscribe'
+
+
+class AdminChannel(object):
+    """
+    Streams events to the admins who subscribe with the token kept in the
+    file at token_path, once started with the websocket server and codec.
+    """
+
+    def __init__(self, token_path):
+        self.token_path = token_path
+        # read (or made) when the channel starts, not when the server script is imported
+        self.token = None
+        self.server = None
+        self.codec = None
+        # client ids of the subscribed admins; only the publishing thread sends to them
+        self._admins = set()
+        self._queue = queue.SimpleQueue() if hasattr(queue, 'SimpleQueue') else queue.Queue()
+        self._publisher = None
+
+    def start(self, server, codec):
+        self.token = load_token(self.token_path)
+        self.server = server
+        self.codec = codec
+        self._publisher = threading.Thread(target=self._publish_events, name='admin-channel')
+        self._publisher.daemon = True
+        self._publisher.start()
+
+    def authenticate(self, token):
+        return (self.token is not None and isinstance(token, str)
+                and hmac.compare_digest(token.encode(), self.token.encode()))
+
+    def subscribe(self, client, snapshot):
+        """Sends client snapshot (a dict), then every event from then on."""
+        self._admins.add(client['id'])
+        self._queue.put((SUBSCRIBE, client, snapshot))
+
+    def unsubscribe(self, client_id):
+        """Stops sending to client_id, returning False if it was not subscribed."""
+        if client_id not in self._admins:
+            return False
+        self._admins.discard(client_id)
+        self._queue.put((UNSUBSCRIBE, client_id))
+        return True
+
+    def is_admin(self, client_id):
+        return client_id in self._admins
+
+    def publish(self, event, **fields):
+        """Sends event, with fields, to every admin subscribed."""
+        if self._admins:
+            self._queue.put((PUBLISH, event, time.time(), fields))
+
+    def close(self):
+        if self._publisher is not None:
+            self._queue.put(None)
+            self._publisher.join()
+            self._publisher = None
+
+    def _publish_events(self):
+        subscribers = {}
+        seq = 0
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            kind = item[0]
+            if kind == PUBLISH:
+                if subscribers:
+                    _, event, t, fields = item
+                    seq += 1
+                    message = dict(fields, command_type='AdminEvent', event=event, seq=seq, time=t)
+                    self._send(list(subscribers.values()), encode_frame(self.codec.dumps(message)))
+            elif kind == SUBSCRIBE:
+                _, client, snapshot = item
+                subscribers[client['id']] = client
+                message = dict(snapshot, command_type='AdminEvent', event='snapshot', seq=seq, time=time.time())
+                self._send([client], encode_frame(self.codec.dumps(message)))
+            else:
+                subscribers.pop(item[1], None)
+
+    def _send(self, clients, frame):
+        # the asyncio server only sends from its event loop
+        loop = getattr(self.server, 'loop', None)
+        if loop is not None:
+            loop.call_soon_threadsafe(self._fan_out, clients, frame)
+        else:
+            self._fan_out(clients, frame)
+
+    def _fan_out(self, clients, frame):
+        for client in clients:
+            try:
+                self.server.send_frame(client, frame)
+            except Exception:
+                # gone since; the server calls client_left, which unsubscribes them
+                pass
+
+
+# The token in the file at path, which is first made with a new random token if need be
+def load_token(path):
+    if not os.path.exists(path):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_urlsafe(24) + '\n')
+    with open(path) as f:
+        return f.read().strip()
@@ -0,0 +1,144 @@
+# Compares the threaded WebsocketServer with AsyncWebsocketServer.
+#
+# Each backend runs as an echo server in its own subprocess so that its
+# memory can be read from /proc (Linux only). We report
+#   - idle memory per connection: RSS growth after opening N idle clients
+#   - messages/sec: echo round trips with C clients sending concurrently
+#
+# Run from the server directory:
+#     python benchmarks/bench_backends.py [--idle 500] [--clients 20] [--seconds 5]
+
+import argparse
+import base64
+import os
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SERVER_DIR)
+
+BACKENDS = ['threaded', 'asyncio']
+
+
+def serve(backend):
+    import websocket_server
+    if backend == 'threaded':
+        server = websocket_server.WebsocketServer(0)
+    else:
+        server = websocket_server.AsyncWebsocketServer(0)
+    server.set_fn_message_received(lambda client, server, message: server.send_message(client, message))
+    print(server.port)
+    sys.stdout.flush()
+    server.run_forever()
+
+
+def rss_kb(pid):
+    with open('/proc/%d/status' % pid) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def connect(port):
+    sock = socket.create_connection(('127.0.0.1', port))
+    key = base64.b64encode(os.urandom(16)).decode()
+    sock.sendall(('GET / HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\n'
+                  'Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\n'
+                  'Sec-WebSocket-Version: 13\r\n\r\n' % key).encode())
+    response = b''
+    while not response.endswith(b'\r\n\r\n'):
+        response += sock.recv(1)
+    return sock
+
+
+def send_text(sock, text):
+    payload = text.encode()
+    mask = os.urandom(4)
+    header = bytes([0x81])
+    if len(payload) <= 125:
+        header += bytes([0x80 | len(payload)])
+    else:
+        header += bytes([0x80 | 126]) + struct.pack('>H', len(payload))
+    masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+    sock.sendall(header + mask + masked)
+
+
+def recv_exact(sock, n):
+    data = b''
+    while len(data) < n:
+        chunk = sock.recv(n - len(data))
+        if not chunk:
+            raise ConnectionError('server closed connection')
+        data += chunk
+    return data
+
+
+def recv_text(sock):
+    b1, b2 = recv_exact(sock, 2)
+    length = b2 & 0x7f
+    if length == 126:
+        length = struct.unpack('>H', recv_exact(sock, 2))[0]
+    elif length == 127:
+        length = struct.unpack('>Q', recv_exact(sock, 8))[0]
+    return recv_exact(sock, length).decode()
+
+
+def measure(backend, n_idle, n_clients, seconds):
+    proc = subprocess.Popen([sys.executable, __file__, '--serve', backend],
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                            cwd=SERVER_DIR)
+    try:
+        port = int(proc.stdout.readline())
+        time.sleep(0.2)
+        baseline = rss_kb(proc.pid)
+        idle = [connect(port) for _ in range(n_idle)]
+        time.sleep(0.5)
+        per_connection = (rss_kb(proc.pid) - baseline) / float(n_idle)
+        for sock in idle:
+            sock.close()
+
+        message = '{"response_type":"RESPONSE","role":"Director","response":"circle"}'
+        counts = [0] * n_clients
+        deadline = time.time() + seconds
+
+        def run(i):
+            sock = connect(port)
+            while time.time() < deadline:
+                send_text(sock, message)
+                recv_text(sock)
+                counts[i] += 1
+            sock.close()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n_clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return per_connection, sum(counts) / float(seconds)
+    finally:
+        proc.kill()
+        proc.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve', choices=BACKENDS)
+    parser.add_argument('--idle', type=int, default=500)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve)
+        return
+    print('%10s %18s %14s' % ('backend', 'KB/idle connection', 'messages/sec'))
+    for backend in BACKENDS:
+        per_connection, rate = measure(backend, args.idle, args.clients, args.seconds)
+        print('%10s %18.1f %14.0f' % (backend, per_connection, rate))
+
+
+if __name__ == '__main__':
+    main()
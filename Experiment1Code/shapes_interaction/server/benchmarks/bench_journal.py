@@ -0,0 +1,103 @@
+# Times the SessionJournal (journal.py): how long recording a change takes in
+# the handler that makes it, and how long a restarted server takes to read
+# back the pairs that were running, when --pairs pairs of --trials trials each
+# are part way through and the server is killed without warning.
+#
+# Also checks that a record cut off part way through being written (the
+# server killed mid-append) is ignored, with everything before it recovered.
+#
+# Run from the server directory:
+#     python benchmarks/bench_journal.py [--pairs 500] [--trials 200] [--size 16]
+# With the defaults the journal never fills up; a --size (in MB) of 1 has it
+# grow and be compacted in the background while records are being added.
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from journal import SessionJournal, DEFAULT_SIZE
+
+
+def make_design(n_trials):
+    shapes = ['square', 'circle', 'diamond', 'star']
+    return {'shapes': shapes,
+            'correspondences': {s: ['red', 'blue'] for s in shapes},
+            'trials': [{'block': 1, 'target': random.choice(shapes), 'foils': random.sample(shapes, 2)}
+                       for _i in range(n_trials)]}
+
+
+def fill(journal, pairs, trials):
+    # every pair is paired, then gets some way through their trials; the first tenth finish
+    latencies = []
+    progress = {}
+    for i in range(pairs):
+        pair_id = 'a%d_b%d' % (i, i)
+        design = make_design(trials)
+        start = time.perf_counter()
+        journal.paired(pair_id, ['a%d' % i, 'b%d' % i], design, 'fixed_associations')
+        latencies.append(time.perf_counter() - start)
+        progress[pair_id] = random.randrange(trials)
+    for pair_id, done in progress.items():
+        for trial in range(done):
+            start = time.perf_counter()
+            journal.trial(pair_id, trial, {pair_id.split('_')[0]: 'Director', pair_id.split('_')[1]: 'Matcher'})
+            latencies.append(time.perf_counter() - start)
+    for pair_id in list(progress)[:pairs // 10]:
+        journal.ended(pair_id, 'finished')
+        del progress[pair_id]
+    return progress, sorted(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=int, default=500)
+    parser.add_argument('--trials', type=int, default=200)
+    parser.add_argument('--size', type=float, default=DEFAULT_SIZE / 2.0**20, help='MB mapped to start with')
+    args = parser.parse_args()
+    random.seed(1)
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'journal.bin')
+        journal = SessionJournal(path, size=int(args.size * 2**20))
+        journal.recover()
+        progress, latencies = fill(journal, args.pairs, args.trials)
+        # killed without warning: the file is left as it is (closing only stops it being
+        # compacted in the background while it is copied)
+        journal.close()
+        stats = journal.stats()
+        print('%d records: median %.1f us, 99th percentile %.1f us, max %.1f us per record; '
+              '%d compactions (including at startup), %.0f MB mapped' %
+              (len(latencies), 1e6 * latencies[len(latencies) // 2], 1e6 * latencies[int(len(latencies) * 0.99)],
+               1e6 * latencies[-1], stats['compactions'], stats['size'] / 2.0**20))
+        end = stats['bytes']
+        with open(path, 'rb') as f:
+            copy = f.read()
+
+        restarted = SessionJournal(path)
+        n_records, seconds = restarted.recover()
+        recovered = {pair_id: state['trial_counter'] for pair_id, state in restarted.state.items()}
+        expected = {pair_id: max(done - 1, 0) for pair_id, done in progress.items()}
+        print('recovered %d running pairs from %d records (%.1f MB) in %.3f s: %s' %
+              (len(recovered), n_records, end / 2.0**20, seconds, 'ok' if recovered == expected else 'MISMATCH'))
+        restarted.close()
+
+        # the same file, with its last record cut off half way
+        with open(path, 'wb') as f:
+            f.write(copy[:end - 10] + b'\0' * (len(copy) - end + 10))
+        torn = SessionJournal(path)
+        n_torn, _seconds = torn.recover()
+        print('with the last record cut off: %d records recovered (%s)' %
+              (n_torn, 'ok' if n_torn == n_records - 1 else 'expected %d' % (n_records - 1)))
+        torn.close()
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
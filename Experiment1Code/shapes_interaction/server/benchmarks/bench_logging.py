@@ -0,0 +1,113 @@
+# Measures what logging every message costs the server.
+#
+# Each mode runs an echo server in a subprocess, logging each message the
+# way the experiment servers do:
+#   - print: the old print() calls, synchronously, before every send
+#   - debug: experiment_log at DEBUG, so every message is queued and written
+#     as a JSON line by the background listener
+#   - info:  experiment_log at INFO, the default - per-message records are skipped
+#   - off:   no logging at all
+# and we report echo round trips/sec with C clients sending concurrently.
+# Output goes to a temporary file rather than a terminal, which flatters print().
+#
+# Run from the server directory:
+#     python benchmarks/bench_logging.py [--clients 20] [--seconds 5]
+
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_backends import SERVER_DIR, connect, send_text, recv_text
+
+MODES = ['print', 'debug', 'info', 'off']
+
+
+def serve(mode, log_path):
+    import websocket_server
+    from experiment_log import setup_logging
+    log = None
+    if mode in ('debug', 'info'):
+        log = setup_logging('bench', path=log_path, console=False,
+                            level=logging.DEBUG if mode == 'debug' else logging.INFO)
+    last_heard_from = {}
+
+    def message_received(client, server, message):
+        client_id = client['id']
+        response = json.loads(message)
+        last_heard_from[client_id] = time.time()
+        if mode == 'print':
+            print("Client(%d) said: %s" % (client_id, message))
+            print('handle_client_response', client_id, response['response_type'], response)
+        elif log is not None:
+            log.debug('receive', client_id=client_id, message=response)
+        reply = {"command_type": "WaitForPartner", "echo": response}
+        if mode == 'print':
+            print("sending", client_id, reply)
+            print("last heard from", last_heard_from[client_id])
+            print('sending')
+        elif log is not None:
+            log.debug('send', client_id=client_id, message=reply)
+        server.send_message(client, json.dumps(reply))
+
+    server = websocket_server.WebsocketServer(0)
+    server.set_fn_message_received(message_received)
+    sys.__stderr__.write('%d\n' % server.port)
+    sys.__stderr__.flush()
+    server.run_forever()
+
+
+def measure(mode, n_clients, seconds):
+    output = tempfile.NamedTemporaryFile(suffix='.log', delete=False)
+    proc = subprocess.Popen([sys.executable, __file__, '--serve', mode, '--log', output.name],
+                            stdout=output, stderr=subprocess.PIPE, cwd=SERVER_DIR)
+    try:
+        port = int(proc.stderr.readline())
+        time.sleep(0.2)
+        message = '{"response_type":"RESPONSE","role":"Director","response":"circle"}'
+        counts = [0] * n_clients
+        deadline = time.time() + seconds
+
+        def run(i):
+            sock = connect(port)
+            while time.time() < deadline:
+                send_text(sock, message)
+                recv_text(sock)
+                counts[i] += 1
+            sock.close()
+
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(n_clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return sum(counts) / float(seconds)
+    finally:
+        proc.kill()
+        proc.wait()
+        output.close()
+        os.unlink(output.name)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve', choices=MODES)
+    parser.add_argument('--log')
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+    if args.serve:
+        serve(args.serve, args.log)
+        return
+    print('%8s %14s' % ('logging', 'messages/sec'))
+    for mode in MODES:
+        print('%8s %14.0f' % (mode, measure(mode, args.clients, args.seconds)))
+
+
+if __name__ == '__main__':
+    main()
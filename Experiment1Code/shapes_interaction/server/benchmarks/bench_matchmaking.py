@@ -0,0 +1,126 @@
+# Compares the old waiting room (a list, paired by len() % 2 and two
+# remove() calls) with matchmaking.WaitingRoom, when --arrivals participants
+# arrive at once, one thread each, and --leave-fraction of them disconnect
+# while waiting.
+#
+# For each we report arrivals/sec, and check that nobody was paired twice,
+# paired with someone who had left, or left waiting with a partner available.
+# The list's failures come from races between the threads; they are reported
+# rather than raised. The list's steps are a handful of bytecodes each, so
+# threads rarely switch in the middle of one unless something lets them; in
+# the server scripts, the handler sent and printed messages around these lines,
+# which does. time.sleep(0) stands in for that where the scripts did it (turn it
+# off with --no-yield, to time the list's bare operations).
+#
+# Run from the server directory:
+#     python benchmarks/bench_matchmaking.py [--arrivals 2000] [--leave-fraction 0.5] [--no-yield]
+
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from matchmaking import WaitingRoom
+
+
+class ListWaitingRoom(object):
+    """The server scripts' waiting room before matchmaking.py."""
+
+    def __init__(self, yield_points=True):
+        self.unpaired_clients = []
+        self.yield_points = yield_points
+
+    def switch(self):
+        # where the scripts sent or printed a message, letting another thread run
+        if self.yield_points:
+            time.sleep(0)
+
+    def join(self, client_id):
+        self.unpaired_clients.append(client_id)
+        if len(self.unpaired_clients) % 2 == 0:
+            one = self.unpaired_clients[0]
+            two = self.unpaired_clients[1]
+            self.switch()
+            self.unpaired_clients.remove(one)
+            self.switch()
+            self.unpaired_clients.remove(two)
+            return (one, two)
+        return None
+
+    def leave(self, client_id):
+        if client_id in self.unpaired_clients:
+            self.switch()
+            self.unpaired_clients.remove(client_id)
+            return True
+        return None
+
+    def waiting(self):
+        return list(self.unpaired_clients)
+
+
+def run(room, arrivals, leave_fraction, seed):
+    random.seed(seed)
+    leavers = set(random.sample(range(arrivals), int(arrivals * leave_fraction)))
+    pairs, left, errors = [], set(), []
+    start_line = threading.Barrier(arrivals + 1)
+
+    def arrive(client_id):
+        start_line.wait()
+        try:
+            match = room.join(client_id)
+            if match is not None:
+                pairs.append(tuple(getattr(match, 'client_ids', match)))
+            if client_id in leavers and room.leave(client_id) is not None:
+                left.add(client_id)
+        except Exception as e:
+            errors.append(repr(e))
+
+    threads = [threading.Thread(target=arrive, args=(i,)) for i in range(arrivals)]
+    for t in threads:
+        t.start()
+    start = time.time()
+    start_line.wait()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    paired = [c for pair in pairs for c in pair]
+    waiting = room.waiting()
+    problems = errors[:]
+    if len(paired) != len(set(paired)):
+        problems.append('%d paired twice' % (len(paired) - len(set(paired))))
+    if left & set(paired):
+        problems.append('%d paired after leaving' % len(left & set(paired)))
+    if len(waiting) > 1:
+        problems.append('%d still waiting' % len(waiting))
+    if len(set(paired)) + len(left) + len(waiting) != arrivals:
+        problems.append('%d lost' % (arrivals - len(set(paired)) - len(left) - len(waiting)))
+    return arrivals / elapsed, problems
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--arrivals', type=int, default=2000)
+    parser.add_argument('--leave-fraction', type=float, default=0.5)
+    parser.add_argument('--repeats', type=int, default=10)
+    parser.add_argument('--no-yield', action='store_true', help="don't let threads switch mid-step in the list")
+    args = parser.parse_args()
+    sys.setswitchinterval(1e-6)  # switch threads often, as a busy server does
+    print('%-12s %14s %10s  %s' % ('waiting room', 'arrivals/sec', 'failures', 'e.g.'))
+    rooms = (('list', lambda: ListWaitingRoom(yield_points=not args.no_yield)), ('WaitingRoom', WaitingRoom))
+    for name, make_room in rooms:
+        rates, failures = [], []
+        for repeat in range(args.repeats):
+            rate, problems = run(make_room(), args.arrivals, args.leave_fraction, repeat)
+            rates.append(rate)
+            failures.extend(problems)
+        print('%-12s %14.0f %10d  %s' % (name, sorted(rates)[len(rates) // 2], len(failures),
+                                          failures[0] if failures else ''))
+
+
+if __name__ == '__main__':
+    main()
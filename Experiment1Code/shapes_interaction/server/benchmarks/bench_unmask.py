@@ -0,0 +1,62 @@
+# Benchmark for unmasking client frames in websocket_server.
+#
+# Compares the original byte-at-a-time loop from read_next_message with
+# websocket_server.unmask (big-integer XOR, and the numpy path when numpy is
+# installed) for payloads from 10 B to 1 MB.
+#
+# Run from the server directory:
+#     python benchmarks/bench_unmask.py
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from websocket_server import websocket_server
+
+PAYLOAD_SIZES = [10, 100, 1000, 10000, 100000, 1000000]
+
+
+def unmask_bytewise(masks, payload):
+    message_bytes = bytearray()
+    for message_byte in payload:
+        message_byte ^= masks[len(message_bytes) % 4]
+        message_bytes.append(message_byte)
+    return message_bytes
+
+
+def unmask_int(masks, payload):
+    numpy = websocket_server.numpy
+    websocket_server.numpy = None
+    try:
+        return websocket_server.unmask(masks, payload)
+    finally:
+        websocket_server.numpy = numpy
+
+
+def time_per_call(fn, masks, payload):
+    timer = timeit.Timer(lambda: fn(masks, payload))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=3, number=number)) / number
+
+
+def main():
+    masks = os.urandom(4)
+    candidates = [('bytewise', unmask_bytewise), ('int', unmask_int)]
+    if websocket_server.numpy is not None:
+        candidates.append(('unmask', websocket_server.unmask))
+    print('%10s' % 'bytes' + ''.join('%14s' % name for name, _ in candidates) + '%10s' % 'speedup')
+    for size in PAYLOAD_SIZES:
+        payload = os.urandom(size)
+        expected = unmask_bytewise(masks, payload)
+        timings = []
+        for name, fn in candidates:
+            assert fn(masks, payload) == expected, name
+            timings.append(time_per_call(fn, masks, payload))
+        row = '%10d' % size + ''.join('%12.2fus' % (t * 1e6) for t in timings)
+        print(row + '%9.0fx' % (timings[0] / min(timings[1:])))
+
+
+if __name__ == '__main__':
+    main()
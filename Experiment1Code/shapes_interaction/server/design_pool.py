@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Pre-generated trial designs
+##############
+
+# Everything random about a pair (their shapes, colour correspondences, trial
+# list...) is a design, made by the server script's make_design(cell) for one
+# cell of the experiment, e.g. one condition. Making a design takes many rounds
+# of rejection sampling, so rather than doing it while both members of a pair
+# wait, a DesignPool keeps a stock of designs for every cell, made in a
+# background process, and pairing just takes one.
+
+# The stock is saved to disk (pickled) each time it has been topped up, and at
+# exit, so it is already full when the server restarts. Delete the file if you change make_design or
+# any of the parameters it uses, or pairs will be given designs made the old way.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import atexit
+import logging
+import multiprocessing
+import os
+import pickle
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+logger = logging.getLogger(__name__)
+
+# Designs kept in stock for each cell
+DEFAULT_POOL_SIZE = 20
+
+# How often the worker process checks that the server is still running, in seconds
+PARENT_POLL_INTERVAL = 1
+
+
+def init_worker(server_pid):
+    # reseed, so the worker does not repeat the random numbers the server
+    # will go on to draw
+    random.seed()
+    # and exit if the server is killed, rather than waiting forever for work
+    watcher = threading.Thread(target=exit_with_parent, args=(server_pid,))
+    watcher.daemon = True
+    watcher.start()
+
+
+def exit_with_parent(server_pid):
+    while os.getppid() == server_pid:
+        time.sleep(PARENT_POLL_INTERVAL)
+    os._exit(0)
+
+
+class DesignPool(object):
+    """
+    Keeps up to size designs for each of cells, made by make_design(cell).
+
+    Designs are made in a worker process forked from the server, so that
+    make_design can use the script's globals; where fork is not available they
+    are made in a background thread instead. take() never waits for the
+    worker: if a cell has run out it makes a design there and then.
+
+    In a process forked after start() (a ShardedWebsocketServer worker) the
+    pool starts again, empty, unsaved and filled by a thread, the first time
+    take() is called, so that no two processes can hand out the same design.
+    """
+
+    def __init__(self, make_design, cells, size=DEFAULT_POOL_SIZE, path=None):
+        self.make_design = make_design
+        self.cells = list(cells)
+        self.size = size
+        self.path = path
+        self.designs = {cell: deque() for cell in self.cells}
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._executor = None
+        self._filler = None
+        self._pid = None
+        self._stopped = False
+        self._load()
+        atexit.register(self.close)
+
+    def start(self, worker_process=True):
+        """
+        Starts topping up the pool in the background. Call this before
+        creating the server, so that the worker process does not inherit
+        its listening socket.
+        """
+        self._pid = os.getpid()
+        self._stopped = False
+        if worker_process and 'fork' in multiprocessing.get_all_start_methods():
+            self._executor = ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('fork'),
+                                                 initializer=init_worker, initargs=(self._pid,))
+            # the worker is only forked when the first job is submitted
+            self._executor.submit(int).result()
+        self._filler = threading.Thread(target=self._fill)
+        self._filler.daemon = True
+        self._filler.start()
+
+    def take(self, cell):
+        """Removes and returns a design for cell, making one if none are ready."""
+        if self._pid is not None and self._pid != os.getpid():
+            self._restart_in_child()
+        with self._lock:
+            stock = self.designs[cell]
+            design = stock.popleft() if stock else None
+        self._wakeup.set()
+        if design is None:
+            self.misses += 1
+            design = self.make_design(cell)
+        return design
+
+    def stock(self):
+        """The number of designs ready for each cell."""
+        with self._lock:
+            return {cell: len(stock) for cell, stock in self.designs.items()}
+
+    def _emptiest_cell(self):
+        with self._lock:
+            cell = min(self.cells, key=lambda cell: len(self.designs[cell]))
+            if len(self.designs[cell]) < self.size:
+                return cell
+        return None
+
+    def _fill(self):
+        while not self._stopped:
+            cell = self._emptiest_cell()
+            if cell is None:
+                self.save()
+                self._wakeup.wait()
+                self._wakeup.clear()
+                continue
+            try:
+                if self._executor is not None:
+                    try:
+                        future = self._executor.submit(self.make_design, cell)
+                    except BrokenProcessPool:
+                        raise
+                    except RuntimeError:
+                        # the executor has been shut down: by close, or at interpreter exit by
+                        # concurrent.futures, whose exit hook runs before close does
+                        return
+                    design = future.result()
+                else:
+                    design = self.make_design(cell)
+            except Exception:
+                if self._stopped:
+                    return
+                if self._executor is None:
+                    logger.exception("Could not make a design for %r; no longer filling the pool." % (cell,))
+                    return
+                logger.exception("Worker could not make a design for %r; making them in this process instead." % (cell,))
+                self._executor.shutdown(wait=False)
+                self._executor = None
+                continue
+            with self._lock:
+                self.designs[cell].append(design)
+
+    def _load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            saved = pickle.load(f)
+        for cell, designs in saved.items():
+            if cell in self.designs:
+                self.designs[cell].extend(designs[:self.size])
+
+    def save(self):
+        """Writes the current stock to path, if there is one."""
+        if self.path is None:
+            return
+        with self._lock:
+            saved = {cell: list(stock) for cell, stock in self.designs.items()}
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            pickle.dump(saved, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, self.path)
+
+    def _restart_in_child(self):
+        # we are in a process forked after start(): the threads and worker
+        # process belong to the parent, as do the designs we inherited. A
+        # worker forked from here would hold on to our clients' sockets, so
+        # designs are made in a thread.
+        self.path = None
+        self.designs = {cell: deque() for cell in self.cells}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._executor = None
+        self.start(worker_process=False)
+
+    def close(self):
+        # only a pool that was started (by the server, not e.g. a benchmark importing the
+        # server script) saves its stock, and only in the process that started it
+        if self._pid is None or self._pid != os.getpid():
+            return
+        self._stopped = True
+        self.save()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Structured logging for the interaction servers
+##############
+
+# Every record is one JSON object per line, e.g.
+#   {"time": 1700000000.123456, "level": "INFO", "event": "pair", "pair_id": "p1_p2", "condition": "fixed_associations"}
+# Handler threads only put records on a queue; a single background thread (a
+# QueueListener) formats them and writes them out, so sending a message never
+# waits for the terminal or the disk.
+
+# Per-message records (every command sent, every response received) are DEBUG,
+# so at the default INFO level they cost almost nothing. To see them for just
+# some pairs while the server is running, list their pair ids, one per line, in
+# the trace file (a line containing * traces every pair); the file is re-read
+# whenever it changes, and emptying it turns tracing off again.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import atexit
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from enum import Enum
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# How often the trace file is checked for changes, in seconds
+TRACE_FILE_POLL_INTERVAL = 1
+
+
+# Formats a record as one line of JSON: time, level, event, pair_id if the
+# record has one, then the record's own fields
+class JsonLinesFormatter(logging.Formatter):
+
+    def format(self, record):
+        entry = {'time': round(record.created, 6),
+                 'level': record.levelname,
+                 'event': record.getMessage()}
+        pair_id = getattr(record, 'pair_id', None)
+        if pair_id is not None:
+            entry['pair_id'] = pair_id
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=json_default)
+
+
+# Enums (Phase, Role) are written as their value, messages already encoded as
+# JSON bytes (see message_codec.py) as what they encode, anything else json
+# cannot encode as its str()
+def json_default(value):
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (bytes, bytearray)):
+        try:
+            return json.loads(value.decode('utf-8'))
+        except ValueError:
+            pass
+    return str(value)
+
+
+class ExperimentLog(object):
+    """
+    Wraps a logging.Logger so that each record is an event name plus keyword
+    fields, e.g. log.info('pair', pair_id=pair_id, condition=condition).
+
+    debug() records are written if the logger is enabled for DEBUG, or if
+    their pair_id is being traced.
+    """
+
+    def __init__(self, logger, listener=None, trace_file=None):
+        self.logger = logger
+        self.listener = listener
+        self.trace_file = trace_file
+        self.traced_pairs = frozenset()
+        self.trace_all = False
+        self._start_watcher()
+        # A forked child (a ShardedWebsocketServer worker) gets none of our
+        # threads, and could inherit a stream locked mid-write; so drain the
+        # queue and stop the listener before forking, then restart it on both
+        # sides
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(before=self._before_fork,
+                                after_in_parent=self._after_fork_in_parent,
+                                after_in_child=self._after_fork_in_child)
+
+    def _start_watcher(self):
+        if self.trace_file is not None:
+            watcher = threading.Thread(target=self._watch_trace_file)
+            watcher.daemon = True
+            watcher.start()
+
+    def _before_fork(self):
+        if self.listener is not None:
+            self.listener.stop()
+
+    def _after_fork_in_parent(self):
+        if self.listener is not None:
+            self.listener.start()
+
+    def _after_fork_in_child(self):
+        self._after_fork_in_parent()
+        self._start_watcher()
+
+    def tracing(self, pair_id):
+        return self.trace_all or (pair_id is not None and pair_id in self.traced_pairs)
+
+    def trace_pairs(self, pair_ids):
+        """Traces exactly these pairs from now on; '*' traces them all."""
+        pair_ids = frozenset(pair_ids)
+        self.trace_all = '*' in pair_ids
+        self.traced_pairs = pair_ids
+        self.logger.info('tracing', extra={'fields': {'pairs': sorted(pair_ids)}})
+
+    def debug(self, event, pair_id=None, **fields):
+        if self.logger.isEnabledFor(logging.DEBUG) or self.tracing(pair_id):
+            self._emit(logging.DEBUG, event, pair_id, fields)
+
+    def info(self, event, pair_id=None, **fields):
+        if self.logger.isEnabledFor(logging.INFO):
+            self._emit(logging.INFO, event, pair_id, fields)
+
+    def warning(self, event, pair_id=None, **fields):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._emit(logging.WARNING, event, pair_id, fields)
+
+    def error(self, event, pair_id=None, **fields):
+        if self.logger.isEnabledFor(logging.ERROR):
+            self._emit(logging.ERROR, event, pair_id, fields)
+
+    def _emit(self, level, event, pair_id, fields):
+        # handle() rather than log(), so that traced records get past the
+        # logger's level
+        record = self.logger.makeRecord(self.logger.name, level, '', 0, event, (), None,
+                                        extra={'pair_id': pair_id, 'fields': fields})
+        self.logger.handle(record)
+
+    def _watch_trace_file(self):
+        last_mtime = None
+        while True:
+            try:
+                mtime = os.stat(self.trace_file).st_mtime
+            except OSError:
+                mtime = None
+            if mtime != last_mtime:
+                last_mtime = mtime
+                pair_ids = []
+                if mtime is not None:
+                    with open(self.trace_file) as f:
+                        pair_ids = [line.strip() for line in f if line.strip()]
+                if pair_ids or self.traced_pairs:
+                    self.trace_pairs(pair_ids)
+            time.sleep(TRACE_FILE_POLL_INTERVAL)
+
+    def close(self):
+        """Writes out everything still queued; also runs at exit."""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+
+def setup_logging(name, path=None, level=logging.INFO, console=True,
+                  max_bytes=50 * 2**20, backup_count=5, trace_file=None):
+    """
+    Returns an ExperimentLog writing JSON lines to path (rotated once it
+    reaches max_bytes, keeping backup_count old files) and/or to stdout.
+    """
+    handlers = []
+    if path is not None:
+        # the file is only made once there is something to write to it, so importing a
+        # server script (e.g. from a benchmark) leaves nothing behind
+        handlers.append(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True))
+    if console:
+        handlers.append(logging.StreamHandler(sys.stdout))
+    formatter = JsonLinesFormatter()
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue() if hasattr(queue, 'SimpleQueue') else queue.Queue()
+    listener = QueueListener(records, *handlers)
+    listener.start()
+    logger = logging.getLogger(name)
+    logger.setLevel(level)
+    logger.propagate = False
+    logger.addHandler(QueueHandler(records))
+
+    log = ExperimentLog(logger, listener, trace_file)
+    atexit.register(log.close)
+    return log
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Metrics for monitoring a running server
+##############
+
+# An ExperimentMetrics serves the state of the server at http://127.0.0.1:<port>/metrics in
+# Prometheus' text format, for Prometheus to scrape or to read with curl while a session is
+# running. It counts the messages of each command_type and response_type, times how long
+# each kind of response takes from arriving to its handler finishing (including any wait
+# behind the pair's other messages), how long a Matcher waits for the Director's label to
+# be relayed, and how long participants wait in the waiting room. How long each of the
+# engine's handlers, and each send, takes is timed by the engine itself (whether or not it
+# has metrics). The rest is read from the websocket server and the experiment's other parts
+# (waiting room, reaper, journal, trial recorder, design pool) when the metrics are
+# requested, so costs nothing in between.
+
+# Counting and timing take no lock (see websocket_server/metrics.py), so handlers never
+# wait for one another, or for a scrape, to record them.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+from websocket_server.metrics import Counter, Histogram, FunctionMetric, MetricsEndpoint
+
+# Upper bounds, in seconds, of the buckets for time spent in the waiting room
+WAIT_BUCKETS = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+
+# The websocket server's stats() (see WebsocketServerBase) exposed as counters
+TRANSPORT_COUNTERS = [('websocket_messages_received_total', 'messages_in', 'Messages received from clients.'),
+                      ('websocket_messages_sent_total', 'messages_out', 'Messages sent to clients.'),
+                      ('websocket_bytes_received_total', 'bytes_in', 'Bytes of websocket frames received.'),
+                      ('websocket_bytes_sent_total', 'bytes_out', 'Bytes of websocket frames sent.'),
+                      ('websocket_handshake_failures_total', 'handshake_failures',
+                       'Connections that did not complete the websocket handshake.'),
+                      ('websocket_slow_consumer_evictions_total', 'slow_consumer_evictions',
+                       'Clients disconnected for not reading what they were sent.'),
+                      ('websocket_heartbeat_timeouts_total', 'heartbeat_timeouts',
+                       'Clients disconnected for sending nothing, not even a pong.')]
+
+
+class ExperimentMetrics(object):
+    """
+    The metrics of one InteractionExperiment, served on port (on host, by
+    default only to the machine the server runs on) once the experiment is
+    attached to its websocket server.
+    """
+
+    def __init__(self, port, host='127.0.0.1'):
+        self.port = port
+        self.host = host
+        self.endpoint = None
+        self.commands_sent = Counter('experiment_commands_sent_total',
+                                     'Commands sent to clients, by command_type.', ['command_type'])
+        self.responses_received = Counter('experiment_responses_received_total',
+                                          'Responses received from clients, by response_type.', ['response_type'])
+        self.response_seconds = Histogram('experiment_response_seconds',
+                                          'Time from a response arriving to its handler finishing.',
+                                          labels=['response_type', 'role'])
+        self.relay_seconds = Histogram('experiment_director_to_matcher_seconds',
+                                       "Time from a Director's RESPONSE arriving to the Matcher command being sent.")
+        self.waits = Histogram('experiment_waiting_room_wait_seconds',
+                               'Time participants spent in the waiting room, by how they left it.',
+                               buckets=WAIT_BUCKETS, labels=['outcome'])
+        self.metrics = [self.commands_sent, self.responses_received, self.response_seconds,
+                        self.relay_seconds, self.waits]
+
+    # Adds the metrics read from experiment's parts and the websocket server, and starts serving
+    def start(self, experiment, server):
+        self.metrics.append(FunctionMetric('gauge', 'websocket_connections', 'Clients connected now.',
+                                           lambda: server.stats()['connections']))
+        for name, stat, help in TRANSPORT_COUNTERS:
+            self.metrics.append(FunctionMetric('counter', name, help, stat_reader(server.stats, stat)))
+        self.metrics.append(server.round_trip_times)
+        self.metrics.append(experiment.handler_seconds)
+        self.metrics.append(experiment.send_seconds)
+        self.metrics.append(FunctionMetric('gauge', 'experiment_participants', 'Participants connected now.',
+                                           lambda: len(experiment.participants)))
+        room = experiment.waiting_room.stats
+        self.metrics.append(FunctionMetric('gauge', 'experiment_waiting_room_size',
+                                           'Participants waiting for a partner.', stat_reader(room, 'waiting')))
+        self.metrics.append(FunctionMetric('counter', 'experiment_pairs_total', 'Pairs made in the waiting room.',
+                                           stat_reader(room, 'pairs')))
+        self.metrics.append(FunctionMetric('counter', 'experiment_reaped_total',
+                                           'Clients disconnected for not being heard from (see reaper.py).',
+                                           stat_reader(experiment.reaper.stats, 'reaped')))
+        self.metrics.append(FunctionMetric('gauge', 'experiment_designs_ready',
+                                           'Designs made in advance and not yet used, by cell.',
+                                           lambda: {(cell,): n for cell, n in experiment.design_pool.stock().items()},
+                                           labels=['cell']))
+        if experiment.journal is not None:
+            journal = experiment.journal.stats
+            self.metrics.append(FunctionMetric('gauge', 'experiment_journal_bytes',
+                                               'Bytes of the journal in use (see journal.py).',
+                                               stat_reader(journal, 'bytes')))
+            self.metrics.append(FunctionMetric('counter', 'experiment_journal_compactions_total',
+                                               'Times the journal has been compacted.',
+                                               stat_reader(journal, 'compactions')))
+        if experiment.recorder is not None:
+            recorder = experiment.recorder.stats
+            self.metrics.append(FunctionMetric('counter', 'experiment_trials_recorded_total',
+                                               'Trials recorded (see trial_recorder.py).',
+                                               stat_reader(recorder, 'recorded')))
+            self.metrics.append(FunctionMetric('gauge', 'experiment_trials_waiting',
+                                               'Trials recorded but not yet written.',
+                                               stat_reader(recorder, 'waiting')))
+        self.endpoint = MetricsEndpoint(lambda: self.metrics, self.port, self.host)
+        self.endpoint.start()
+
+    def close(self):
+        if self.endpoint is not None:
+            self.endpoint.shutdown()
+            self.endpoint.server_close()
+            self.endpoint = None
+
+
+# Returns a function reading stats()[name]
+def stat_reader(stats, name):
+    return lambda: stats()[name]
@@ -0,0 +1,1062 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### The interaction, shared by every version of the experiment
+##############
+
+# What happens between a client connecting and the end of the experiment is the
+# same in every version: clients send CLIENT_INFO, are paired in the waiting room,
+# read the instructions, then take turns as Director and Matcher through their
+# pair's trial list. What differs is the design each pair gets (their shapes,
+# trial list, and so on), which the server script makes (see make_design there).
+# A server script describes its version with an InteractionExperiment and
+# hands it the websocket server.
+
+# What happens when a client enters each phase, and how each kind of client
+# response is handled, is declared below with @enters and @responds_to. These
+# are compiled into dispatch tables when an InteractionExperiment is made, so
+# handling a message or moving to the next phase is a dictionary lookup rather
+# than a run through a chain of if/elif. A version that needs to do something
+# differently can subclass InteractionExperiment and declare its own handler
+# for that phase or response.
+
+# We are using json-encoded dictionaries to send messages back and forth between server and client.
+
+# Each message from the server to the client includes a key command_type which
+# lets the client know what action to take.
+
+# Each message from the client to the server includes a key response_type, which
+# indicates the kind of response the client is providing.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import functools
+import os
+import random
+import threading
+import time
+import traceback
+
+from session_state import Participant, Pair, Phase, Role
+from message_codec import default_codec, ConstantCommands, MessageTemplate
+from matchmaking import WaitingRoom
+from reaper import DeadlineReaper
+from actors import ActorPool, DEFAULT_WORKERS
+from journal import SessionJournal
+from websocket_server.metrics import Histogram
+
+
+# Clients ping the server regularly to keep connections open - I am assuming a ping
+# every 5 seconds - so a client we have not heard from for this many seconds has gone
+# (see reaper.py)
+MAX_TIMEDIFF_BEFORE_TIMEOUT = 1600
+
+# After a restart, seconds for which pairs that were running can be resumed (see journal.py);
+# after that, a participant still waiting for their partner to come back is told they have dropped out
+RESUME_WINDOW = 600
+
+# The commands that never change, framed once and sent with send_command_by_id
+CONSTANT_COMMANDS = [{"command_type": "WaitForPartner"},
+                     {"command_type": "WaitingRoomPairing"},
+                     {"command_type": "Pong"},
+                     {"command_type": "PartnerDropout"},
+                     {"command_type": "EndExperiment"},
+                     {"command_type": "DuplicateParticipant"},
+                     {"command_type": "Instructions", "instruction_type": "Interaction"}]
+
+# Upper bounds, in seconds, of the buckets for the time handlers and sends take
+HANDLER_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def enters(phase):
+    """Declares the method as what happens when a client enters phase."""
+    def declare(method):
+        method.entered_phase = phase
+        return method
+    return declare
+
+
+def responds_to(response_type, role=None):
+    """
+    Declares the method as the handler for client responses of response_type;
+    with role, only for those whose 'role' field is role.
+    """
+    def declare(method):
+        method.response = (response_type, role)
+        return method
+    return declare
+
+
+def clocked(method):
+    """Times every call of the method into handler_seconds, under its name."""
+    name = method.__name__
+
+    @functools.wraps(method)
+    def clocked_method(self, *args):
+        started = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            self.handler_seconds.observe(time.perf_counter() - started, name)
+    return clocked_method
+
+
+# Returns randomised copy of l, i.e. does not shuffle in place
+def shuffle(l):
+    return random.sample(l, len(l))
+
+
+class InteractionExperiment(object):
+    """
+    One version of the experiment: pairs clients, gives each pair a design
+    from design_pool, and runs the interaction.
+
+    Args:
+        log: the script's ExperimentLog (see experiment_log.py)
+        design_pool: DesignPool of the script's designs. A design is a dict
+            with 'shapes', 'correspondences' and 'trials', and optionally
+            'mappings', one for each participant, of abstract to actual shapes,
+            which are then sent with every trial command.
+        assign_cell: function returning the design cell (e.g. condition) for a
+            new pair
+        describe_cell: function returning a dict of log fields for a cell
+        break_trials: trials after which participants are offered a break
+        codec: how messages are encoded, by default the fastest available
+        timeout: seconds after which a client we have not heard from is disconnected
+        workers: threads that handle clients' messages (see actors.py)
+        journal_path: file in which to keep each running pair's progress, so that pairs
+            can carry on where they left off if the server is restarted (see journal.py);
+            not used with the ShardedWebsocketServer
+        resume_window: seconds after a restart for which those pairs can be resumed
+        recorder: TrialRecorder to write every trial's outcome to (see trial_recorder.py)
+        participant_index: ParticipantIndex of everyone who has been paired before, who are
+            turned away if they connect again (see participant_index.py); with the
+            ShardedWebsocketServer, checked by its coordinator before pairing
+        metrics: ExperimentMetrics to count and time messages in, served over HTTP from when the
+            experiment is attached (see experiment_metrics.py); not used with the ShardedWebsocketServer
+        profiler: SamplingProfiler to start and stop by signalling the server process (see profiler.py);
+            what it writes includes the handler timers below
+        admin: AdminChannel to stream each pair's progress to admins who subscribe to it
+            (see admin_channel.py); not used with the ShardedWebsocketServer
+
+    Whatever the options, the handlers marked @clocked below are timed into handler_seconds, and
+    handing each command to the websocket server into send_seconds (Histograms, see
+    websocket_server/metrics.py).
+    """
+
+    # The phases clients progress through, in order
+    phase_sequence = [Phase.START, Phase.PAIR_PARTICIPANTS, Phase.INTERACTION, Phase.END]
+
+    def __init__(self, log, design_pool, assign_cell, describe_cell=None, break_trials=(), codec=None,
+                 timeout=MAX_TIMEDIFF_BEFORE_TIMEOUT, workers=DEFAULT_WORKERS, journal_path=None,
+                 resume_window=RESUME_WINDOW, recorder=None, participant_index=None, metrics=None,
+                 profiler=None, admin=None):
+        self.log = log
+        self.design_pool = design_pool
+        self.assign_cell = assign_cell
+        self.describe_cell = describe_cell or (lambda cell: {'cell': cell})
+        self.break_trials = frozenset(break_trials)
+        self.codec = codec or default_codec()
+        self.commands = ConstantCommands(self.codec, CONSTANT_COMMANDS)
+        self.server = None
+
+        # The main piece of state is a dictionary, participants. Each connected client has
+        # an entry in here, indexed by their ID (an integer assigned when they connect).
+        # Their entry is a Participant (see session_state.py) holding all the information
+        # we need to guide them through the experiment, including their client_info
+        # (details of the socket etc that is required for message passing), the ID of
+        # their partner, their current phase and role (e.g. director or matcher), and once
+        # paired, their Pair. The Pair holds what both partners share: their shapes, their
+        # list of trials, and the trial counter showing where they are in the experiment.
+        self.participants = {}
+        # Clients who are in the waiting room waiting to be paired (see matchmaking.py), and
+        # a list of client IDs for clients in the waiting room waiting for their partner to
+        # finish training
+        self.waiting_room = WaitingRoom('pairing')
+        self.post_training_clients = []
+        # Deadlines for hearing from each client, expired in the background
+        self.reaper = DeadlineReaper(timeout, self.expire)
+        # Each client's messages are handled on an actor (see actors.py): the matchmaking
+        # actor until they are paired, then their pair's. So each pair's state is only
+        # ever changed by one thread at a time, the waiting room only by the matchmaking
+        # actor, and different pairs are handled in parallel.
+        self.actors = ActorPool(workers, on_error=self._task_failed)
+        self.matchmaker = self.actors.actor('matchmaking')
+        # Every change to a running pair is recorded in the journal. After a restart, the
+        # pairs it shows were running can be resumed: resumable has each of their
+        # participant_ids, and resuming the client_id of whichever partner is back first,
+        # by pair_id. Both are only used by the matchmaking actor.
+        self.journal = SessionJournal(journal_path) if journal_path else None
+        self.resume_window = resume_window
+        self.resumable = {}
+        self.resuming = {}
+        self.recorder = recorder
+        self.participant_index = participant_index
+        # With the ShardedWebsocketServer, the coordinator process checks participant_ids before
+        # pairing (see screen_client), as each worker only knows of the pairs it has made: this
+        # has the client id there of each participant_id it has let through, by participant_id
+        self.screened = {}
+        self.metrics = metrics
+        self.profiler = profiler
+        self.admin = admin
+        self.handler_seconds = Histogram('experiment_handler_seconds',
+                                         'Time spent in each handler, including the handlers it calls.',
+                                         buckets=HANDLER_BUCKETS, labels=['handler'])
+        self.send_seconds = Histogram('experiment_send_seconds',
+                                      'Time spent handing each command to the websocket server to send.',
+                                      buckets=HANDLER_BUCKETS)
+
+        self._compile()
+
+    def _compile(self):
+        # collect the declared handlers, a subclass's overriding its bases'
+        self.phase_handlers = {}
+        self.response_handlers = {}
+        for cls in reversed(type(self).__mro__):
+            for name, method in vars(cls).items():
+                if hasattr(method, 'entered_phase'):
+                    self.phase_handlers[method.entered_phase] = getattr(self, name)
+                if hasattr(method, 'response'):
+                    self.response_handlers[method.response] = getattr(self, name)
+        missing = [phase for phase in self.phase_sequence if phase not in self.phase_handlers]
+        if missing:
+            raise ValueError("Nothing declared for entering %s" % ', '.join(str(phase) for phase in missing))
+        self.next_phase = dict(zip(self.phase_sequence, self.phase_sequence[1:]))
+        # response types whose handler depends on the role they come from
+        self.role_dispatched = set(response_type for response_type, role in self.response_handlers
+                                   if role is not None)
+
+    # Registers our callbacks with the websocket server
+    def attach(self, server):
+        self.server = server
+        server.set_fn_new_client(self.new_client)
+        server.set_fn_client_left(self.client_left)
+        server.set_fn_message_received(self.message_received)
+        # the asyncio server runs callbacks one at a time on its event loop, the only thread
+        # allowed to send, so there each task runs there and then
+        if getattr(server, 'loop', None) is not None:
+            self.actors.workers = 0
+        if hasattr(server, 'set_fn_screen_client'):
+            # the ShardedWebsocketServer pairs clients before a worker hears from them, so they are
+            # checked there
+            server.set_fn_screen_client(self.screen_client)
+            server.set_fn_unpaired_client_left(self.unscreen_client)
+            server.set_fn_worker_stopped(self.worker_stopped)
+        if self.journal is not None:
+            if hasattr(server, 'worker_index'):
+                # the ShardedWebsocketServer pairs clients in arrival order before handing them to
+                # a worker, so cannot bring the partners of a pair back together
+                self.log.warning('journal_disabled', reason='sharded server')
+                self.journal = None
+            else:
+                self.recover()
+        if self.metrics is not None:
+            if hasattr(server, 'worker_index'):
+                # each worker process would need a port of its own
+                self.log.warning('metrics_disabled', reason='sharded server')
+                self.metrics = None
+            else:
+                self.metrics.start(self, server)
+                self.log.info('metrics', port=self.metrics.endpoint.port)
+        if self.admin is not None:
+            if hasattr(server, 'worker_index'):
+                # each worker process only sees its own pairs
+                self.log.warning('admin_disabled', reason='sharded server')
+                self.admin = None
+            else:
+                self.admin.start(server, self.codec)
+                self.log.info('admin', token_path=self.admin.token_path)
+        if self.profiler is not None:
+            if self.profiler.install(self.log, self.timing_summary):
+                self.log.info('profiler', pid=os.getpid(), signal=self.profiler.signum)
+            else:
+                self.log.warning('profiler_disabled', reason='no signal to start it with on this platform')
+
+    # Reads back the pairs that were running when the server last stopped, and lets them be
+    # resumed for resume_window seconds
+    def recover(self):
+        n_records, seconds = self.journal.recover()
+        for state in self.journal.state.values():
+            for participant_id in state['participant_ids']:
+                self.resumable[participant_id] = state
+        self.log.info('recovered', pairs=len(self.journal.state), records=n_records, seconds=seconds)
+        if self.resumable:
+            timer = threading.Timer(self.resume_window, self.tell_matchmaker, (self.end_resumption,))
+            timer.daemon = True
+            timer.start()
+
+    # Has client_id's actor call fn(client_id, *args)
+    def tell(self, client_id, fn, *args):
+        actor = self.participants[client_id].actor
+        actor.tell(self._deliver, actor, client_id, fn, args)
+
+    def _deliver(self, actor, client_id, fn, args):
+        participant = self.participants.get(client_id)
+        if participant is not None and participant.actor is not actor:
+            # they have been paired since this was told to the matchmaking actor; nothing
+            # they send after pairing can arrive before it, so it goes after anything
+            # already waiting on their pair's actor
+            participant.actor.tell(self._deliver, participant.actor, client_id, fn, args)
+            return
+        fn(client_id, *args)
+
+    # Has the matchmaking actor call fn(*args), from a thread that is not handling a client
+    def tell_matchmaker(self, fn, *args):
+        loop = getattr(self.server, 'loop', None)
+        if loop is not None:
+            loop.call_soon_threadsafe(self.matchmaker.tell, fn, *args)
+        else:
+            self.matchmaker.tell(fn, *args)
+
+    def _task_failed(self, actor, fn):
+        self.log.error('task_failed', actor=actor.name, exception=traceback.format_exc())
+
+    # Lines summing up handler_seconds and send_seconds, for the profiler's summary
+    def timing_summary(self):
+        lines = ['Since the server started (times include any handlers a handler calls):',
+                 '%-28s %10s %10s %14s %10s' % ('', 'calls', 'mean ms', '99% under ms', 'total s')]
+        timings = sorted((label_values[0], timing) for label_values, timing in self.handler_seconds.summary().items())
+        timings += [('(sending a command)', timing) for timing in self.send_seconds.summary().values()]
+        for name, (n, total, bound) in timings:
+            lines.append('%-28s %10d %10.3f %14s %10.2f' % (name, n, 1000 * total / n if n else 0,
+                                                            '%g' % (1000 * bound), total))
+        return lines
+
+    # Converts message dictionary to JSON and sends to client_id; message can also be
+    # JSON already encoded by the codec, e.g. rendered from one of the participant's templates,
+    # in which case command_type says what it is, for the metrics.
+    def send_message_by_id(self, client_id, message, command_type=None):
+        participant = self.participants[client_id]
+        self.log.debug('send', pair_id=pair_id_of(participant), client_id=client_id, message=message)
+        if isinstance(message, dict):
+            command_type = message['command_type']
+            message = self.codec.dumps(message)
+        started = time.perf_counter()
+        self.server.send_message(participant.client_info, message)
+        self.send_seconds.observe(time.perf_counter() - started)
+        if self.metrics is not None:
+            self.metrics.commands_sent.inc(command_type)
+
+    # Sends one of the constant commands to client_id
+    def send_command_by_id(self, client_id, command_type):
+        participant = self.participants[client_id]
+        self.log.debug('send', pair_id=pair_id_of(participant), client_id=client_id,
+                       message=self.commands.messages[command_type])
+        started = time.perf_counter()
+        self.server.send_frame(participant.client_info, self.commands.frame(command_type))
+        self.send_seconds.observe(time.perf_counter() - started)
+        if self.metrics is not None:
+            self.metrics.commands_sent.inc(command_type)
+
+    # Called by the reaper when we have not heard from a client for too long: drops their
+    # connection, and the server then calls client_left as it does for any disconnection,
+    # which frees their place in the waiting room and tells their partner
+    def expire(self, client_id, last_heard_from):
+        participant = self.participants.get(client_id)
+        if participant is None:
+            return
+        self.log.warning('timeout', pair_id=pair_id_of(participant), client_id=client_id,
+                         last_heard_from=last_heard_from,
+                         detection_latency=time.time() - last_heard_from - self.reaper.timeout)
+        self.server.disconnect(participant.client_info)
+
+    # Builds templates for the trial commands this participant will be sent: the fields
+    # that stay the same for the whole interaction, including their mapping if they have
+    # one, are encoded once, here, and on each trial only the rest are encoded
+    def make_templates(self, client_id):
+        participant = self.participants[client_id]
+        pair = participant.pair
+        fixed = {'max_trial_n': len(pair.trial_list),
+                 'partner_id': self.participants[participant.partner].participant_id}
+        if participant.mapping is not None:
+            fixed['mapping'] = participant.mapping
+        participant.templates = {"Director": MessageTemplate(self.codec, command_type="Director",
+                                                             label_choices=pair.shapes, **fixed),
+                                 "Matcher": MessageTemplate(self.codec, command_type="Matcher", **fixed)}
+        if participant.mapping is not None:
+            participant.templates["Feedback"] = MessageTemplate(self.codec, command_type="Feedback",
+                                                                mapping=participant.mapping)
+
+    # Checks that all clients listed in list_of_ids are still connected to the server -
+    # if so, clients will be in participants
+    def all_connected(self, list_of_ids):
+        return all(id in self.participants for id in list_of_ids)
+
+    # Called when a client drops out, used to notify any clients who are still connected
+    # that this leaves them stranded.
+    def notify_stranded(self, list_of_ids):
+        for id in list_of_ids:
+            if id in self.participants:
+                #this will notify the participant and cause them to disconnect
+                self.send_command_by_id(id, "PartnerDropout")
+
+    ######################
+    ##### Handling clients connecting, disconnecting, sending messages
+    ######################
+
+    # Called for every client connecting (after handshake)
+    # Initialiases that client in participants, as a Participant
+    # client objects passed over from the websocket are dictionaries including an id
+    # key (the client's integer identifier) and a client_info key, which contains
+    # technical details needed to communicate with this client via the socket
+    def new_client(self, client, server):
+        client_id = client['id']
+        self.log.info('connect', client_id=client_id, address=client['address'])
+        participant = Participant(client_id, client, time.time())
+        participant.actor = self.matchmaker
+        self.participants[client_id] = participant
+        self.reaper.touch(client_id)
+
+    # Called for every client disconnecting
+    def client_left(self, client, server):
+        client_id = client['id']
+        if self.admin is not None and self.admin.unsubscribe(client_id):
+            self.log.info('admin_unsubscribed', client_id=client_id)
+            return
+        self.log.info('disconnect', client_id=client_id)
+        self.reaper.remove(client_id)
+        self.tell(client_id, self.remove_client)
+
+    # Finds all partners and notifies (NB this will have no effect if experiment is over)
+    # Remove the client from the waiting room if appropriate
+    # Remove the client from participants
+    def remove_client(self, client_id):
+        participant = self.participants.get(client_id)
+        if participant is None:
+            # an admin who disconnected as they subscribed (see admin_subscribe)
+            if self.admin is not None:
+                self.admin.unsubscribe(client_id)
+            return
+        waited = self.waiting_room.leave(client_id)
+        if waited is not None:
+            self.log.info('leave_waiting_room', client_id=client_id, waited=waited)
+            if self.metrics is not None:
+                self.metrics.waits.observe(waited, 'left')
+        if self.admin is not None and participant.participant_id is not None and participant.phase is not Phase.END:
+            self.admin.publish('dropout', pair_id=pair_id_of(participant), participant_id=participant.participant_id,
+                               phase=participant.phase.value if participant.phase else None)
+        # If they have a partner, and if you are not leaving because you are at the End state,
+        # notify partner that they have been stranded
+        if participant.partner is not None:
+            if participant.phase is not Phase.END:
+                self.notify_stranded([participant.partner])
+                self.journal_ended(participant.pair, 'dropout')
+        # or if they were waiting for their partner to come back after a restart, stop waiting
+        state = self.resumable.get(participant.participant_id)
+        if state is not None and self.resuming.get(state['pair_id']) == client_id:
+            del self.resuming[state['pair_id']]
+        # and let their id be used again if they left before being paired
+        if self.participant_index is not None and participant.participant_id is not None:
+            self.participant_index.release(participant.participant_id, client_id)
+        del self.participants[client_id]
+
+    # Called when the server receives a message from the client.
+    # Parses the message to a dictionary using codec.loads, reads off the
+    # response_type (and, for some, the role) and has the client's actor pass it to the
+    # handler declared for it
+    def message_received(self, client, server, message):
+        client_id = client['id']
+        participant = self.participants.get(client_id)
+        if participant is None:
+            # an admin subscribed to the event stream, who has nothing more to say
+            return
+        response = self.codec.loads(message)
+        response_code = response['response_type']
+        self.log.debug('receive', pair_id=pair_id_of(participant), client_id=client_id, message=redacted(response))
+        participant.last_heard_from = time.time()
+        self.reaper.touch(client_id)
+        if response_code in self.role_dispatched:
+            handler = self.response_handlers.get((response_code, response.get('role')))
+        else:
+            handler = self.response_handlers.get((response_code, None))
+        if handler is None:
+            self.log.warning('unknown_response', client_id=client_id, message=redacted(response))
+            return
+        #closed sockets are detected by the websocket server's own ping/pong
+        #heartbeat, so there is no need to ping the partner here
+        if self.metrics is None:
+            self.tell(client_id, handler, response)
+        else:
+            self.metrics.responses_received.inc(response_code)
+            self.tell(client_id, self.timed, handler, response, time.perf_counter())
+
+    # On the client's actor: handles response as message_received would have, and records how
+    # long it took from arriving
+    def timed(self, client_id, handler, response, received):
+        handler(client_id, response)
+        seconds = time.perf_counter() - received
+        response_code = response['response_type']
+        role = response.get('role') if response_code in self.role_dispatched else None
+        self.metrics.response_seconds.observe(seconds, response_code, role or '')
+        #relaying the Director's label to the Matcher is the last thing their response's handler does
+        if response_code == 'RESPONSE' and role == 'Director':
+            self.metrics.relay_seconds.observe(seconds)
+
+    ##########################
+    ### Management of phases
+    ##########################
+
+    # Moves the client on to the phase after their current one
+    def progress_phase(self, client_id):
+        self.enter_phase(client_id, self.next_phase[self.participants[client_id].phase])
+
+    # Records the client's new phase and triggers the actions declared for it
+    @clocked
+    def enter_phase(self, client_id, phase):
+        participant = self.participants[client_id]
+        participant.phase = phase
+        if self.admin is not None:
+            self.admin.publish('phase', pair_id=pair_id_of(participant), participant_id=participant.participant_id,
+                               phase=phase.value)
+        self.phase_handlers[phase](client_id)
+
+    # Nothing actually happens here, but in some experiments we will need to set stuff up
+    # when the participant starts the experiment
+    @enters(Phase.START)
+    def start(self, client_id):
+        self.log.info('phase', client_id=client_id, phase=Phase.START)
+        self.progress_phase(client_id)
+
+    # Attempts to pair this client with anyone already in the waiting room; this runs on
+    # the matchmaking actor, like everything else before a client is paired
+    @enters(Phase.PAIR_PARTICIPANTS)
+    def pair_participants(self, client_id):
+        self.log.info('phase', client_id=client_id, phase=Phase.PAIR_PARTICIPANTS)
+        #send message to the client sending them to waiting room
+        #NB we always send them to the waiting room so we can have a uniform treatment at the client
+        #end regardless of whether they had 0 waiting time or not
+        #(with the ShardedWebsocketServer the pairing coordinator has already done this)
+        if not self.participants[client_id].client_info.get('waiting_message_sent'):
+            self.send_command_by_id(client_id, "WaitingRoomPairing")
+        #pair them with whoever has waited longest, or leave them in the waiting room if no one is waiting
+        match = self.waiting_room.join(client_id)
+        #if that partner disconnected just as they were paired, try again with the next one
+        while match is not None and not self.all_connected(match.client_ids):
+            match = self.waiting_room.join(client_id)
+        # If they have been paired, set up the pair and progress both to the next phase
+        if match is not None:
+            self.make_pair(match)
+
+    # Links the two clients in match, gives them a design and an actor of their own, and has
+    # that actor move them to the next phase
+    def make_pair(self, match):
+        unpaired_one, unpaired_two = match.client_ids
+        # Link them - mark them as each others' partner
+        participant_one = self.participants[unpaired_one]
+        participant_two = self.participants[unpaired_two]
+        participant_one.partner = unpaired_two
+        participant_two.partner = unpaired_one
+        pair_id = participant_one.participant_id + '_' + participant_two.participant_id
+
+        # Both participants will work through a shared target list; that and the rest of the
+        # pair's design were made in advance for the cell they are assigned to (see make_design
+        # in the server script)
+        cell = self.assign_cell()
+        design = self.design_pool.take(cell)
+
+        #record these pieces of info, then move them to the next phase
+        if 'mappings' in design:
+            participant_one.mapping = design['mappings'][0]
+            participant_two.mapping = design['mappings'][1]
+        pair = Pair(pair_id, design['shapes'], design['correspondences'], design['trials'],
+                    actor=self.actors.actor(pair_id), cell=cell)
+        self.log.info('pair', pair_id=pair_id, client_ids=[unpaired_one, unpaired_two], waits=match.waits(),
+                      shapes=design['shapes'], correspondences=design['correspondences'],
+                      **self.describe_cell(cell))
+        if self.admin is not None:
+            self.admin.publish('pair', pair_id=pair_id,
+                               participant_ids=[participant_one.participant_id, participant_two.participant_id],
+                               trial_counter=0, max_trial_n=len(design['trials']), **self.describe_cell(cell))
+        if self.metrics is not None:
+            for waited in match.waits():
+                self.metrics.waits.observe(waited, 'paired')
+        self.log.debug('trial_list', pair_id=pair_id, trials=design['trials'])
+        if self.journal is not None:
+            self.journal.paired(pair_id, [participant_one.participant_id, participant_two.participant_id],
+                                design, cell)
+        if self.participant_index is not None:
+            self.participant_index.add(participant_one.participant_id)
+            self.participant_index.add(participant_two.participant_id)
+        self.hand_over(pair, [unpaired_one, unpaired_two], self.start_pair)
+
+    # Gives the clients in list_of_participants their pair, and moves them onto its actor, which
+    # first calls start(list_of_participants, *args)
+    def hand_over(self, pair, list_of_participants, start, *args):
+        for c in list_of_participants:
+            self.participants[c].pair = pair
+        #start is told to the pair's actor before either participant is moved onto it,
+        #so it runs before anything else they send
+        pair.actor.tell(start, list_of_participants, *args)
+        for c in list_of_participants:
+            self.participants[c].actor = pair.actor
+
+    # On the pair's actor: builds both partners' templates and moves them to the next phase
+    def start_pair(self, list_of_participants):
+        if not self.all_connected(list_of_participants):
+            self.notify_stranded(list_of_participants)
+            return
+        for c in list_of_participants:
+            self.make_templates(c)
+            self.progress_phase(c)
+
+    # A participant whose pair was running when the server stopped is back: once their partner
+    # is too, rebuild their pair from the journal and carry on from the trial they were on
+    def resume(self, client_id):
+        participant = self.participants[client_id]
+        state = self.resumable[participant.participant_id]
+        pair_id = state['pair_id']
+        participant.phase = Phase.PAIR_PARTICIPANTS
+        partner_id = self.resuming.pop(pair_id, None)
+        if (partner_id is None or not self.all_connected([partner_id])
+                or self.participants[partner_id].participant_id == participant.participant_id):
+            self.resuming[pair_id] = client_id
+            self.log.info('wait_to_resume', pair_id=pair_id, client_id=client_id)
+            self.send_command_by_id(client_id, "WaitingRoomPairing")
+            return
+        for participant_id in state['participant_ids']:
+            del self.resumable[participant_id]
+        #in the same order as when they were paired, which is the order of their mappings
+        client_ids = {self.participants[c].participant_id: c for c in [partner_id, client_id]}
+        list_of_participants = [client_ids[participant_id] for participant_id in state['participant_ids']]
+        mappings = state['mappings'] or [None, None]
+        for c, partner, mapping in zip(list_of_participants, reversed(list_of_participants), mappings):
+            self.participants[c].partner = partner
+            self.participants[c].mapping = mapping
+        pair = Pair(pair_id, state['shapes'], state['correspondences'], state['trials'],
+                    actor=self.actors.actor(pair_id), cell=state['cell'])
+        pair.trial_counter = state['trial_counter']
+        self.log.info('resume', pair_id=pair_id, client_ids=list_of_participants,
+                      trial_counter=pair.trial_counter, **self.describe_cell(state['cell']))
+        if self.admin is not None:
+            self.admin.publish('pair', pair_id=pair_id, participant_ids=state['participant_ids'],
+                               trial_counter=pair.trial_counter, max_trial_n=len(pair.trial_list), resumed=True,
+                               **self.describe_cell(state['cell']))
+        self.hand_over(pair, list_of_participants, self.resume_pair, state['roles'])
+
+    # On the pair's actor: as start_pair, but back to the instructions if they had not finished
+    # them, otherwise to the start of the trial they were on, in the roles they had
+    def resume_pair(self, list_of_participants, roles):
+        if not self.all_connected(list_of_participants):
+            self.notify_stranded(list_of_participants)
+            return
+        for c in list_of_participants:
+            self.make_templates(c)
+            if roles is None:
+                self.enter_phase(c, Phase.INTERACTION)
+            else:
+                participant = self.participants[c]
+                participant.phase = Phase.INTERACTION
+                participant.role = Role(roles[participant.participant_id])
+                self.send_message_by_id(c, {"command_type": "PairID", "pair_id": participant.pair.pair_id})
+        if roles is not None:
+            self.start_interaction_trial(list_of_participants)
+
+    # When resume_window is up, pairs not yet resumed never will be
+    def end_resumption(self):
+        self.notify_stranded(list(self.resuming.values()))
+        self.log.info('resume_window_closed', waiting=len(self.resuming),
+                      not_resumed=len(set(state['pair_id'] for state in self.resumable.values())))
+        for state in list(self.resumable.values()):
+            if state['pair_id'] in self.journal.state:
+                self.journal.ended(state['pair_id'], 'not_resumed')
+        self.resumable.clear()
+        self.resuming.clear()
+
+    # Records in the journal that pair is over, so will not be resumed after a restart
+    def journal_ended(self, pair, reason):
+        if self.journal is not None and pair.pair_id in self.journal.state:
+            self.journal.ended(pair.pair_id, reason)
+
+    # Writes the outcome of the pair's current trial to the recorder, with the columns used in
+    # Analysis/data; label and object_choices are joined as the clients do in their own data
+    def record_trial(self, pair, director_id, matcher_id, guess, score):
+        trial = pair.current_trial()
+        director = self.participants[director_id]
+        matcher = self.participants[matcher_id]
+        row = {'time': round(time.time(), 3), 'pair_id': pair.pair_id,
+               'block_n': trial['block'], 'trial_n': pair.trial_counter + 1,
+               'director_id': director.participant_id, 'matcher_id': matcher.participant_id,
+               'object': object_to_string(trial['target']), 'label': label_to_string(pair.label),
+               'object_choices': '_'.join(object_to_string(o) for o in pair.object_choices),
+               'object_selected': object_to_string(guess), 'score': score}
+        if director.mapping is not None:
+            # Experiment 2: the columns above are in the abstract shapes (shapeN, label N) the partners
+            # share, and these in the actual shapes each of them saw, as in the local_ columns of
+            # their own data files
+            row.update(director_local_object=object_to_string(trial['target'], director.mapping),
+                       director_local_label=label_to_string(pair.label, director.mapping),
+                       matcher_local_label=label_to_string(pair.label, matcher.mapping),
+                       matcher_local_object_choices='_'.join(object_to_string(o, matcher.mapping)
+                                                             for o in pair.object_choices),
+                       matcher_local_object_selected=object_to_string(guess, matcher.mapping))
+        row.update(self.describe_cell(pair.cell))
+        self.recorder.record(row)
+
+    # Records in the journal the trial list_of_participants are on, and their roles in it
+    def journal_trial(self, list_of_participants):
+        if self.journal is not None:
+            participants = [self.participants[c] for c in list_of_participants]
+            self.journal.trial(participants[0].pair.pair_id, participants[0].pair.trial_counter,
+                               {p.participant_id: p.role.value for p in participants})
+
+    # Tells any admins (see admin_channel.py) who is Director and who is Matcher in list_of_participants' pair
+    def publish_roles(self, list_of_participants):
+        if self.admin is not None:
+            participants = [self.participants[c] for c in list_of_participants]
+            roles = {p.role: p.participant_id for p in participants}
+            self.admin.publish('roles', pair_id=participants[0].pair.pair_id, trial_counter=participants[0].pair.trial_counter,
+                               director=roles.get(Role.DIRECTOR), matcher=roles.get(Role.MATCHER))
+
+    # Everything admins are sent when they subscribe: every pair, with each partner's phase and
+    # role, and the number of participants connected and waiting to be paired (not counting
+    # the client exclude, the admin it is for)
+    def admin_snapshot(self, exclude=None):
+        pairs = {}
+        waiting = 0
+        participants = [p for p in list(self.participants.values()) if p.client_id != exclude]
+        for participant in participants:
+            pair = participant.pair
+            if pair is None:
+                if participant.phase is Phase.PAIR_PARTICIPANTS:
+                    waiting += 1
+                continue
+            if pair.pair_id not in pairs:
+                pairs[pair.pair_id] = dict(pair_id=pair.pair_id, trial_counter=pair.trial_counter,
+                                           max_trial_n=len(pair.trial_list), participants=[],
+                                           **self.describe_cell(pair.cell))
+            pairs[pair.pair_id]['participants'].append({'participant_id': participant.participant_id,
+                                                        'phase': participant.phase.value if participant.phase else None,
+                                                        'role': participant.role.value if participant.role else None})
+        return {'pairs': list(pairs.values()), 'connected': len(participants), 'waiting': waiting}
+
+    # Once paired with a partner clients will end up here; Interaction phase starts with instructions,
+    # so just send those instructions to the client
+    @enters(Phase.INTERACTION)
+    def interaction(self, client_id):
+        participant = self.participants[client_id]
+        self.log.info('phase', pair_id=pair_id_of(participant), client_id=client_id, phase=Phase.INTERACTION)
+        self.send_message_by_id(client_id, {"command_type": "PairID", "pair_id": participant.pair.pair_id})
+        #set role
+        participant.role = Role.READING_INSTRUCTIONS
+        self.send_command_by_id(client_id, "Instructions")
+
+    # When they hit the end phase, the EndExperiment command will instruct the clients to end the experiment.
+    @enters(Phase.END)
+    def end(self, client_id):
+        self.send_command_by_id(client_id, "EndExperiment")
+
+    #################
+    ### Client responses
+    #################
+
+    # if client sends Ping, respond with Pong
+    @responds_to('Ping')
+    def ping(self, client_id, response):
+        self.send_command_by_id(client_id, "Pong")
+
+    # an admin (rather than a participant) asking for the event stream: with the right token, they
+    # are no longer treated as a participant, and are sent a snapshot and then each event
+    # (see admin_channel.py); otherwise they are disconnected
+    @responds_to('ADMIN_SUBSCRIBE')
+    def admin_subscribe(self, client_id, response):
+        participant = self.participants[client_id]
+        if (self.admin is None or participant.participant_id is not None
+                or not self.admin.authenticate(response.get('token'))):
+            self.log.warning('admin_refused', client_id=client_id, address=participant.client_info['address'])
+            self.server.disconnect(participant.client_info)
+            return
+        self.reaper.remove(client_id)
+        # subscribed before they stop being a participant, so that if they disconnect meanwhile either
+        # client_left unsubscribes them, or remove_client, told while they were still a participant, does
+        self.admin.subscribe(participant.client_info, self.admin_snapshot(exclude=client_id))
+        del self.participants[client_id]
+        self.log.info('admin_subscribed', client_id=client_id, address=participant.client_info['address'])
+
+    # client is passing in a unique ID, simply associate that with this client and then send them to the first phase
+    # (unless their pair was running when the server stopped and can be resumed, or they have
+    # taken part before, in which case they are told so and go no further)
+    @responds_to('CLIENT_INFO')
+    def client_info(self, client_id, response):
+        participant_id = response.get('client_info')
+        participant = self.participants[client_id]
+        if not valid_participant_id(participant_id):
+            self.log.warning('bad_client_info', client_id=client_id, participant_id=repr(participant_id))
+            self.server.disconnect(participant.client_info)
+            return
+        participant.participant_id = participant_id
+        if participant_id in self.resumable:
+            self.resume(client_id)
+        elif self.participant_index is not None and not self.participant_index.reserve(participant_id, client_id):
+            #paired before, or another connection with the same id is on its way to being paired
+            self.log.warning('duplicate_participant', client_id=client_id, participant_id=participant_id)
+            self.send_command_by_id(client_id, "DuplicateParticipant")
+        else:
+            self.enter_phase(client_id, self.phase_sequence[0])
+
+    # With the ShardedWebsocketServer, runs in its coordinator process on the first message of
+    # each client, before they are paired (and so before client_info): a worker that turned one
+    # of a pair away would have nobody else to pair the other with. Returns None to let them be
+    # paired, or what to send them before they are disconnected
+    def screen_client(self, client, server, message):
+        try:
+            response = self.codec.loads(message)
+        except ValueError:
+            response = None
+        if not isinstance(response, dict):
+            response = {}
+        if response.get('response_type') != 'CLIENT_INFO':
+            #e.g. ADMIN_SUBSCRIBE, which is not available with the ShardedWebsocketServer
+            self.log.warning('not_client_info', address=client['address'], response_type=response.get('response_type'))
+            return ''
+        participant_id = response.get('client_info')
+        if not valid_participant_id(participant_id):
+            self.log.warning('bad_client_info', address=client['address'], participant_id=repr(participant_id))
+            return ''
+        if self.participant_index is not None:
+            #the index here has everyone paired before the server started; everyone let through
+            #since will be paired, in one worker or another
+            if participant_id in self.participant_index or participant_id in self.screened:
+                self.log.warning('duplicate_participant', address=client['address'], participant_id=participant_id)
+                return self.codec.dumps({"command_type": "DuplicateParticipant"})
+            self.screened[participant_id] = client['id']
+            client['participant_id'] = participant_id
+        return None
+
+    # With the ShardedWebsocketServer, in its coordinator process: a client screen_client let through
+    # has left before being paired, so their participant_id can be used again
+    def unscreen_client(self, client, server):
+        participant_id = client.get('participant_id')
+        if participant_id is not None and self.screened.get(participant_id) == client['id']:
+            del self.screened[participant_id]
+
+    # With the ShardedWebsocketServer, in a worker process it is stopping, which exits without
+    # running the atexit functions that would write out the trials still waiting to be
+    def worker_stopped(self, server):
+        if self.recorder is not None:
+            self.recorder.flush()
+
+    # Runs when participants complete instructions.
+    # Need to waits until both participants are ready to progress - use the role for this,
+    # mark participants as ReadyToInteract when they indicate they have finished reading the instructions.
+    # Then when both participants are ready we randomly assigns roles of Director and Matcher and
+    # start the first interaction trial.
+    @responds_to('INTERACTION_INSTRUCTIONS_COMPLETE')
+    def initiate_interaction(self, client_id, response):
+        participant = self.participants[client_id]
+        partner_id = participant.partner
+        list_of_participants = [client_id, partner_id]
+        #checking both players are still connected, to avoid one being left hanging
+        if not self.all_connected(list_of_participants):
+            self.notify_stranded(list_of_participants)
+        else:
+            self.send_command_by_id(client_id, "WaitForPartner")
+            partner_role = self.participants[partner_id].role
+            #if your partner is ready to go, let's go!
+            if partner_role is Role.READY_TO_INTERACT:
+                self.log.info('interaction_start', pair_id=pair_id_of(participant))
+                #allocate random director and matcher, and run start_interaction_trial for both clients
+                for client, role in zip(list_of_participants, shuffle([Role.DIRECTOR, Role.MATCHER])):
+                    self.participants[client].role = role
+                self.journal_trial(list_of_participants)
+                self.publish_roles(list_of_participants)
+                self.start_interaction_trial(list_of_participants)
+            else: #else mark you as ready to go, so you will wait for partner
+                participant.role = Role.READY_TO_INTERACT
+
+    # Interaction trial - sends director trial instruction to director and wait instruction to matcher
+    # For director, we need to send the D command_type, with the prompt_word and also the partner_id
+    # (the partner_id is just sent so that the client can record this in the data file it produces).
+    @clocked
+    def start_interaction_trial(self, list_of_participants):
+        #check everyone is still connected!
+        if not self.all_connected(list_of_participants):
+            self.notify_stranded(list_of_participants)
+            return
+        #figure out who is the director
+        director_id = [id for id in list_of_participants if self.participants[id].role is Role.DIRECTOR][0]
+        #retrieve their pair, which holds the trial list and trial counter
+        director = self.participants[director_id]
+        pair = director.pair
+        #check that the pair has more trials to run - if not, move to next phase
+        if pair.finished():
+            self.journal_ended(pair, 'finished')
+            for c in list_of_participants:
+                self.progress_phase(c)
+            return
+        #otherwise retrieve the info we need from the director and their pair
+        trial = pair.current_trial()
+        if self.admin is not None:
+            self.admin.publish('trial', pair_id=pair.pair_id, trial_counter=pair.trial_counter,
+                               max_trial_n=len(pair.trial_list), block_n=trial['block'],
+                               director=director.participant_id)
+        target = trial['target']
+        context_array = shuffle([target] + trial['foils'])
+        for c in list_of_participants:
+            this_role = self.participants[c].role
+            if this_role is Role.DIRECTOR: #send the appropriate instruction to the Director
+                #label_choices, max_trial_n, partner_id (and any mapping) are already in the director's template
+                instruction_string = director.templates["Director"].render(target_meaning=target,
+                                        context_array=context_array,
+                                        #send over info on current trial number etc for display to participant
+                                        block_n=trial['block'],
+                                        trial_n=pair.trial_counter + 1)
+                self.send_message_by_id(c, instruction_string, "Director")
+            elif this_role is Role.MATCHER: #and send the appropriate instruction to the matcher
+                self.send_command_by_id(c, "WaitForPartner")
+
+    # When director responds, all we need to do is relay their label to the matcher.
+    @responds_to('RESPONSE', role='Director')
+    @clocked
+    def handle_director_response(self, director_id, director_response):
+        director = self.participants[director_id]
+        matcher_id = director.partner
+        if not self.all_connected([matcher_id]): #the usual check that everyone is still connected
+            self.notify_stranded([director_id])
+            return
+        #retrieve the current trial from their pair
+        pair = director.pair
+        trial = pair.current_trial()
+        target = trial['target']
+        context_array = shuffle([target] + trial['foils'])
+
+        #note that director_response['response'] is the clue word the director sent us
+        self.send_command_by_id(director_id, "WaitForPartner")
+        #kept for recording the trial once the matcher responds
+        pair.label = director_response['response']
+        pair.object_choices = context_array
+
+        #max_trial_n, partner_id (and any mapping) are already in the matcher's template
+        instruction_string = self.participants[matcher_id].templates["Matcher"].render(target_meaning=target,
+                                director_label=director_response['response'],
+                                #send over info on current trial number etc for display to participant
+                                meaning_choices=context_array,
+                                block_n=trial['block'],
+                                trial_n=pair.trial_counter + 1)
+        self.send_message_by_id(matcher_id, instruction_string, "Matcher")
+
+    # When the matcher responds with their guess, we need to send feedback to matcher + director.
+    # Both clients are sent a feedback command: command_type F, then multiple pieces of info including
+    # score, the intended target, the clue provided, etc etc
+    @responds_to('RESPONSE', role='Matcher')
+    @clocked
+    def handle_matcher_response(self, matcher_id, matcher_response):
+        matcher = self.participants[matcher_id]
+        director_id = matcher.partner
+        if not self.all_connected([director_id, matcher_id]):
+            self.notify_stranded([director_id, matcher_id])
+            return
+        #easiest way to access what the target was is to look it up in the pair's trial list
+        pair = matcher.pair
+        target = pair.current_trial()['target']
+        #participants have an option for a self-paced break after each of break_trials
+        break_option = 'true' if (pair.trial_counter + 1) in self.break_trials else 'false'
+        guess = matcher_response['response']
+        score = 1 if target == guess else 0
+        if self.recorder is not None:
+            self.record_trial(pair, director_id, matcher_id, guess, score)
+        if matcher.mapping is None:
+            #both get the same feedback, so it only needs encoding once
+            feedback = self.codec.dumps({"command_type": "Feedback", "score": score,
+                                         "target": target, "guess": guess,
+                                         "break_allowed": break_option})
+            for c in [matcher_id, director_id]: #send to both clients
+                self.send_message_by_id(c, feedback, "Feedback")
+        else:
+            #each gets their own mapping, which is already in their Feedback template
+            for c in [director_id, matcher_id]:
+                feedback = self.participants[c].templates["Feedback"].render(score=score,
+                                target=target, guess=guess,
+                                break_allowed=break_option)
+                self.send_message_by_id(c, feedback, "Feedback")
+
+    # Each client comes here when they signals they are done with feedback from an interaction trial.
+    # The first client who returns will set their role to 'WaitingToSwitch'.
+    # The second client to return will then trigger the next trial, then we can use the role of that
+    # second client to figure out who will be director and matcher at the next trial.
+    @responds_to('FINISHED_FEEDBACK')
+    @clocked
+    def swap_roles_and_progress(self, client_id, response):
+        participant = self.participants[client_id]
+        partner_id = participant.partner
+        if not self.all_connected([client_id, partner_id]):
+            self.notify_stranded([client_id, partner_id])
+            return
+        partner = self.participants[partner_id]
+        #If your partner is already ready, then switch roles and progress
+        if partner.role is Role.WAITING_TO_SWITCH:
+            #both partners are done with this trial, so move the shared trial counter on
+            participant.pair.next_trial()
+            if participant.role is Role.DIRECTOR: #if you were director for this trial then
+                participant.role = Role.MATCHER #next time you will be Matcher...
+                partner.role = Role.DIRECTOR #..and your partner will be Director
+            else:
+                participant.role = Role.DIRECTOR #otherwise the opposite
+                partner.role = Role.MATCHER
+            self.journal_trial([client_id, partner_id])
+            self.publish_roles([client_id, partner_id])
+            #next trial
+            self.start_interaction_trial([client_id, partner_id])
+        #Otherwise your partner is not yet ready, so just flag up that you are
+        else:
+            #NOT sending to wait here - it causes problems because they both end up waiting simultaneously
+            participant.role = Role.WAITING_TO_SWITCH
+
+    #client reporting a non-responsive partner (NB this is not implemented in the client)
+    @responds_to('NONRESPONSIVE_PARTNER')
+    def nonresponsive_partner(self, client_id, response):
+        pass #not doing anything special with this - the participant reporting
+        #the problem leaves, so for their partner it will be as if they have
+        #dropped out
+
+    #participant timed out in waiting room while waiting for partner to complete training
+    @responds_to('AFTER_TRAINING_TIMEOUT')
+    def after_training_timeout(self, client_id, response):
+        #remove the timed-out participant from the waiting list
+        if client_id in self.post_training_clients:
+            self.post_training_clients.remove(client_id)
+        #not doing anything other than that - the participant reporting
+        #the problem leaves, so for their partner it will be as if they have
+        #dropped out
+
+
+# An object as the clients write it in their data: a string as it is, and a shape-colour
+# dictionary (Experiment 2) as shape_colour, with abstract (integer) shapes as shapeN, or
+# given a participant's mapping, as the actual shape they saw
+def object_to_string(an_object, mapping=None):
+    if not isinstance(an_object, dict):
+        return str(an_object)
+    shape = an_object['shape']
+    if isinstance(shape, int):
+        shape = mapping[shape] if mapping is not None else 'shape%d' % shape
+    return '%s_%s' % (shape, an_object['colour'])
+
+
+# A Director's label as the clients write it in their data: a label made of several
+# shapes joined with -, and abstract (integer) shapes as they are, or given a
+# participant's mapping, as the actual shape they saw
+def label_to_string(label, mapping=None):
+    parts = label if isinstance(label, list) else [label]
+    return '-'.join(str(mapping[part] if mapping is not None and isinstance(part, int) else part)
+                    for part in parts)
+
+
+# Whether a participant_id from CLIENT_INFO can be used: it goes in file names and, one per
+# line, in the participant index
+def valid_participant_id(participant_id):
+    return isinstance(participant_id, str) and participant_id != '' and '\n' not in participant_id
+
+
+# A client's response as it is logged, without any token in it
+def redacted(response):
+    if 'token' in response:
+        return dict(response, token='...')
+    return response
+
+
+# The id of the participant's pair, for logging - None until they are paired
+def pair_id_of(participant):
+    if participant.pair is None:
+        return None
+    return participant.pair.pair_id
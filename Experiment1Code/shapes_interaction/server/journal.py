@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Surviving a server restart
+##############
+
+# Everything about a pair in progress (their design, roles and how far through
+# their trial list they are) lives in the server's memory, so if the server
+# stops every pair is lost. A SessionJournal records each change to a pair as
+# it happens (paired, roles assigned or swapped, trial finished, pair ended) in
+# an append-only file, and when the server starts again it reads the file back
+# to find the pairs that were still running, so that their participants can
+# carry on from the trial they were on when they reconnect.
+
+# The file is memory-mapped: adding a record copies it into the mapping, with no
+# system call, so handlers never wait for the disk. Pages written to the mapping
+# survive the server process being killed; a background thread also flushes them
+# to disk every few seconds, in case the whole machine goes down. Each record
+# carries its length and a checksum, so one cut off part way through being
+# written is recognised, and it and everything after it ignored.
+
+# Only pairs still running are ever needed, so the journal is compacted - written
+# out again as one record per running pair - when it starts getting full and
+# each time the server starts. Recovery therefore reads at most one file's worth
+# of records, however long the server has been running. Compacting is done by
+# the background thread, and holds the lock that adding a record takes only to
+# copy the running pairs and, at the end, to copy over the records added while
+# it wrote the new file; if the file fills up before the thread gets to it, it
+# is made bigger and the thread woken, so adding a record never waits for it.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import logging
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+logger = logging.getLogger(__name__)
+
+# Bytes mapped for the journal; the file is made bigger if the pairs still
+# running take up more than half of it, or if it fills up before it is compacted
+DEFAULT_SIZE = 16 * 2**20
+
+# Seconds between flushes of the journal to disk
+DEFAULT_FLUSH_INTERVAL = 2.0
+
+# The background thread compacts the journal once it is this full
+COMPACT_FRACTION = 0.75
+
+# Start of the file, followed by records
+MAGIC = b'SIJOURN1'
+# Each record: length and crc32 of the pickled record, then the record; a zero
+# length marks the end of the records. Records are pickled rather than JSON, as
+# designs are in design_pool.py, so a pair comes back exactly as it was made
+# (e.g. with integer shapes as dictionary keys)
+RECORD_HEADER = struct.Struct('<II')
+
+
+class Journal(object):
+    """
+    An append-only, memory-mapped file of records (pickled dicts), folded
+    into state as they are added.
+
+    Subclasses say how a record changes state (apply) and which records
+    describe state as it now is (snapshot, which is what the journal is
+    compacted to; records that later calls to apply will not change). recover() reads back the file left by the last run; after
+    that, append() records a change and applies it. append() may be called
+    from any thread.
+    """
+
+    def __init__(self, path, size=DEFAULT_SIZE, flush_interval=DEFAULT_FLUSH_INTERVAL):
+        self.path = path
+        self.size = size
+        self.flush_interval = flush_interval
+        self.state = self.empty_state()
+        self._mmap = None
+        self._end = 0
+        self._lock = threading.Lock()
+        self._compact_soon = threading.Event()
+        self._closed = False
+        self.appended = 0
+        self.compactions = 0
+
+    def empty_state(self):
+        return {}
+
+    def apply(self, record):
+        raise NotImplementedError
+
+    def snapshot(self):
+        raise NotImplementedError
+
+    def recover(self):
+        """
+        Replays the records left by the last run into state, then compacts the
+        journal and starts flushing it. Returns the number of records read and
+        how long that took, in seconds.
+        """
+        start = time.time()
+        n_records = 0
+        if os.path.exists(self.path) and os.path.getsize(self.path) > len(MAGIC):
+            with open(self.path, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for record in self._read(data):
+                    self.apply(record)
+                    n_records += 1
+            finally:
+                data.close()
+        self._compact()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return n_records, time.time() - start
+
+    def _read(self, data):
+        if data[:len(MAGIC)] != MAGIC:
+            logger.warning("%s is not a journal; ignoring it" % self.path)
+            return
+        position = len(MAGIC)
+        while position + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, position)
+            if length == 0:
+                return
+            body = data[position + RECORD_HEADER.size:position + RECORD_HEADER.size + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                logger.warning("%s: record at byte %d is incomplete; ignoring the rest" % (self.path, position))
+                return
+            yield pickle.loads(body)
+            position += RECORD_HEADER.size + length
+
+    def append(self, record):
+        """Records record, then applies it to state."""
+        body = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self.apply(record)
+            if self._mmap is None:
+                return  # not recovered yet, or closed
+            needed = self._end + RECORD_HEADER.size + len(body) + RECORD_HEADER.size
+            if needed > self.size:
+                # full before the background thread compacted it: make room rather than
+                # compacting here, and have the thread compact it now
+                size = self.size
+                while needed > size:
+                    size *= 2
+                self._mmap = grow(self.path, self._mmap, size)
+                self.size = size
+                self._compact_soon.set()
+            self._write(self._mmap, self._end, body)
+            self._end += RECORD_HEADER.size + len(body)
+            self.appended += 1
+
+    @staticmethod
+    def _write(data, position, body):
+        # the body goes in before the length, so a record is never seen without it
+        start = position + RECORD_HEADER.size
+        data[start:start + len(body)] = body
+        RECORD_HEADER.pack_into(data, position, len(body), zlib.crc32(body))
+
+    def _compact(self):
+        # writes state as it now is to a new file, then swaps it in for the old one, with
+        # the records added meanwhile copied to the end of it; only ever run by one thread
+        # at a time (recover, then the background thread)
+        with self._lock:
+            records = self.snapshot()
+            mark = self._end
+            size = self.size
+        bodies = [pickle.dumps(record, pickle.HIGHEST_PROTOCOL) for record in records]
+        needed = len(MAGIC) + sum(RECORD_HEADER.size + len(body) for body in bodies) + RECORD_HEADER.size
+        while needed > size // 2:
+            size *= 2
+        new_path = self.path + '.new'
+        with open(new_path, 'w+b') as f:
+            f.truncate(size)
+            data = mmap.mmap(f.fileno(), size)
+        data[:len(MAGIC)] = MAGIC
+        position = len(MAGIC)
+        for body in bodies:
+            self._write(data, position, body)
+            position += RECORD_HEADER.size + len(body)
+        data.flush()
+        with self._lock:
+            if self._closed:
+                data.close()
+                os.remove(new_path)
+                return
+            if self._mmap is not None:
+                added = self._mmap[mark:self._end]
+                while position + len(added) + RECORD_HEADER.size > size:
+                    size *= 2
+                if size > len(data):
+                    data = grow(new_path, data, size)
+                data[position:position + len(added)] = added
+                position += len(added)
+                self._mmap.close()
+            os.replace(new_path, self.path)
+            self._mmap = data
+            self._end = position
+            self.size = size
+            self.compactions += 1
+
+    def flush(self, compact=False):
+        """Writes the journal to disk, compacting it first if it is getting full (or compact)."""
+        with self._lock:
+            if self._mmap is None:
+                return
+            compact = compact or self._end > self.size * COMPACT_FRACTION
+            if not compact:
+                self._mmap.flush()
+        if compact:
+            self._compact()
+
+    def run(self):
+        """Flushes forever; recover() runs this in a daemon thread."""
+        while not self._closed:
+            # woken early by append when the journal fills up
+            compact = self._compact_soon.wait(self.flush_interval)
+            self._compact_soon.clear()
+            try:
+                self.flush(compact)
+            except Exception:
+                logger.exception("Could not flush %s" % self.path)
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path, 'bytes': self._end, 'size': self.size,
+                    'appended': self.appended, 'compactions': self.compactions}
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            if self._mmap is not None:
+                self._mmap.flush()
+                self._mmap.close()
+                self._mmap = None
+
+
+# data, a mapping of the file at path, made size bytes long; the old mapping is closed
+def grow(path, data, size):
+    with open(path, 'r+b') as f:
+        f.truncate(size)
+        bigger = mmap.mmap(f.fileno(), size)
+    data.close()
+    return bigger
+
+
+class SessionJournal(Journal):
+    """
+    The pairs still running, as a dict of pair_id: the pair's latest state, a
+    dict with the 'pair' record's fields (see InteractionExperiment.make_pair)
+    plus their trial_counter and, once the interaction has started, 'roles',
+    a dict of participant_id: role at the start of that trial.
+    """
+
+    def apply(self, record):
+        kind = record['record']
+        if kind == 'pair':
+            state = dict(record)
+            state.setdefault('trial_counter', 0)
+            state.setdefault('roles', None)
+            self.state[record['pair_id']] = state
+        elif kind == 'trial':
+            state = self.state.get(record['pair_id'])
+            if state is not None:
+                state['trial_counter'] = record['trial_counter']
+                state['roles'] = record['roles']
+        elif kind == 'end':
+            self.state.pop(record['pair_id'], None)
+
+    def snapshot(self):
+        # apply replaces a state's values rather than changing them, so a copy of each will do
+        return [dict(state) for state in self.state.values()]
+
+    def paired(self, pair_id, participant_ids, design, cell):
+        self.append({'record': 'pair', 'pair_id': pair_id, 'participant_ids': participant_ids,
+                     'cell': cell, 'shapes': design['shapes'], 'correspondences': design['correspondences'],
+                     'trials': design['trials'], 'mappings': design.get('mappings')})
+
+    # Called when roles are first assigned, and each time they swap for the next trial
+    def trial(self, pair_id, trial_counter, roles):
+        self.append({'record': 'trial', 'pair_id': pair_id, 'trial_counter': trial_counter, 'roles': roles})
+
+    def ended(self, pair_id, reason):
+        self.append({'record': 'end', 'pair_id': pair_id, 'reason': reason})
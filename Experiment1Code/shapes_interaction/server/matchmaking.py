@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### The waiting room
+##############
+
+# Participants who are ready to be paired wait in a WaitingRoom until someone
+# else arrives. Each client handler runs in its own thread, so joining, leaving
+# and pairing all happen under the room's lock: two participants arriving at
+# the same moment are paired with each other or with whoever was already
+# waiting, never both with the same person. The room is an OrderedDict of
+# client_id: time they joined, so joining, leaving and taking the longest-
+# waiting participant all take the same time however many are waiting.
+
+# Rooms are independent of each other, so several can run side by side (one
+# per experiment version, say); WaitingRooms keeps them by name.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class Match(object):
+    # room: name of the WaitingRoom the pair met in
+    # client_ids: the two client_ids, the one who had been waiting first
+    # joined_at: when each of them joined the room
+    # paired_at: when they were paired
+    __slots__ = ('room', 'client_ids', 'joined_at', 'paired_at')
+
+    def __init__(self, room, client_ids, joined_at, paired_at):
+        self.room = room
+        self.client_ids = client_ids
+        self.joined_at = joined_at
+        self.paired_at = paired_at
+
+    def __repr__(self):
+        return 'Match(%s, %r, waits=%r)' % (self.room, self.client_ids, self.waits())
+
+    # How long each of them waited, in seconds
+    def waits(self):
+        return [self.paired_at - joined_at for joined_at in self.joined_at]
+
+
+class WaitingRoom(object):
+    """
+    Participants waiting for a partner, paired in order of arrival.
+
+    join(client_id) either pairs the client with whoever has waited longest,
+    returning the Match, or leaves them waiting and returns None. Also keeps
+    count of the pairs made, the participants who left without a partner and
+    how long everyone waited, for stats().
+    """
+
+    def __init__(self, name='waiting_room', clock=time.time):
+        self.name = name
+        self.clock = clock
+        self._waiting = OrderedDict()
+        self._lock = threading.Lock()
+        self.pairs = 0
+        self.left = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def __contains__(self, client_id):
+        return client_id in self._waiting
+
+    def join(self, client_id):
+        """
+        Pairs client_id with the longest-waiting participant and returns the
+        Match, or adds client_id to the room and returns None if no one is
+        waiting (or client_id already is).
+        """
+        now = self.clock()
+        with self._lock:
+            if client_id in self._waiting:
+                return None
+            if not self._waiting:
+                self._waiting[client_id] = now
+                return None
+            partner, joined_at = self._waiting.popitem(last=False)
+            self.pairs += 1
+            self._record_wait(now - joined_at)
+            self._record_wait(0.0)
+        return Match(self.name, (partner, client_id), (joined_at, now), now)
+
+    def leave(self, client_id):
+        """
+        Removes client_id from the room, returning how long they waited, or
+        None if they were not waiting (e.g. they have just been paired).
+        """
+        with self._lock:
+            joined_at = self._waiting.pop(client_id, None)
+            if joined_at is None:
+                return None
+            self.left += 1
+            waited = self.clock() - joined_at
+            self._record_wait(waited)
+        return waited
+
+    def waiting(self):
+        """The client_ids waiting, longest-waiting first."""
+        with self._lock:
+            return list(self._waiting)
+
+    def stats(self):
+        with self._lock:
+            n_waits = 2 * self.pairs + self.left
+            return {'room': self.name, 'waiting': len(self._waiting), 'pairs': self.pairs,
+                    'left': self.left, 'max_wait': self.max_wait,
+                    'mean_wait': self.total_wait / n_waits if n_waits else 0.0}
+
+    def _record_wait(self, waited):
+        self.total_wait += waited
+        if waited > self.max_wait:
+            self.max_wait = waited
+
+
+class WaitingRooms(object):
+    """WaitingRooms by name, each made the first time it is asked for."""
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.rooms = {}
+        self._lock = threading.Lock()
+
+    def room(self, name):
+        with self._lock:
+            room = self.rooms.get(name)
+            if room is None:
+                room = self.rooms[name] = WaitingRoom(name, self.clock)
+            return room
+
+    def stats(self):
+        with self._lock:
+            rooms = list(self.rooms.values())
+        return [room.stats() for room in rooms]
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Encoding the server's commands
+##############
+
+# Three ways of avoiding work when sending a command:
+# - A codec turns dictionaries into UTF-8 JSON bytes and back, using orjson or
+#   ujson if one is installed and the standard library's json otherwise. The
+#   bytes can be given straight to server.send_message, which then sends them
+#   without encoding them again.
+# - ConstantCommands holds complete websocket frames for commands that never
+#   change (WaitForPartner, Pong, EndExperiment...), built once at startup and
+#   sent with server.send_frame.
+# - A MessageTemplate encodes the fields of a command that stay the same for a
+#   whole interaction (a pair's label_choices, a participant's mapping...) once,
+#   so that only the fields that change from trial to trial are encoded each time.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import json
+
+from websocket_server import encode_frame
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+# A codec has a name, dumps(message) returning compact UTF-8 JSON bytes,
+# and loads(data) accepting str or bytes
+class StdlibCodec(object):
+    name = 'json'
+
+    def __init__(self):
+        # json.dumps builds a new encoder on every call unless given no options
+        self.encoder = json.JSONEncoder(separators=(',', ':'), ensure_ascii=False)
+
+    def dumps(self, message):
+        return self.encoder.encode(message).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class OrjsonCodec(object):
+    name = 'orjson'
+
+    def dumps(self, message):
+        return orjson.dumps(message)
+
+    def loads(self, data):
+        return orjson.loads(data)
+
+
+class UjsonCodec(object):
+    name = 'ujson'
+
+    def dumps(self, message):
+        return ujson.dumps(message, ensure_ascii=False).encode('utf-8')
+
+    def loads(self, data):
+        return ujson.loads(data)
+
+
+# The fastest codec available, in this order of preference
+def default_codec():
+    if orjson is not None:
+        return OrjsonCodec()
+    if ujson is not None:
+        return UjsonCodec()
+    return StdlibCodec()
+
+
+class ConstantCommands(object):
+    """
+    Pre-framed commands, looked up by command_type. The frames are never
+    compressed, which is allowed whether or not a client has negotiated
+    permessage-deflate, so the same bytes can go to every client.
+    """
+
+    def __init__(self, codec, messages):
+        self.messages = {}
+        self.frames = {}
+        for message in messages:
+            command_type = message['command_type']
+            self.messages[command_type] = message
+            self.frames[command_type] = encode_frame(codec.dumps(message))
+
+    def frame(self, command_type):
+        return self.frames[command_type]
+
+
+class MessageTemplate(object):
+    """
+    A command whose fixed fields are encoded once, when the template is made.
+    render(**fields) encodes only the given fields and splices them in, giving
+    the same bytes codec.dumps would for the whole dictionary (up to the order
+    of the keys). Both the fixed fields and those given to render must be
+    non-empty, and render must not repeat a fixed field.
+    """
+    __slots__ = ('codec', 'fixed')
+
+    def __init__(self, codec, **fixed):
+        self.codec = codec
+        # everything after the opening brace, i.e. '"key":value,...}'
+        self.fixed = codec.dumps(fixed)[1:]
+
+    def render(self, **fields):
+        # everything before the closing brace, a comma, then the fixed fields
+        return self.codec.dumps(fields)[:-1] + b',' + self.fixed
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Participants who have already taken part
+##############
+
+# Each participant may only take part once. Their participant_id arrives in
+# CLIENT_INFO, so the server reserves it there, and turns away anyone whose id
+# has been paired before, or is reserved by another connection that has not
+# been paired yet, before they reach the waiting room. The reservation becomes
+# permanent when they are paired (add), and is released if they disconnect
+# before then. Each of these is a set or dict lookup, however many participants
+# there have been.
+
+# With the ShardedWebsocketServer each worker process has its own copy of the
+# index, which only learns of the pairs that worker makes, so the experiment
+# checks ids in the coordinator process instead, before pairing (see
+# screen_client in interaction_engine.py): against the ids the index had when
+# the server started, and every id it has let through since.
+
+# The ids are also appended to a text file, one per line, which is read back
+# when the server starts. It can be seeded from the directory save_data.php
+# writes participants' data to (files named s_<participant_id>.csv), so that
+# everyone who took part before the server kept its own list counts too.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ParticipantIndex(object):
+    """
+    The participant_ids listed in the file at path, plus those with a data file
+    in data_directory if given, and any added since.
+    """
+
+    def __init__(self, path, data_directory=None):
+        self.path = path
+        self._ids = set()
+        # participant_id: client_id of the connection that has it, until it is added
+        self._reserved = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self._ids.update(line.rstrip('\n') for line in f if line.strip())
+        if data_directory is not None:
+            self._ids.update(participant_ids_in(data_directory))
+        self._file = None
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __contains__(self, participant_id):
+        return participant_id in self._ids
+
+    def reserve(self, participant_id, client_id):
+        """
+        Reserves participant_id for client_id, returning False if it has been
+        added already or another client has it reserved.
+        """
+        with self._lock:
+            if participant_id in self._ids or self._reserved.get(participant_id, client_id) != client_id:
+                return False
+            self._reserved[participant_id] = client_id
+        return True
+
+    def release(self, participant_id, client_id):
+        """Releases client_id's reservation of participant_id, if it has one."""
+        with self._lock:
+            if self._reserved.get(participant_id) == client_id:
+                del self._reserved[participant_id]
+
+    def add(self, participant_id):
+        """Adds participant_id, returning False if it was already there."""
+        with self._lock:
+            self._reserved.pop(participant_id, None)
+            if participant_id in self._ids:
+                return False
+            self._ids.add(participant_id)
+            if self._file is None:
+                self._file = open(self.path, 'a', encoding='utf-8')
+            self._file.write(participant_id + '\n')
+            self._file.flush()
+        return True
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# The participant_ids of the data files save_data.php has written in directory
+def participant_ids_in(directory):
+    ids = []
+    for entry in os.scandir(directory):
+        name = entry.name
+        if name.startswith('s_') and name.endswith('.csv'):
+            ids.append(name[len('s_'):-len('.csv')])
+    return ids
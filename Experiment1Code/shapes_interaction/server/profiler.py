@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Profiling the running server
+##############
+
+# A SamplingProfiler can be started and stopped while the server is running, by
+# sending it a signal (SIGUSR1 by default):
+#     kill -USR1 <pid of the server>       starts it
+#     kill -USR1 <pid of the server>       stops it and writes what it found
+# so that a server that has slowed down mid-session can be looked at without
+# restarting it, which would end every pair's session.
+
+# While it runs, a thread of its own looks at what every thread is doing every
+# interval seconds (sys._current_frames), and counts each distinct stack. Nothing
+# is added to the code being profiled, so it slows the server down much less than
+# cProfile would, and it sees every thread, not just the one that started it.
+# Stopping it writes:
+# - <prefix>_<pid>_<time>.collapsed: one line per stack, outermost frame first,
+#   frames separated by ;, then the number of times it was seen, for
+#   flamegraph.pl (https://github.com/brendangregg/FlameGraph) or speedscope.app
+# - <prefix>_<pid>_<time>.txt: a summary - the functions threads were most often
+#   running (a thread found in a call that blocks, or that has used no CPU time
+#   since the sample before, is counted as waiting), how busy the process was, how late the
+#   profiler's own thread woke up (which, as it has to wait for the GIL like any
+#   other thread, shows how long a thread that is ready to run waits for its
+#   turn), and whatever the server adds (the interaction engine adds how long its
+#   handlers and sends take).
+
+# With the ShardedWebsocketServer, each worker is a process of its own (its pid is
+# logged when it starts), so signal the worker to profile it.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import os
+import re
+import signal
+import sys
+import threading
+import time
+
+# Seconds between samples
+DEFAULT_INTERVAL = 0.01
+
+# Not available on Windows, where the profiler cannot be signalled
+DEFAULT_SIGNAL = getattr(signal, 'SIGUSR1', None)
+
+# Functions listed in the summary
+TOP_FUNCTIONS = 25
+
+# (function, file) of the standard library's calls that block - a thread found in one of
+# these is waiting, even if it has used CPU since the sample before
+BLOCKING_CALLS = frozenset([('wait', 'threading.py'), ('_wait_for_tstate_lock', 'threading.py'),
+                            ('readinto', 'socket.py'), ('accept', 'socket.py'), ('select', 'selectors.py'),
+                            ('get', 'queue.py'), ('_worker', 'thread.py'), ('dequeue', 'handlers.py')])
+
+
+class SamplingProfiler(object):
+    """
+    Samples every thread's stack every interval seconds while running, and
+    writes the results to files named from prefix when stopped. install()
+    has the process's signum toggle it.
+    """
+
+    def __init__(self, prefix, interval=DEFAULT_INTERVAL, signum=DEFAULT_SIGNAL):
+        self.prefix = prefix
+        self.interval = interval
+        self.signum = signum
+        self.log = None
+        self.summary = None
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = None
+        self._pid = os.getpid()
+
+    def install(self, log=None, summary=None):
+        """
+        Toggles the profiler whenever the process is sent signum; call from
+        the main thread. log (an ExperimentLog) is told when it starts and
+        stops, and summary() returns lines to add to the summary it writes.
+        """
+        self.log = log
+        self.summary = summary
+        if self.signum is None:
+            return False
+        signal.signal(self.signum, self._signalled)
+        return True
+
+    def _signalled(self, signum, frame):
+        self.toggle()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._pid == os.getpid()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        with self._lock:
+            if self.running:
+                return
+            # in a process forked while we were running, the sampling thread is the parent's
+            self._pid = os.getpid()
+            self._stopping = threading.Event()
+            self._thread = threading.Thread(target=self._run, args=(self._stopping,), name='profiler')
+            self._thread.daemon = True
+            self._thread.start()
+        if self.log is not None:
+            self.log.info('profiler_started', pid=self._pid, interval=self.interval)
+
+    def stop(self):
+        """Stops sampling; the sampling thread then writes out what it found."""
+        with self._lock:
+            if not self.running:
+                return
+            self._stopping.set()
+            self._thread = None
+
+    def _run(self, stopping):
+        samples = Samples()
+        me = threading.get_ident()
+        started = time.time()
+        cpu_started = time.process_time()
+        next_sample = time.perf_counter()
+        while not stopping.is_set():
+            next_sample += self.interval
+            delay = next_sample - time.perf_counter()
+            if delay > 0:
+                stopping.wait(delay)
+            now = time.perf_counter()
+            samples.lateness.append(max(0.0, now - next_sample))
+            # if sampling fell behind, carry on from now rather than catching up
+            next_sample = max(next_sample, now)
+            samples.take(me)
+        ended = time.time()
+        try:
+            paths = self.write(samples, started, ended, time.process_time() - cpu_started)
+        except Exception as e:
+            if self.log is not None:
+                self.log.error('profiler_failed', pid=os.getpid(), error=repr(e))
+            return
+        if self.log is not None:
+            self.log.info('profiler_stopped', pid=os.getpid(), seconds=round(ended - started, 3),
+                          samples=samples.n, files=paths)
+
+    def write(self, samples, started, ended, cpu_seconds):
+        base = '%s_%d_%s' % (self.prefix, os.getpid(), time.strftime('%Y%m%d-%H%M%S', time.localtime(started)))
+        with open(base + '.collapsed', 'w', encoding='utf-8') as f:
+            for stack, count in sorted(samples.collapsed().items()):
+                f.write('%s %d\n' % (stack, count))
+        lines = samples.summary(ended - started, cpu_seconds, self.interval)
+        if self.summary is not None:
+            lines.append('')
+            lines.extend(self.summary())
+        with open(base + '.txt', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        return [base + '.collapsed', base + '.txt']
+
+
+class Samples(object):
+    """
+    Counts of each (thread name, stack of code objects) seen, of the innermost
+    code of threads that were running rather than waiting, and how late each
+    sample was.
+    """
+
+    def __init__(self):
+        self.stacks = {}
+        self.running = {}
+        self.waiting = 0
+        self.lateness = []
+        self.n = 0
+        self._thread_names = {}
+        self._blocking = {}
+        self._cpu_clocks = {}
+        self._cpu_times = {}
+
+    def take(self, own_ident):
+        names = {}
+        for thread in threading.enumerate():
+            names[thread.ident] = thread.name
+        cpu_times = {}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            # a thread in a call that blocks (reading a socket, waiting on a lock or queue...) is
+            # waiting, as is one that has used no CPU since the sample before
+            cpu_time = cpu_times[ident] = self.cpu_time(ident)
+            if self.blocks(frame.f_code) or (cpu_time is not None and cpu_time == self._cpu_times.get(ident)):
+                self.waiting += 1
+            else:
+                self.running[frame.f_code] = self.running.get(frame.f_code, 0) + 1
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            key = (self.thread_name(names.get(ident, 'unknown')), tuple(codes))
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+        self._cpu_times = cpu_times
+        self.n += 1
+
+    # CPU time the thread has used, where the platform can say (Linux, macOS...), else None
+    def cpu_time(self, ident):
+        clock = self._cpu_clocks.get(ident)
+        try:
+            if clock is None:
+                clock = self._cpu_clocks[ident] = time.pthread_getcpuclockid(ident)
+            return time.clock_gettime(clock)
+        except (AttributeError, OSError):
+            return None
+
+    def blocks(self, code):
+        blocks = self._blocking.get(code)
+        if blocks is None:
+            blocks = self._blocking[code] = (code.co_name, os.path.basename(code.co_filename)) in BLOCKING_CALLS
+        return blocks
+
+    # Threads made for each client are told apart only by a number, so drop it, and
+    # count them all as one
+    def thread_name(self, name):
+        short = self._thread_names.get(name)
+        if short is None:
+            short = self._thread_names[name] = re.sub(r'-?\d+', '', name).strip() or 'thread'
+        return short
+
+    def collapsed(self):
+        stacks = {}
+        for (thread, codes), count in self.stacks.items():
+            stack = ';'.join([thread] + [code_name(code) for code in reversed(codes)])
+            stacks[stack] = stacks.get(stack, 0) + count
+        return stacks
+
+    def summary(self, seconds, cpu_seconds, interval):
+        lines = ['Profiled pid %d for %.1fs: %d samples, one every %gs' % (os.getpid(), seconds, self.n, interval),
+                 'Process CPU time: %.1fs, %.0f%% of one core (near 100%% means threads are taking turns with the GIL)'
+                 % (cpu_seconds, 100 * cpu_seconds / seconds if seconds else 0)]
+        if self.lateness:
+            late = sorted(self.lateness)
+            lines.append('Profiler thread woke late (waiting for the GIL or a core): mean %.2fms, median %.2fms, '
+                         '99th percentile %.2fms, max %.2fms'
+                         % (1000 * sum(late) / len(late), 1000 * late[len(late) // 2],
+                            1000 * late[min(len(late) - 1, int(len(late) * 0.99))], 1000 * late[-1]))
+        running = sum(self.running.values())
+        lines.append('')
+        lines.append('Innermost function of each thread that was running, in %d of %d thread samples (the rest were '
+                     'in a call that blocks, or had used no CPU since the sample before):'
+                     % (running, running + self.waiting))
+        for code, count in sorted(self.running.items(), key=lambda item: -item[1])[:TOP_FUNCTIONS]:
+            lines.append('%8d %5.1f%%  %s' % (count, 100.0 * count / running, code_name(code)))
+        return lines
+
+
+def code_name(code):
+    return '%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno)
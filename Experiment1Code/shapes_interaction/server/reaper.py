@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Expiring clients who have gone quiet
+##############
+
+# Clients ping the server every few seconds, so one we have not heard from for
+# a long time has gone, even if its connection is still open. A DeadlineReaper
+# keeps a deadline for every client, pushed back each time it hears from them,
+# and a background thread expires clients whose deadline has passed. The
+# websocket server's own heartbeat catches dead connections; this catches
+# clients that are connected but no longer taking part.
+
+# Deadlines are kept in a min-heap with one entry per client. Hearing from a
+# client only updates its deadline in a dictionary; when its heap entry comes
+# to the top, an entry whose deadline has since moved is pushed back with the
+# new one. So each message costs O(1), and each tick pops at most max_per_tick
+# entries at O(log n) each, however many clients are connected.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import heapq
+import itertools
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between checks for expired clients
+DEFAULT_TICK = 1.0
+
+# Heap entries looked at per tick; any more that are due wait for the next tick
+DEFAULT_MAX_PER_TICK = 1000
+
+
+class DeadlineReaper(object):
+    """
+    Calls expire(client_id, last_heard_from) for each client not touched for
+    timeout seconds, from a background thread, and forgets them.
+
+    The thread starts with the first touch() in each process, so a server
+    forked after the reaper was made (a ShardedWebsocketServer worker) reaps
+    its own clients.
+    """
+
+    def __init__(self, timeout, expire, tick=DEFAULT_TICK, max_per_tick=DEFAULT_MAX_PER_TICK, clock=time.time):
+        self.timeout = timeout
+        self.expire = expire
+        self.tick_length = tick
+        self.max_per_tick = max_per_tick
+        self.clock = clock
+        # client_id: [last heard from, token of its heap entry]
+        self._clients = {}
+        self._heap = []
+        self._tokens = itertools.count()
+        self._lock = threading.Lock()
+        self._pid = None
+        self.reaped = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __len__(self):
+        return len(self._clients)
+
+    def touch(self, client_id):
+        """Records that we have just heard from client_id, adding them if new."""
+        now = self.clock()
+        with self._lock:
+            entry = self._clients.get(client_id)
+            if entry is not None:
+                entry[0] = now
+                return
+            token = next(self._tokens)
+            self._clients[client_id] = [now, token]
+            heapq.heappush(self._heap, (now + self.timeout, token, client_id))
+        if self._pid != os.getpid():
+            self.start_thread()
+
+    def remove(self, client_id):
+        """Forgets client_id, e.g. because they have disconnected."""
+        with self._lock:
+            # its heap entry is dropped when it comes to the top
+            self._clients.pop(client_id, None)
+
+    def tick(self):
+        """Expires the clients whose deadline has passed, up to max_per_tick of them."""
+        now = self.clock()
+        expired = []
+        with self._lock:
+            for _i in range(self.max_per_tick):
+                if not self._heap or self._heap[0][0] > now:
+                    break
+                deadline, token, client_id = heapq.heappop(self._heap)
+                entry = self._clients.get(client_id)
+                if entry is None or entry[1] != token:
+                    continue  # removed since
+                last_heard_from = entry[0]
+                if last_heard_from + self.timeout > now:
+                    heapq.heappush(self._heap, (last_heard_from + self.timeout, token, client_id))
+                    continue
+                del self._clients[client_id]
+                latency = now - (last_heard_from + self.timeout)
+                self.reaped += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                expired.append((client_id, last_heard_from))
+        for client_id, last_heard_from in expired:
+            try:
+                self.expire(client_id, last_heard_from)
+            except Exception:
+                logger.exception("Could not expire client %r" % (client_id,))
+        return len(expired)
+
+    def stats(self):
+        """Clients tracked and reaped, and how long after their deadline they were noticed."""
+        with self._lock:
+            return {'clients': len(self._clients), 'reaped': self.reaped,
+                    'max_latency': self.max_latency,
+                    'mean_latency': self.total_latency / self.reaped if self.reaped else 0.0}
+
+    def run(self):
+        """Ticks forever; start_thread runs this in a daemon thread."""
+        while True:
+            time.sleep(self.tick_length)
+            self.tick()
+
+    def start_thread(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
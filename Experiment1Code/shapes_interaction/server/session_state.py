@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Session state shared by the interaction servers
+##############
+
+# One Participant per connected client and one Pair per dyad. Both use __slots__,
+# so each is a fixed set of attributes rather than a dictionary of string keys.
+# Anything the two partners share (shapes, trial list, trial counter) is stored
+# once, on their Pair.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+from enum import Enum
+
+
+# The phases a client progresses through, in the order given by phase_sequence
+# in the server script
+class Phase(Enum):
+    START = 'Start'
+    PAIR_PARTICIPANTS = 'PairParticipants'
+    INTERACTION = 'Interaction'
+    END = 'End'
+
+
+# A client's role during the interaction, including the states in between trials
+class Role(Enum):
+    READING_INSTRUCTIONS = 'ReadingInstructions'
+    READY_TO_INTERACT = 'ReadyToInteract'
+    DIRECTOR = 'Director'
+    MATCHER = 'Matcher'
+    WAITING_TO_SWITCH = 'WaitingToSwitch'
+
+
+class Participant(object):
+    # client_id: the integer id the websocket server gave this client
+    # client_info: the websocket server's client dictionary, needed to send messages
+    # participant_id: the unique identifier the client sends in CLIENT_INFO
+    # partner: client_id of their partner, once paired
+    # pair: the Pair they belong to, once paired
+    # mapping: their mapping of abstract to actual shapes, if the experiment uses one
+    # templates: MessageTemplates for the trial commands they are sent, by command_type, once paired
+    # actor: the Actor (see actors.py) their messages are handled on - matchmaking's until
+    #   they are paired, then their Pair's
+    __slots__ = ('client_id', 'client_info', 'participant_id', 'last_heard_from',
+                 'phase', 'role', 'partner', 'pair', 'mapping', 'templates', 'actor')
+
+    def __init__(self, client_id, client_info, last_heard_from):
+        self.client_id = client_id
+        self.client_info = client_info
+        self.participant_id = None
+        self.last_heard_from = last_heard_from
+        self.phase = None
+        self.role = None
+        self.partner = None
+        self.pair = None
+        self.mapping = None
+        self.templates = None
+        self.actor = None
+
+    def __repr__(self):
+        return 'Participant(%s)' % ', '.join('%s=%r' % (name, getattr(self, name))
+                                             for name in self.__slots__ if name not in ('client_info', 'templates', 'actor'))
+
+
+class Pair(object):
+    # pair_id: the two participant_ids joined with an underscore
+    # shapes: the shapes assigned to this pair
+    # shape_colour_correspondences: dictionary of shape:colours for this pair
+    # trial_list: the interleaved list of trials both partners work through
+    # trial_counter: index into trial_list of the current trial
+    # actor: the Actor that handles both partners' messages, one at a time
+    # cell: the design cell (e.g. condition) they were assigned to
+    # label, object_choices: the director's label on the current trial, and the choices the
+    #   matcher was given, once the director has responded
+    __slots__ = ('pair_id', 'shapes', 'shape_colour_correspondences', 'trial_list', 'trial_counter', 'actor',
+                 'cell', 'label', 'object_choices')
+
+    def __init__(self, pair_id, shapes, shape_colour_correspondences, trial_list, actor=None, cell=None):
+        self.pair_id = pair_id
+        self.shapes = shapes
+        self.shape_colour_correspondences = shape_colour_correspondences
+        self.trial_list = trial_list
+        self.trial_counter = 0
+        self.actor = actor
+        self.cell = cell
+        self.label = None
+        self.object_choices = None
+
+    def __repr__(self):
+        return 'Pair(%s, trial %d of %d)' % (self.pair_id, self.trial_counter + 1, len(self.trial_list))
+
+    # True once every trial in the list has been run
+    def finished(self):
+        return self.trial_counter >= len(self.trial_list)
+
+    def current_trial(self):
+        return self.trial_list[self.trial_counter]
+
+    # Called once per trial, when both partners are done with its feedback
+    def next_trial(self):
+        self.trial_counter += 1
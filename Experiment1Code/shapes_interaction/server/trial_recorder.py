@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Recording trial outcomes on the server
+##############
+
+# The clients upload their data at the end of the session, so a pair that drops
+# out part way through leaves no record of the trials they did complete. A
+# TrialRecorder writes one CSV row per completed trial, as it happens, with the
+# columns used in Analysis/data (pair_id, block_n, trial_n, object, label,
+# object_choices, object_selected, score...). In Experiment 2 the object and label
+# columns are in the abstract shapes both partners share (shapeN, and the label
+# as an integer), as in the clients' own object and label columns; the
+# director_local_ and matcher_local_ columns give them in the actual shapes each
+# partner saw, like the clients' local_ columns. pair_id is the two participant_ids
+# joined with _, before any anonymisation.
+
+# Handlers only add the row to a list; a background thread writes whatever has
+# built up every flush_interval seconds (or as soon as batch_size rows are
+# waiting), so recording a trial never waits for the disk. Rows still waiting
+# when the server stops are written at exit (which is why the server scripts
+# have SIGTERM stop the server as Ctrl-C does). How often the file is fsync'ed -
+# after every batch, at most every so many seconds, or never (leaving it to the
+# operating system) - is set by fsync. Once the file reaches max_bytes
+# it is renamed with the time it was closed and a new one started; nothing is
+# ever deleted.
+
+# NB like the websocket_server folder, this file needs to be in the same
+# directory as the server script.
+
+import atexit
+import csv
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Seconds between writes of the rows recorded since the last one
+DEFAULT_FLUSH_INTERVAL = 1.0
+
+# Rows waiting at which they are written straight away
+DEFAULT_BATCH_SIZE = 500
+
+# Seconds between fsyncs: 0 after every write, None never
+DEFAULT_FSYNC = 5.0
+
+# Size at which the file is rotated
+DEFAULT_MAX_BYTES = 50 * 2**20
+
+
+class TrialRecorder(object):
+    """
+    Appends rows (dicts) to the CSV file at path, from a background thread.
+
+    The columns are the keys of the first row recorded; a header is written
+    at the start of each new file. A process forked after the recorder was
+    made (a ShardedWebsocketServer worker) writes its own file, with its pid
+    added to the name.
+    """
+
+    def __init__(self, path, flush_interval=DEFAULT_FLUSH_INTERVAL, batch_size=DEFAULT_BATCH_SIZE,
+                 fsync=DEFAULT_FSYNC, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.columns = None
+        self.recorded = 0
+        self.written = 0
+        self.rotations = 0
+        self._rows = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._file = None
+        self._writer = None
+        self._last_fsync = 0.0
+        self._pid = os.getpid()
+        self._started = False
+
+    def record(self, row):
+        """Queues row to be written."""
+        with self._lock:
+            if self._pid != os.getpid():
+                self._forked()
+            self._rows.append(row)
+            self.recorded += 1
+            if not self._started:
+                self._start()
+            if len(self._rows) >= self.batch_size:
+                self._wakeup.set()
+
+    def _forked(self):
+        # with the lock held, in a forked process: forget the parent's rows and
+        # file, and write our own
+        root, ext = os.path.splitext(self.path)
+        self.path = '%s-%d%s' % (root, os.getpid(), ext)
+        self._pid = os.getpid()
+        self._rows = []
+        self._file = None
+        self._writer = None
+        self._write_lock = threading.Lock()
+        self._started = False
+
+    def _start(self):
+        self._started = True
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.flush)
+
+    def run(self):
+        """Writes batches forever; started by the first record() in each process."""
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Could not write trials to %s" % self.path)
+
+    def flush(self):
+        """Writes every row recorded so far."""
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return
+        with self._write_lock:
+            if self._file is None:
+                self._open(rows[0])
+            self._writer.writerows(rows)
+            self._file.flush()
+            self.written += len(rows)
+            if self.fsync is not None and time.time() - self._last_fsync >= self.fsync:
+                os.fsync(self._file.fileno())
+                self._last_fsync = time.time()
+            if self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def _open(self, first_row):
+        if self.columns is None:
+            self.columns = list(first_row)
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        self._file = open(self.path, 'a', newline='', encoding='utf-8')
+        self._writer = csv.DictWriter(self._file, self.columns, extrasaction='ignore')
+        if new:
+            self._writer.writeheader()
+
+    def _rotate(self):
+        if self.fsync is not None:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        self._file = None
+        root, ext = os.path.splitext(self.path)
+        rotated = '%s-%s' % (root, time.strftime('%Y%m%d-%H%M%S'))
+        n = 1
+        while os.path.exists(rotated + ext):
+            rotated = '%s-%s.%d' % (root, time.strftime('%Y%m%d-%H%M%S'), n)
+            n += 1
+        os.rename(self.path, rotated + ext)
+        self.rotations += 1
+
+    def stats(self):
+        with self._lock:
+            return {'path': self.path, 'recorded': self.recorded, 'waiting': len(self._rows),
+                    'written': self.written, 'rotations': self.rotations}
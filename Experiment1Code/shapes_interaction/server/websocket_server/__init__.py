@@ -1 +1,10 @@
+import os
+import sys
+
 from .websocket_server import *
+
+if sys.version_info >= (3, 7):
+    from .async_server import AsyncWebsocketServer
+
+if sys.version_info >= (3, 7) and hasattr(os, 'fork'):
+    from .sharding import ShardedWebsocketServer
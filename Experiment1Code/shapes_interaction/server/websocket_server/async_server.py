@@ -0,0 +1,197 @@
+# License: MIT
+
+import asyncio
+import logging
+import struct
+
+from .heartbeat import set_tcp_keepalive
+from .websocket_server import (FrameHandlerMixin, WebsocketServerBase,
+                               PAYLOAD_LEN, SLOW_CONSUMER_CHECK_INTERVAL, logger, unmask)
+
+
+class AsyncWebsocketServer(WebsocketServerBase):
+    """
+    A websocket server running every connection as an asyncio task on a
+    single event loop, instead of one OS thread per client.
+
+    Exposes exactly the same API as WebsocketServer (set_fn_new_client,
+    set_fn_client_left, set_fn_message_received, send_message, run_forever),
+    so an experiment server can switch backends by changing its constructor.
+    Callbacks run on the event loop thread, one at a time.
+
+    Args:
+        port(int): Port to bind to
+        host(str): Hostname or IP to listen for connections. By default 127.0.0.1
+            is being used. To accept connections from any client, you should use
+            0.0.0.0.
+        loglevel: Logging level from logging module to use for logging. By default
+            warnings and errors are being logged.
+        **options: Transport options, see WebsocketServerBase. The outbound
+            queue is the transport's own write buffer.
+    """
+
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING, **options):
+        logger.setLevel(loglevel)
+        WebsocketServerBase.__init__(self, **options)
+        self.host = host
+        self.port = port
+        self.loop = asyncio.new_event_loop()
+        self._server = self.loop.run_until_complete(
+            asyncio.start_server(self._handle_connection, host, port))
+        self.port = self._server.sockets[0].getsockname()[1]
+        if self.heartbeat is not None:
+            self.loop.call_later(self.heartbeat.tick_length, self._heartbeat_tick)
+        self.loop.call_later(SLOW_CONSUMER_CHECK_INTERVAL, self._slow_consumer_tick)
+
+    def _heartbeat_tick(self):
+        # pings are written from the loop thread, like every other frame
+        self.heartbeat.tick()
+        self.loop.call_later(self.heartbeat.tick_length, self._heartbeat_tick)
+
+    def _slow_consumer_tick(self):
+        # a client that has stopped reading is noticed even when nothing more is sent to it
+        self._check_slow_consumers_()
+        self.loop.call_later(SLOW_CONSUMER_CHECK_INTERVAL, self._slow_consumer_tick)
+
+    async def _handle_connection(self, reader, writer):
+        handler = AsyncWebSocketHandler(self, reader, writer)
+        await handler.handle()
+
+    def disconnect(self, client):
+        # may be called from another thread, e.g. the experiment's reaper
+        self.loop.call_soon_threadsafe(client['handler'].disconnect)
+
+    def serve_forever(self):
+        self.loop.run_until_complete(self._server.serve_forever())
+
+    def server_close(self):
+        self._server.close()
+        self.loop.run_until_complete(self._server.wait_closed())
+        self.loop.close()
+
+
+class AsyncWebSocketHandler(FrameHandlerMixin):
+    """
+    asyncio counterpart of WebSocketHandler: the same handshake and framing,
+    reading with StreamReader.readexactly and writing into the transport's
+    buffer, so send_message never blocks the event loop.
+    """
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.client_address = writer.get_extra_info('peername')
+        self.keep_alive = True
+        self.handshake_done = False
+        self.valid_client = False
+        self.init_frame_state()
+        # bytes the transport had written when the server last checked, and since when it has
+        # written none while it had some to write (see check_slow_consumer)
+        self._written = 0
+        self._stalled_since = None
+        writer.transport.set_write_buffer_limits(server.high_watermark, server.low_watermark)
+        if server.tcp_keepalive:
+            set_tcp_keepalive(writer.get_extra_info('socket'), *server.tcp_keepalive)
+
+    async def handle(self):
+        try:
+            while self.keep_alive:
+                if not self.handshake_done:
+                    await self.handshake()
+                elif self.valid_client:
+                    await self.read_next_message()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            logger.info("Client closed connection.")
+        finally:
+            self.finish()
+
+    async def read_next_message(self):
+        b1, b2 = await self.reader.readexactly(2)
+
+        if not self.frame_header_ok(b1, b2):
+            return
+        payload_length = b2 & PAYLOAD_LEN
+
+        if payload_length == 126:
+            payload_length = struct.unpack(">H", await self.reader.readexactly(2))[0]
+        elif payload_length == 127:
+            payload_length = struct.unpack(">Q", await self.reader.readexactly(8))[0]
+        if not self.payload_length_ok(b1, payload_length):
+            return
+
+        masks = await self.reader.readexactly(4)
+        self.frame_received(b1, unmask(masks, await self.reader.readexactly(payload_length)))
+
+    def _write_frame(self, *parts):
+        # the transport buffers whatever the socket does not take at once,
+        # and asyncio streams already set TCP_NODELAY
+        if not self.writer.is_closing():
+            self.writer.writelines(parts)
+            self.check_backpressure(self.queued_bytes())
+
+    def queued_bytes(self):
+        return self.writer.transport.get_write_buffer_size()
+
+    def check_slow_consumer(self, now):
+        # a client that has stopped reading leaves the transport writing nothing, with
+        # perhaps too little buffered to count as congested
+        queued = self.queued_bytes()
+        written = self.bytes_out - queued
+        if queued and written == self._written:
+            if self._stalled_since is None:
+                self._stalled_since = now
+            elif now - self._stalled_since > self.server.slow_consumer_timeout:
+                self._stalled_since = None
+                self._evict_slow_consumer()
+                return
+        else:
+            self._stalled_since = None
+        self._written = written
+        self.check_backpressure(queued)
+
+    def disconnect(self):
+        """Drops the connection; the reading task then calls finish as usual."""
+        self.writer.transport.abort()
+
+    async def read_http_headers(self):
+        headers = {}
+        # first line should be HTTP GET
+        http_get = (await self.reader.readline()).decode().strip()
+        assert http_get.upper().startswith('GET')
+        # remaining should be headers
+        while True:
+            header = (await self.reader.readline()).decode().strip()
+            if not header:
+                break
+            head, value = header.split(':', 1)
+            headers[head.lower().strip()] = value.strip()
+        return headers
+
+    async def handshake(self):
+        try:
+            headers = await self.read_http_headers()
+            assert headers['upgrade'].lower() == 'websocket'
+        except (AssertionError, KeyError, ValueError):
+            self.server._handshake_failed_(self.client_address, "not a websocket upgrade request")
+            self.keep_alive = False
+            return
+
+        try:
+            key = headers['sec-websocket-key']
+        except KeyError:
+            logger.warning("Client tried to connect but was missing a key")
+            self.server._handshake_failed_(self.client_address, "no Sec-WebSocket-Key")
+            self.keep_alive = False
+            return
+
+        extensions = self.negotiate_extensions(headers)
+        response = self.make_handshake_response(key, extensions)
+        self.writer.write(response.encode())
+        self.handshake_done = True
+        self.valid_client = True
+        self.server._new_client_(self)
+
+    def finish(self):
+        self.server._client_left_(self)
+        self.writer.close()
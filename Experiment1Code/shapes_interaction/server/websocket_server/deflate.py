@@ -0,0 +1,165 @@
+# License: MIT
+
+import zlib
+
+'''
+permessage-deflate (RFC 7692).
+
+A client offers the extension in its Sec-WebSocket-Extensions header, e.g.
+
+    Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits
+
+If the server is configured with a DeflateConfig, it accepts the first offer
+it can satisfy and echoes the agreed parameters back in the handshake. From
+then on, any data message may be sent with RSV1 set, meaning its payload is
+a raw DEFLATE stream with the trailing 0x00 0x00 0xff 0xff removed.
+'''
+
+EXTENSION_NAME = 'permessage-deflate'
+DEFLATE_TRAILER = b'\x00\x00\xff\xff'
+
+# zlib cannot produce raw deflate streams with an 8-bit window
+MIN_WINDOW_BITS = 9
+MAX_WINDOW_BITS = 15
+
+
+class DeflateConfig(object):
+    """
+    Server-side permessage-deflate settings.
+
+    Args:
+        server_no_context_takeover(bool): Reset the compressor after every
+            message. Costs compression ratio, saves keeping a window per client.
+        client_no_context_takeover(bool): Ask clients to do the same.
+        server_max_window_bits(int): LZ77 window (9-15) used for compressing.
+        client_max_window_bits(int): Window clients are asked to stay within,
+            if they say they support the parameter.
+        threshold(int): Payloads shorter than this many bytes are sent
+            uncompressed; deflating a tiny message usually makes it bigger.
+        level(int): zlib compression level.
+    """
+
+    def __init__(self, server_no_context_takeover=False,
+                 client_no_context_takeover=False,
+                 server_max_window_bits=MAX_WINDOW_BITS,
+                 client_max_window_bits=MAX_WINDOW_BITS,
+                 threshold=128, level=6):
+        for bits in (server_max_window_bits, client_max_window_bits):
+            if not MIN_WINDOW_BITS <= bits <= MAX_WINDOW_BITS:
+                raise ValueError("Window bits must be between %d and %d" % (MIN_WINDOW_BITS, MAX_WINDOW_BITS))
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self.threshold = threshold
+        self.level = level
+
+    def negotiate(self, header):
+        """
+        Takes the client's Sec-WebSocket-Extensions header and returns a
+        PerMessageDeflate for the first acceptable permessage-deflate offer,
+        or None if there is none.
+        """
+        if not header:
+            return None
+        for offer in header.split(','):
+            params = [p.strip() for p in offer.split(';')]
+            if params[0].lower() != EXTENSION_NAME:
+                continue
+            agreed = self._accept(params[1:])
+            if agreed is not None:
+                return PerMessageDeflate(self, *agreed)
+        return None
+
+    def _accept(self, params):
+        server_no_context_takeover = self.server_no_context_takeover
+        client_no_context_takeover = self.client_no_context_takeover
+        server_max_window_bits = self.server_max_window_bits
+        client_max_window_bits = None
+        seen = set()
+        for param in params:
+            name, _, value = param.partition('=')
+            name = name.strip().lower()
+            value = value.strip().strip('"')
+            if name in seen:
+                return None
+            seen.add(name)
+            if name == 'server_no_context_takeover' and not value:
+                server_no_context_takeover = True
+            elif name == 'client_no_context_takeover' and not value:
+                client_no_context_takeover = True
+            elif name == 'server_max_window_bits':
+                if not value.isdigit() or not MIN_WINDOW_BITS <= int(value) <= MAX_WINDOW_BITS:
+                    return None
+                server_max_window_bits = min(server_max_window_bits, int(value))
+            elif name == 'client_max_window_bits':
+                if value and not value.isdigit():
+                    return None
+                limit = int(value) if value else MAX_WINDOW_BITS
+                client_max_window_bits = min(self.client_max_window_bits, limit)
+            else:
+                return None
+        return (server_no_context_takeover, client_no_context_takeover,
+                server_max_window_bits, client_max_window_bits)
+
+
+class PerMessageDeflate(object):
+    """
+    The permessage-deflate state agreed with one client: a compressor for
+    outgoing messages and a decompressor for incoming ones.
+
+    Not thread safe - callers serialise compress() with writing the frame,
+    so messages reach the wire in the order the shared window saw them.
+    """
+
+    def __init__(self, config, server_no_context_takeover,
+                 client_no_context_takeover, server_max_window_bits,
+                 client_max_window_bits):
+        self.threshold = config.threshold
+        self.level = config.level
+        self.server_no_context_takeover = server_no_context_takeover
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_max_window_bits = server_max_window_bits
+        self.client_max_window_bits = client_max_window_bits
+        self._compressor = self._new_compressor()
+        self._decompressor = self._new_decompressor()
+
+    def _new_compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.server_max_window_bits)
+
+    def _new_decompressor(self):
+        # a 15-bit window can inflate anything the client is allowed to send
+        return zlib.decompressobj(-MAX_WINDOW_BITS)
+
+    def response_header(self):
+        params = [EXTENSION_NAME]
+        if self.server_no_context_takeover:
+            params.append('server_no_context_takeover')
+        if self.client_no_context_takeover:
+            params.append('client_no_context_takeover')
+        if self.server_max_window_bits < MAX_WINDOW_BITS:
+            params.append('server_max_window_bits=%d' % self.server_max_window_bits)
+        if self.client_max_window_bits is not None and self.client_max_window_bits < MAX_WINDOW_BITS:
+            params.append('client_max_window_bits=%d' % self.client_max_window_bits)
+        return '; '.join(params)
+
+    def should_compress(self, payload):
+        return len(payload) >= self.threshold
+
+    def compress(self, payload):
+        data = self._compressor.compress(payload) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(DEFLATE_TRAILER):
+            data = data[:-4]
+        if self.server_no_context_takeover:
+            self._compressor = self._new_compressor()
+        return data
+
+    def decompress(self, payload, max_length=0):
+        """
+        Inflates one message. If max_length is given, at most that many bytes
+        are produced, so a small compressed message cannot expand without limit.
+        """
+        data = self._decompressor.decompress(bytes(payload) + DEFLATE_TRAILER, max_length)
+        if self.client_no_context_takeover:
+            self._decompressor = self._new_decompressor()
+        return data
@@ -0,0 +1,98 @@
+# License: MIT
+
+import math
+import socket
+import struct
+import threading
+import time
+
+PING_PAYLOAD = struct.Struct(">d")
+
+
+class Heartbeat(object):
+    """
+    Protocol-level heartbeat for every client of one server.
+
+    Clients sit on a timer wheel of interval/tick slots. Each tick visits one
+    slot, so every client is visited once per interval and the work per tick
+    is a fixed share of the clients rather than all of them at once. A visited
+    client that has sent nothing at all (data, ping or pong) for longer than
+    timeout is disconnected; otherwise it is sent an OPCODE_PING frame carrying
+    the send time, which the client's pong echoes back to give the round trip
+    time. Browsers answer pings by themselves, so no application code is
+    involved.
+
+    The server drives tick() - from a thread for the threaded backend, from
+    the event loop for the asyncio one.
+    """
+
+    def __init__(self, server, interval, timeout, tick=1.0):
+        self.server = server
+        self.interval = interval
+        self.timeout = timeout
+        self.tick_length = min(tick, interval)
+        self.n_slots = max(1, int(math.ceil(interval / self.tick_length)))
+        self._slots = [set() for _ in range(self.n_slots)]
+        self._slot_of = {}
+        self._current = 0
+        self._lock = threading.Lock()
+        self.timeouts = 0
+
+    def add(self, handler):
+        with self._lock:
+            # the slot just behind the hand comes round last, one interval away
+            slot = (self._current - 1) % self.n_slots
+            self._slots[slot].add(handler)
+            self._slot_of[handler] = slot
+
+    def remove(self, handler):
+        with self._lock:
+            slot = self._slot_of.pop(handler, None)
+            if slot is not None:
+                self._slots[slot].discard(handler)
+
+    def tick(self):
+        with self._lock:
+            due = list(self._slots[self._current])
+            self._current = (self._current + 1) % self.n_slots
+        now = time.time()
+        for handler in due:
+            if now - handler.last_seen > self.timeout:
+                self.remove(handler)
+                self.timeouts += 1
+                self.server._heartbeat_timeout_(handler)
+                handler.disconnect()
+            else:
+                handler.send_ping(PING_PAYLOAD.pack(now))
+
+    def run(self):
+        """Ticks forever; the threaded server runs this in a daemon thread."""
+        while True:
+            time.sleep(self.tick_length)
+            self.tick()
+
+    def start_thread(self):
+        thread = threading.Thread(target=self.run)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+def round_trip_time(pong_payload):
+    """Seconds since the ping a pong answers was sent, or None if it is not ours."""
+    if len(pong_payload) != PING_PAYLOAD.size:
+        return None
+    return time.time() - PING_PAYLOAD.unpack(bytes(pong_payload))[0]
+
+
+def set_tcp_keepalive(sock, idle, interval, count):
+    """
+    Has the kernel probe a connection after idle seconds of silence, every
+    interval seconds, giving up after count unanswered probes - so half-open
+    sockets are noticed even when the heartbeat cannot get a frame out.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    # the timings are platform specific; Linux has all three
+    for option, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', interval), ('TCP_KEEPCNT', count)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
@@ -0,0 +1,244 @@
+# License: MIT
+
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+'''
+Counters and histograms for a Prometheus-style /metrics endpoint.
+
+Updating a metric takes no lock: each thread counts into a cell of its own,
+which only it ever writes, and the cells are added up when the metrics are
+read. A thread's cell is folded into the metric's running total once the
+thread has finished, so connections coming and going (a thread each, on the
+threaded server) do not leave cells behind.
+'''
+
+# Upper bounds, in seconds, of the buckets of a latency histogram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class PerThreadCells(object):
+    """
+    One dict per thread, of label values: count (or list of counts), that
+    only its own thread writes to; totals() adds them all up.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._cells = []
+        self._finished = {}
+
+    def cell(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = {}
+            with self._lock:
+                self._cells.append((threading.current_thread(), cell))
+            return cell
+
+    def totals(self):
+        with self._lock:
+            running = []
+            for thread, cell in self._cells:
+                if thread.is_alive():
+                    running.append((thread, cell))
+                else:
+                    # nothing will write to it again
+                    add_cell(self._finished, cell)
+            self._cells = running
+            totals = {}
+            add_cell(totals, self._finished)
+            for _thread, cell in running:
+                add_cell(totals, cell.copy())
+        return totals
+
+
+def add_cell(totals, cell):
+    for key, value in cell.items():
+        if isinstance(value, list):
+            total = totals.get(key)
+            if total is None:
+                totals[key] = list(value)
+            else:
+                for i, count in enumerate(value):
+                    total[i] += count
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+class Counter(object):
+    """A count that only goes up, optionally one per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._cells = PerThreadCells()
+
+    def inc(self, *label_values):
+        cell = self._cells.cell()
+        cell[label_values] = cell.get(label_values, 0) + 1
+
+    def add(self, amount, *label_values):
+        cell = self._cells.cell()
+        cell[label_values] = cell.get(label_values, 0) + amount
+
+    def samples(self):
+        totals = self._cells.totals()
+        if not self.labels:
+            totals.setdefault((), 0)
+        return [('', label_values, value) for label_values, value in sorted(totals.items())]
+
+
+class Histogram(object):
+    """
+    Observations counted into buckets by upper bound (Prometheus' le), with
+    their sum, optionally one histogram per combination of label values.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.labels = tuple(labels)
+        self._cells = PerThreadCells()
+
+    def observe(self, value, *label_values):
+        cell = self._cells.cell()
+        counts = cell.get(label_values)
+        if counts is None:
+            # a count for each bucket, one for over the last, then the sum
+            counts = cell[label_values] = [0] * (len(self.buckets) + 2)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def samples(self):
+        totals = self._cells.totals()
+        if not self.labels:
+            totals.setdefault((), [0] * (len(self.buckets) + 2))
+        samples = []
+        for label_values, counts in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                samples.append(('_bucket', label_values + (format_value(bound),), cumulative))
+            samples.append(('_sum', label_values, counts[-1]))
+            samples.append(('_count', label_values, cumulative))
+        return samples
+
+    def sample_labels(self, suffix):
+        return self.labels + ('le',) if suffix == '_bucket' else self.labels
+
+    def summary(self, quantile=0.99):
+        """
+        {label values: (count, sum, bound)} where bound is the upper bound of
+        the bucket holding the given quantile of the observations.
+        """
+        summary = {}
+        for label_values, counts in self._cells.totals().items():
+            n = sum(counts[:-1])
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                if cumulative >= quantile * n:
+                    break
+            summary[label_values] = (n, counts[-1], bound)
+        return summary
+
+
+class FunctionMetric(object):
+    """
+    A metric whose value is read when the metrics are, from read(): a number,
+    or with labels, a dict of label values (a tuple): number.
+    """
+
+    def __init__(self, kind, name, help, read, labels=()):
+        self.kind = kind
+        self.name = name
+        self.help = help
+        self.read = read
+        self.labels = tuple(labels)
+
+    def samples(self):
+        values = self.read()
+        if not self.labels:
+            return [('', (), values)]
+        return [('', label_values, value) for label_values, value in sorted(values.items())]
+
+
+def render(metrics):
+    """The metrics in Prometheus' text exposition format."""
+    lines = []
+    for metric in metrics:
+        lines.append('# HELP %s %s' % (metric.name, metric.help.replace('\\', '\\\\').replace('\n', '\\n')))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for suffix, label_values, value in metric.samples():
+            names = metric.sample_labels(suffix) if hasattr(metric, 'sample_labels') else metric.labels
+            if names:
+                labels = ','.join('%s="%s"' % (name, escape_label(label))
+                                  for name, label in zip(names, label_values))
+                lines.append('%s%s{%s} %s' % (metric.name, suffix, labels, format_value(value)))
+            else:
+                lines.append('%s%s %s' % (metric.name, suffix, format_value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer() and abs(value) < 1e15:
+        return '%d.0' % value
+    return repr(value)
+
+
+class MetricsEndpoint(ThreadingMixIn, HTTPServer):
+    """
+    Serves render(collect()) at /metrics, from a daemon thread once start()
+    is called. Listens on 127.0.0.1 by default, so only the machine the
+    server runs on can read it.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, collect, port, host='127.0.0.1'):
+        self.collect = collect
+        HTTPServer.__init__(self, (host, port), MetricsRequestHandler)
+        self.port = self.socket.getsockname()[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render(self.server.collect()).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
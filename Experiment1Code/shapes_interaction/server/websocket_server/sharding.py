@@ -0,0 +1,603 @@
+# License: MIT
+
+import array
+import functools
+import io
+import itertools
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict
+from socketserver import ThreadingMixIn, TCPServer
+
+from .heartbeat import set_tcp_keepalive
+from .websocket_server import (FrameHandlerMixin, WebSocketHandler, WebsocketServerBase,
+                               CLOSE_STATUS_NORMAL, CONTROL_OPCODES, FIN, MASKED, OPCODE,
+                               OPCODE_BINARY, OPCODE_CLOSE_CONN, OPCODE_CONTINUATION, PAYLOAD_LEN,
+                               RSV1, encode_frame, logger, unmask)
+
+'''
+Dyad-affinity sharding over several processes.
+
+Experiment state for a pair must live in one process, so connections cannot
+simply be spread over processes by the kernel. Instead one coordinator
+process accepts every connection, answers the handshake and holds the client
+until it has sent its first message (CLIENT_INFO in the experiments), which
+screen_client may use to turn them away. Ready clients are paired in arrival
+order, and both sockets of a pair are passed
+(SCM_RIGHTS), in one message, to the least loaded of N forked worker
+processes, together with the bytes already read from them. Each worker is an ordinary threaded server
+running the experiment's callbacks, so every pair meets in one process.
+'''
+
+# A client's handshake, and everything it sends before it is handed to a
+# worker, must fit in these many bytes; beyond that it is disconnected.
+MAX_HANDSHAKE_SIZE = 8192
+MAX_PENDING_BYTES = 2**16
+# a pair's handoff: the headers and address of each client, then what was read from them
+MAX_HANDOFF_SIZE = 2 * (4 * MAX_HANDSHAKE_SIZE + MAX_PENDING_BYTES)
+HANDOFF_HEADER = struct.Struct(">I")
+# A client that has not finished the handshake and sent its first message this
+# many seconds after connecting is disconnected.
+PENDING_TIMEOUT = 60
+
+# Seconds between workers' load reports, and between the coordinator's log
+# lines summarising them.
+LOAD_REPORT_INTERVAL = 5
+LOAD_LOG_INTERVAL = 60
+# A crashed worker is replaced after this many seconds.
+RESTART_DELAY = 1
+
+
+class ShardedWebsocketServer(ThreadingMixIn, TCPServer, WebsocketServerBase):
+    """
+    A websocket server that runs the experiment in several worker processes,
+    keeping both members of a pair in the same one. Needs os.fork and fd
+    passing, so Linux or macOS.
+
+    Callbacks are set exactly as for WebsocketServer; each worker is a fork
+    of the process that called run_forever, with its own copy of every
+    global. Clients a worker receives carry 'waiting_message_sent' in their
+    client dict when the coordinator has already sent them waiting_message.
+
+    A worker only ever gets whole pairs, so it cannot find another partner
+    for a client whose partner it turns away. Two further callbacks run in
+    the coordinator so that clients can be turned away before they are
+    paired: screen_client(client, server, message) is given each client's
+    first message and returns None to let them be paired, or a message to
+    send them before they are disconnected ('' for none); then, if a client
+    it let through leaves before being handed to a worker,
+    unpaired_client_left(client, server) is called. client there is a dict
+    with the client's 'id' (unrelated to its id in the worker) and
+    'address', and may be used to keep anything else about them.
+
+    Workers are stopped with SIGTERM when the coordinator is, and leave
+    without running the atexit functions they inherited from it, so
+    worker_stopped(server) is called in each first, e.g. to write out
+    anything still buffered.
+
+    Args:
+        port(int): Port to bind to
+        host(str): Hostname or IP to listen for connections. By default 127.0.0.1
+            is being used. To accept connections from any client, you should use
+            0.0.0.0.
+        loglevel: Logging level from logging module to use for logging. By default
+            warnings and errors are being logged; use logging.INFO to see the
+            per-worker load.
+        workers(int): Number of worker processes. Defaults to one per CPU.
+        waiting_message(str): Sent by the coordinator to a client that is
+            ready but has no partner yet, e.g. a waiting room command.
+        **options: Transport options, see WebsocketServerBase.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING,
+                 workers=None, waiting_message=None, **options):
+        logger.setLevel(loglevel)
+        WebsocketServerBase.__init__(self, **options)
+        TCPServer.__init__(self, (host, port), AdoptedWebSocketHandler)
+        self.port = self.socket.getsockname()[1]
+        self.waiting_message = waiting_message
+        self.workers = [Worker(index) for index in range(workers or os.cpu_count() or 1)]
+        self.worker_index = None
+        self._waiting_frame = encode_frame(waiting_message) if waiting_message is not None else None
+        self._selector = None
+        self._pending_ids = itertools.count(1)
+        self._pending = {}
+        self._waiting = OrderedDict()
+        self._adopted = {}
+
+    def screen_client(self, client, server, message):
+        return None
+
+    def unpaired_client_left(self, client, server):
+        pass
+
+    def worker_stopped(self, server):
+        pass
+
+    def set_fn_screen_client(self, fn):
+        self.screen_client = fn
+
+    def set_fn_unpaired_client_left(self, fn):
+        self.unpaired_client_left = fn
+
+    def set_fn_worker_stopped(self, fn):
+        self.worker_stopped = fn
+
+    # ----------------------------- coordinator ----------------------------
+
+    def serve_forever(self):
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(self.socket, selectors.EVENT_READ, self._accept)
+        for worker in self.workers:
+            self._start_worker(worker)
+        last_logged = time.time()
+        while True:
+            for key, _ in self._selector.select(timeout=1):
+                # unless an earlier callback has since handed off or dropped its client
+                if self._selector.get_map().get(key.fd) is key:
+                    key.data()
+            self._check_workers()
+            self._expire_pending()
+            # pairs a worker could not take are handed off again
+            self._pair()
+            if time.time() - last_logged > LOAD_LOG_INTERVAL:
+                self._log_loads()
+                last_logged = time.time()
+
+    def server_close(self):
+        TCPServer.server_close(self)
+        for worker in self.workers:
+            if worker.pid is not None:
+                try:
+                    os.kill(worker.pid, signal.SIGTERM)
+                    os.waitpid(worker.pid, 0)
+                except OSError:
+                    pass
+
+    def worker_loads(self):
+        """The latest load report from each worker, as a list of dicts."""
+        return [{'worker': w.index, 'pid': w.pid, 'clients': w.clients,
+                 'cpu_percent': w.cpu_percent, 'restarts': w.restarts}
+                for w in self.workers]
+
+    def _log_loads(self):
+        for load in self.worker_loads():
+            logger.info("worker %(worker)d (pid %(pid)s): %(clients)d clients, "
+                        "%(cpu_percent).0f%% cpu, %(restarts)d restarts" % load)
+
+    def _accept(self):
+        try:
+            sock, address = self.socket.accept()
+        except OSError:
+            return
+        if self.tcp_keepalive:
+            set_tcp_keepalive(sock, *self.tcp_keepalive)
+        client = PendingClient(next(self._pending_ids), sock, address, time.monotonic())
+        self._pending[sock] = client
+        self._selector.register(sock, selectors.EVENT_READ, functools.partial(self._read_pending, client))
+
+    def _read_pending(self, client):
+        try:
+            data = client.sock.recv(65536)
+        except OSError:
+            data = b''
+        if not data:
+            self._drop(client)
+            return
+        if client.refused:
+            # waiting for them to close their end
+            return
+        client.buffer += data
+        if client.headers is None:
+            end = client.buffer.find(b'\r\n\r\n')
+            if end < 0:
+                if len(client.buffer) > MAX_HANDSHAKE_SIZE:
+                    self._handshake_failed_(client.address, "request over %d bytes" % MAX_HANDSHAKE_SIZE)
+                    self._drop(client)
+                return
+            head = bytes(client.buffer[:end])
+            del client.buffer[:end + 4]
+            if not self._handshake(client, head):
+                self._handshake_failed_(client.address, "not a websocket upgrade request")
+                self._drop(client)
+                return
+        if len(client.buffer) > MAX_PENDING_BYTES:
+            logger.warning("Disconnecting client %s: sent over %d bytes while waiting for a partner." %
+                           (client.address, MAX_PENDING_BYTES))
+            self._drop(client)
+        elif not client.ready:
+            try:
+                message = first_message(client.buffer, client.deflate, self.max_message_size)
+            except ValueError:
+                self._drop(client)
+                return
+            if message is None:
+                return
+            refusal = self.screen_client(client.info, self, message)
+            if refusal is not None:
+                self._refuse(client, refusal)
+                return
+            client.ready = True
+            if self._waiting_frame is not None:
+                client.sock.sendall(self._waiting_frame)
+            self._waiting[client.sock] = client
+            self._pair()
+
+    def _handshake(self, client, head):
+        lines = head.decode('latin-1').split('\r\n')
+        if not lines[0].upper().startswith('GET'):
+            return False
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(':')
+            if not sep:
+                return False
+            headers[name.lower().strip()] = value.strip()
+        if headers.get('upgrade', '').lower() != 'websocket':
+            return False
+        if 'sec-websocket-key' not in headers:
+            logger.warning("Client tried to connect but was missing a key")
+            return False
+        # the worker negotiates again from the same headers and config, and
+        # so agrees the same extensions
+        extensions = None
+        if self.deflate is not None:
+            client.deflate = self.deflate.negotiate(headers.get('sec-websocket-extensions'))
+            if client.deflate is not None:
+                extensions = client.deflate.response_header()
+        response = FrameHandlerMixin.make_handshake_response(headers['sec-websocket-key'], extensions)
+        client.sock.sendall(response.encode())
+        client.headers = headers
+        return True
+
+    def _drop(self, client):
+        self._selector.unregister(client.sock)
+        del self._pending[client.sock]
+        self._waiting.pop(client.sock, None)
+        client.sock.close()
+        if client.ready:
+            self.unpaired_client_left(client.info, self)
+
+    def _refuse(self, client, message):
+        # closed from our side once they have seen message; the socket itself is only closed when
+        # they close theirs (or at PENDING_TIMEOUT), so nothing they sent meanwhile resets it
+        try:
+            if message:
+                client.sock.sendall(encode_frame(message))
+            client.sock.sendall(encode_frame(struct.pack(">H", CLOSE_STATUS_NORMAL), OPCODE_CLOSE_CONN))
+            client.sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            self._drop(client)
+            return
+        client.refused = True
+        client.buffer = bytearray()
+
+    def _expire_pending(self):
+        deadline = time.monotonic() - PENDING_TIMEOUT
+        for client in list(self._pending.values()):
+            if not client.ready and client.connected_at < deadline:
+                if not client.refused:
+                    logger.warning("Disconnecting client %s: no handshake and first message within %ds." %
+                                   (client.address, PENDING_TIMEOUT))
+                self._drop(client)
+
+    def _pair(self):
+        running = [w for w in self.workers if w.pid is not None]
+        while len(self._waiting) >= 2 and running:
+            worker = min(running, key=lambda w: w.load)
+            pair = [self._waiting.popitem(last=False)[1] for _ in range(2)]
+            if not self._hand_off(worker, pair):
+                # still ours; first in line for the next worker, or once this one is back
+                for client in reversed(pair):
+                    self._waiting[client.sock] = client
+                    self._waiting.move_to_end(client.sock, last=False)
+                running.remove(worker)
+
+    def _hand_off(self, worker, pair):
+        # both clients go in one message, so a worker gets the whole pair or neither
+        info = json.dumps([{'headers': client.headers, 'address': client.address, 'buffered': len(client.buffer)}
+                           for client in pair]).encode()
+        message = HANDOFF_HEADER.pack(len(info)) + info + b''.join(bytes(client.buffer) for client in pair)
+        fds = array.array('i', [client.sock.fileno() for client in pair])
+        try:
+            worker.control.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+        except OSError as e:
+            logger.warning("Could not hand clients %s to worker %d: %s" %
+                           (', '.join(str(client.address) for client in pair), worker.index, e))
+            return False
+        worker.handed_off += len(pair)
+        for client in pair:
+            self._selector.unregister(client.sock)
+            del self._pending[client.sock]
+            # the worker has its own copy of the socket now
+            client.sock.close()
+        return True
+
+    def _start_worker(self, worker):
+        parent_end, child_end = control_socketpair()
+        sys.stdout.flush()
+        pid = os.fork()
+        if pid == 0:
+            parent_end.close()
+            status = 0
+            try:
+                try:
+                    self._become_worker(worker.index, child_end)
+                except KeyboardInterrupt:
+                    pass
+                self.worker_stopped(self)
+            except BaseException:
+                logger.error("Worker %d failed" % worker.index, exc_info=True)
+                status = 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(status)
+        child_end.close()
+        worker.started(pid, parent_end)
+        self._selector.register(parent_end, selectors.EVENT_READ, functools.partial(self._read_report, worker))
+        logger.info("Started worker %d (pid %d)" % (worker.index, pid))
+
+    def _read_report(self, worker):
+        try:
+            data = worker.control.recv(4096)
+        except OSError:
+            data = b''
+        if not data:
+            # the worker has gone; _check_workers reaps and replaces it
+            self._selector.unregister(worker.control)
+            return
+        worker.report(json.loads(data.decode()))
+
+    def _check_workers(self):
+        for worker in self.workers:
+            if worker.pid is None:
+                if time.time() - worker.stopped_at >= RESTART_DELAY:
+                    self._start_worker(worker)
+                    self._pair()
+                continue
+            pid, status = os.waitpid(worker.pid, os.WNOHANG)
+            if pid == 0:
+                continue
+            if os.WIFSIGNALED(status):
+                how = "was killed by signal %d" % os.WTERMSIG(status)
+            else:
+                how = "exited with status %d" % os.WEXITSTATUS(status)
+            logger.warning("Worker %d (pid %d) %s, dropping its %d clients; restarting it." %
+                           (worker.index, pid, how, worker.clients))
+            if worker.control in self._selector.get_map():
+                self._selector.unregister(worker.control)
+            worker.stopped()
+
+    # ------------------------------- worker -------------------------------
+
+    def _become_worker(self, index, control):
+        # let go of everything that belongs to the coordinator
+        self._selector.close()
+        self.socket.close()
+        for client in self._pending.values():
+            client.sock.close()
+        for worker in self.workers:
+            if worker.control is not None:
+                worker.control.close()
+        self._pending.clear()
+        self._waiting.clear()
+        self.workers = []
+        self.worker_index = index
+        # stopped by the coordinator as by Ctrl-C, so worker_stopped is called
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+        if self.heartbeat is not None:
+            self.heartbeat.start_thread()
+        self.start_slow_consumer_thread()
+        reporter = threading.Thread(target=self._report_load, args=(control,))
+        reporter.daemon = True
+        reporter.start()
+
+        fd_size = array.array('i').itemsize
+        while True:
+            try:
+                message, ancdata, _, _ = control.recvmsg(MAX_HANDOFF_SIZE, socket.CMSG_SPACE(2 * fd_size))
+            except ConnectionError:
+                message = b''
+            if not message:
+                return  # the coordinator has gone
+            fds = array.array('i')
+            for level, kind, data in ancdata:
+                if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                    fds.frombytes(data[:len(data) - len(data) % fd_size])
+            self._adopt_pair(fds, message)
+
+    def _adopt_pair(self, fds, message):
+        info_length = HANDOFF_HEADER.unpack_from(message)[0]
+        start = HANDOFF_HEADER.size + info_length
+        infos = json.loads(message[HANDOFF_HEADER.size:start].decode())
+        for fd, info in zip(fds, infos):
+            sock = socket.socket(fileno=fd)
+            self._adopted[sock] = (info['headers'], message[start:start + info['buffered']])
+            start += info['buffered']
+            self.process_request(sock, tuple(info['address']))
+
+    def _report_load(self, control):
+        while True:
+            time.sleep(LOAD_REPORT_INTERVAL)
+            report = {'clients': len(self.registry), 'cpu': time.process_time()}
+            try:
+                control.send(json.dumps(report).encode())
+            except OSError:
+                return
+
+
+class AdoptedWebSocketHandler(WebSocketHandler):
+    """
+    Serves a connection handed over by the coordinator, which has already
+    answered the handshake. Whatever the coordinator read after the handshake
+    is replayed ahead of the socket, so frames (and the deflate stream) are
+    seen exactly as the client sent them.
+    """
+
+    def setup(self):
+        WebSocketHandler.setup(self)
+        self.handshake_headers, replay = self.server._adopted.pop(self.request)
+        self.rfile.close()
+        self.rfile = io.BufferedReader(ReplayReader(replay, socket.SocketIO(self.request, 'rb')))
+
+    def handshake(self):
+        self.negotiate_extensions(self.handshake_headers)
+        self.handshake_done = True
+        self.valid_client = True
+        self.server._new_client_(self, waiting_message_sent=self.server.waiting_message is not None)
+
+
+class ReplayReader(io.RawIOBase):
+    """Reads the replay bytes first, then from raw."""
+
+    def __init__(self, replay, raw):
+        self._replay = memoryview(replay)
+        self._raw = raw
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if len(self._replay):
+            n = min(len(buffer), len(self._replay))
+            buffer[:n] = self._replay[:n]
+            self._replay = self._replay[n:]
+            return n
+        return self._raw.readinto(buffer)
+
+
+class PendingClient(object):
+    """A connection the coordinator holds until it has a partner."""
+
+    def __init__(self, id, sock, address, connected_at):
+        self.sock = sock
+        self.address = address
+        self.connected_at = connected_at
+        # what screen_client and unpaired_client_left are given
+        self.info = {'id': id, 'address': address}
+        self.buffer = bytearray()
+        self.headers = None
+        self.deflate = None
+        self.ready = False
+        self.refused = False
+
+
+class Worker(object):
+    """The coordinator's view of one worker process."""
+
+    def __init__(self, index):
+        self.index = index
+        self.pid = None
+        self.control = None
+        self.clients = 0
+        self.handed_off = 0
+        self.cpu = 0.0
+        self.cpu_percent = 0.0
+        self.reported_at = None
+        self.stopped_at = 0
+        self.restarts = 0
+
+    @property
+    def load(self):
+        # clients handed over since the last report are not in it yet
+        return self.clients + self.handed_off
+
+    def started(self, pid, control):
+        self.pid = pid
+        self.control = control
+        self.clients = self.handed_off = 0
+        self.cpu = self.cpu_percent = 0.0
+        self.reported_at = None
+
+    def stopped(self):
+        self.control.close()
+        self.pid = self.control = None
+        self.stopped_at = time.time()
+        self.restarts += 1
+
+    def report(self, report):
+        now = time.time()
+        if self.reported_at is not None:
+            self.cpu_percent = 100 * (report['cpu'] - self.cpu) / (now - self.reported_at)
+        self.cpu = report['cpu']
+        self.reported_at = now
+        self.clients = report['clients']
+        self.handed_off = 0
+
+
+def control_socketpair():
+    # SEQPACKET keeps handoffs apart and reports EOF when the other end
+    # exits; macOS only has datagrams for unix socket pairs
+    try:
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    except (AttributeError, OSError):
+        return socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+
+def first_message(data, deflate=None, max_message_size=None):
+    """
+    The first data message in data, raw frames from a client: a str for a
+    text message or bytes for a binary one, inflated with deflate (a fresh
+    PerMessageDeflate, as the worker will start with) if it was compressed.
+    None if data does not hold a whole message yet. Raises ValueError if the
+    client has started closing the connection, or the message is not valid
+    UTF-8 or is over max_message_size, or was compressed without
+    permessage-deflate.
+    """
+    pos = 0
+    payloads = []
+    opcode = compressed = None
+    while len(data) >= pos + 2:
+        b1, b2 = data[pos], data[pos + 1]
+        pos += 2
+        length = b2 & PAYLOAD_LEN
+        if length == 126:
+            if len(data) < pos + 2:
+                return None
+            length = struct.unpack_from(">H", data, pos)[0]
+            pos += 2
+        elif length == 127:
+            if len(data) < pos + 8:
+                return None
+            length = struct.unpack_from(">Q", data, pos)[0]
+            pos += 8
+        masks = data[pos:pos + 4] if b2 & MASKED else None
+        if masks is not None:
+            pos += 4
+        if len(data) < pos + length:
+            return None
+        payload = data[pos:pos + length]
+        pos += length
+        frame_opcode = b1 & OPCODE
+        if frame_opcode == OPCODE_CLOSE_CONN:
+            raise ValueError("client is closing the connection")
+        if frame_opcode in CONTROL_OPCODES:
+            continue
+        if frame_opcode != OPCODE_CONTINUATION:
+            opcode, compressed = frame_opcode, bool(b1 & RSV1)
+        payloads.append(unmask(masks, payload) if masks is not None else payload)
+        if b1 & FIN:
+            message = b''.join(payloads)
+            if compressed:
+                if deflate is None:
+                    raise ValueError("compressed message without permessage-deflate")
+                message = deflate.decompress(message, max_message_size + 1 if max_message_size else 0)
+            if max_message_size is not None and len(message) > max_message_size:
+                raise ValueError("message over %d bytes" % max_message_size)
+            if opcode == OPCODE_BINARY:
+                return bytes(message)
+            return message.decode('utf-8')
+    return None
@@ -3,12 +3,26 @@
 
 import sys
 import struct
+import itertools
+import threading
+import time
+from collections import deque
 from base64 import b64encode
 from hashlib import sha1
 import logging
+import socket
 from socket import error as SocketError
 import errno
 
+from .deflate import DeflateConfig
+from .heartbeat import Heartbeat, round_trip_time, set_tcp_keepalive
+from .metrics import Histogram
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 if sys.version_info[0] < 3:
     from SocketServer import ThreadingMixIn, TCPServer, StreamRequestHandler
 else:
@@ -34,6 +48,8 @@ logging.basicConfig()
 '''
 
 FIN    = 0x80
+RSV1   = 0x40
+RSV    = 0x70
 OPCODE = 0x0f
 MASKED = 0x80
 PAYLOAD_LEN = 0x7f
@@ -46,6 +62,42 @@ OPCODE_BINARY       = 0x2
 OPCODE_CLOSE_CONN   = 0x8
 OPCODE_PING         = 0x9
 OPCODE_PONG         = 0xA
+CONTROL_OPCODES     = (OPCODE_CLOSE_CONN, OPCODE_PING, OPCODE_PONG)
+
+CLOSE_STATUS_NORMAL         = 1000
+CLOSE_STATUS_PROTOCOL_ERROR = 1002
+CLOSE_STATUS_INVALID_DATA   = 1007
+CLOSE_STATUS_TOO_BIG        = 1009
+
+# Largest message (after reassembling fragments and inflating) a client may
+# send before the connection is closed with status 1009.
+DEFAULT_MAX_MESSAGE_SIZE = 16 * 2**20
+
+# Outbound queue limits, in bytes waiting to be written to one client.
+DEFAULT_HIGH_WATERMARK = 2**20
+DEFAULT_LOW_WATERMARK = 2**18
+# How long a client's queue may stay over the high watermark before the
+# client is disconnected as a slow consumer.
+DEFAULT_SLOW_CONSUMER_TIMEOUT = 30
+# Seconds between checks of every client for being a slow consumer, so one
+# that has stopped reading is noticed even when nothing more is sent to it.
+SLOW_CONSUMER_CHECK_INTERVAL = 1.0
+# How long a closing connection waits for its queue to drain.
+DRAIN_TIMEOUT = 5
+
+# Seconds between protocol-level pings to each client, and how long a client
+# may send nothing at all (not even a pong) before it is disconnected.
+DEFAULT_HEARTBEAT_INTERVAL = 20
+DEFAULT_HEARTBEAT_TIMEOUT = 60
+# Kernel keepalive probing: (idle seconds, seconds between probes, probes).
+DEFAULT_TCP_KEEPALIVE = (60, 10, 3)
+
+# Payloads at least this long are unmasked with numpy when it is available;
+# below this the fixed cost of building arrays outweighs the saving.
+NUMPY_UNMASK_THRESHOLD = 4096
+
+# What every handler counts of its traffic (see WebsocketServerBase.stats)
+TRAFFIC_COUNTS = ('messages_in', 'bytes_in', 'messages_out', 'bytes_out')
 
 
 # -------------------------------- API ---------------------------------
@@ -72,6 +124,9 @@ class API():
     def message_received(self, client, server, message):
         pass
 
+    def binary_received(self, client, server, data):
+        pass
+
     def set_fn_new_client(self, fn):
         self.new_client = fn
 
@@ -81,16 +136,251 @@ class API():
     def set_fn_message_received(self, fn):
         self.message_received = fn
 
+    def set_fn_binary_received(self, fn):
+        self.binary_received = fn
+
     def send_message(self, client, msg):
         self._unicast_(client, msg)
 
     def send_message_to_all(self, msg):
         self._multicast_(msg)
+
+    def send_frame(self, client, frame):
+        """Sends a complete frame built earlier with encode_frame."""
+        client['handler'].send_frame(frame)
+
+    def queued_bytes(self, client):
+        """Bytes sent to client that have not yet been written to its socket."""
+        return client['handler'].queued_bytes()
+
+    def disconnect(self, client):
+        """Drops the connection to client; client_left is then called as usual."""
+        client['handler'].disconnect()
     
 
 
 # ------------------------- Implementation -----------------------------
-class WebsocketServer(ThreadingMixIn, TCPServer, API):
+class ClientRegistry(object):
+    """
+    The connected clients of one server, indexed both by handler and by id so
+    that adding, removing and looking up a client are all constant time.
+
+    Ids come from a counter guarded by a lock, so clients connecting on
+    different threads at the same moment never share an id. Lookups are
+    single dict reads and need no lock.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._by_handler = {}
+        self._by_id = {}
+
+    def add(self, handler, **info):
+        """Registers handler under a new id; info becomes extra client keys."""
+        with self._lock:
+            client = {
+                'id': next(self._ids),
+                'handler': handler,
+                'address': handler.client_address
+            }
+            client.update(info)
+            self._by_handler[handler] = client
+            self._by_id[client['id']] = client
+        return client
+
+    def remove(self, handler):
+        """Unregisters and returns handler's client, or None if it has none."""
+        with self._lock:
+            client = self._by_handler.pop(handler, None)
+            if client is not None:
+                del self._by_id[client['id']]
+        return client
+
+    def get(self, handler):
+        return self._by_handler.get(handler)
+
+    def get_by_id(self, client_id):
+        return self._by_id.get(client_id)
+
+    def __contains__(self, client):
+        return client['id'] in self._by_id
+
+    def __len__(self):
+        return len(self._by_id)
+
+    def __iter__(self):
+        # iterate over a snapshot so clients may come and go meanwhile
+        return iter(list(self._by_id.values()))
+
+
+class WebsocketServerBase(API):
+    """
+    Client bookkeeping shared by the threaded WebsocketServer and the asyncio
+    AsyncWebsocketServer. Handlers call back into these methods whatever the
+    transport underneath them is.
+
+    Transport options (keyword arguments to either server):
+        deflate(DeflateConfig): Settings for permessage-deflate compression,
+            offered to clients that ask for it. None (the default) disables it.
+        max_message_size(int): Largest message in bytes a client may send,
+            after reassembling fragments and decompressing. Bigger messages
+            close the connection with status 1009.
+        high_watermark(int), low_watermark(int): Every client has an outbound
+            queue, so sending never waits on a slow socket. Once more than
+            high_watermark bytes are queued the client counts as congested,
+            until the queue drains below low_watermark.
+        slow_consumer_timeout(float): Seconds a client may stay congested,
+            or a single write to it may stay blocked, before it is
+            disconnected (and client_left called as usual). Every client is
+            checked once a second as well as whenever its queue changes.
+        heartbeat_interval(float): Seconds between ping frames to each
+            client. None disables the heartbeat.
+        heartbeat_timeout(float): Seconds a client may stay silent - no
+            message, ping or pong - before it is disconnected.
+        tcp_keepalive(tuple): (idle, interval, count) for kernel keepalive
+            probes on every connection, or None to leave keepalive off.
+
+    stats() gives the server's totals of connections, messages and bytes
+    in each direction, and failed handshakes; round_trip_times is a
+    Histogram of every heartbeat round trip (see metrics.py).
+    """
+
+    def __init__(self, deflate=None, max_message_size=DEFAULT_MAX_MESSAGE_SIZE,
+                 high_watermark=DEFAULT_HIGH_WATERMARK,
+                 low_watermark=DEFAULT_LOW_WATERMARK,
+                 slow_consumer_timeout=DEFAULT_SLOW_CONSUMER_TIMEOUT,
+                 heartbeat_interval=DEFAULT_HEARTBEAT_INTERVAL,
+                 heartbeat_timeout=DEFAULT_HEARTBEAT_TIMEOUT,
+                 tcp_keepalive=DEFAULT_TCP_KEEPALIVE):
+        if low_watermark > high_watermark:
+            raise ValueError("low_watermark must not be above high_watermark")
+        self.registry = ClientRegistry()
+        self.deflate = deflate
+        self.max_message_size = max_message_size
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.slow_consumer_timeout = slow_consumer_timeout
+        self.slow_consumer_evictions = 0
+        self.handshake_failures = 0
+        # each handler counts its own messages and bytes; these are the totals of
+        # clients that have left
+        self._departed = dict.fromkeys(TRAFFIC_COUNTS, 0)
+        self._counts_lock = threading.Lock()
+        self.round_trip_times = Histogram('websocket_heartbeat_rtt_seconds',
+                                          'Round trip time of protocol-level pings to each client.')
+        self.tcp_keepalive = tcp_keepalive
+        self.heartbeat = None
+        if heartbeat_interval:
+            self.heartbeat = Heartbeat(self, heartbeat_interval, heartbeat_timeout)
+
+    @property
+    def clients(self):
+        return list(self.registry)
+
+    def _message_received_(self, handler, msg):
+        self.message_received(self.handler_to_client(handler), self, msg)
+
+    def _binary_received_(self, handler, data):
+        self.binary_received(self.handler_to_client(handler), self, data)
+
+    def _ping_received_(self, handler, msg):
+        handler.send_pong(msg)
+
+    def _pong_received_(self, handler, msg):
+        rtt = round_trip_time(msg)
+        if rtt is not None:
+            handler.round_trip_time = rtt
+            self.round_trip_times.observe(rtt)
+
+    def _heartbeat_timeout_(self, handler):
+        client = self.handler_to_client(handler)
+        logger.warning("Disconnecting client %s: nothing received for over %ss." %
+                       (client['id'] if client else handler.client_address,
+                        self.heartbeat.timeout))
+
+    def _new_client_(self, handler, **info):
+        client = self.registry.add(handler, **info)
+        if self.heartbeat is not None:
+            self.heartbeat.add(handler)
+        self.new_client(client, self)
+
+    def _client_left_(self, handler):
+        if self.heartbeat is not None:
+            self.heartbeat.remove(handler)
+        client = self.registry.remove(handler)
+        with self._counts_lock:
+            for name in TRAFFIC_COUNTS:
+                self._departed[name] += getattr(handler, name)
+        if client is not None:
+            self.client_left(client, self)
+
+    def _handshake_failed_(self, address, reason):
+        with self._counts_lock:
+            self.handshake_failures += 1
+        logger.info("Handshake with %s failed: %s" % (address, reason))
+
+    def stats(self):
+        """
+        Clients connected now, messages (data frames) and bytes (whole
+        frames) received and sent over every connection so far, and
+        handshakes, slow consumers and heartbeat timeouts that ended one.
+        """
+        with self._counts_lock:
+            stats = dict(self._departed)
+            stats['handshake_failures'] = self.handshake_failures
+        for client in self.registry:
+            handler = client['handler']
+            for name in TRAFFIC_COUNTS:
+                stats[name] += getattr(handler, name)
+        stats['connections'] = len(self.registry)
+        stats['slow_consumer_evictions'] = self.slow_consumer_evictions
+        stats['heartbeat_timeouts'] = self.heartbeat.timeouts if self.heartbeat is not None else 0
+        return stats
+
+    def _slow_consumer_(self, handler):
+        client = self.handler_to_client(handler)
+        self.slow_consumer_evictions += 1
+        logger.warning("Disconnecting client %s: %d bytes queued for over %ss." %
+                       (client['id'] if client else handler.client_address,
+                        handler.queued_bytes(), self.slow_consumer_timeout))
+
+    def _check_slow_consumers_(self):
+        now = time.time()
+        for client in self.registry:
+            client['handler'].check_slow_consumer(now)
+
+    def _watch_slow_consumers_(self):
+        # the threaded servers run this in a daemon thread, the asyncio one on its loop
+        while True:
+            time.sleep(SLOW_CONSUMER_CHECK_INTERVAL)
+            self._check_slow_consumers_()
+
+    def start_slow_consumer_thread(self):
+        thread = threading.Thread(target=self._watch_slow_consumers_)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _unicast_(self, to_client, msg):
+        to_client['handler'].send_message(msg)
+
+    def _multicast_(self, msg):
+        for client in self.registry:
+            self._unicast_(client, msg)
+
+    def last_seen(self, client):
+        """time.time() at which the last frame of any kind arrived from client."""
+        return client['handler'].last_seen
+
+    def handler_to_client(self, handler):
+        return self.registry.get(handler)
+
+    def id_to_client(self, client_id):
+        return self.registry.get_by_id(client_id)
+
+
+class WebsocketServer(ThreadingMixIn, TCPServer, WebsocketServerBase):
     """
 	A websocket server waiting for clients to connect.
 
@@ -101,10 +391,13 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
             0.0.0.0.
         loglevel: Logging level from logging module to use for logging. By default
             warnings and errors are being logged.
+        **options: Transport options, see WebsocketServerBase.
 
     Properties:
-        clients(list): A list of connected clients. A client is a dictionary
-            like below.
+        registry(ClientRegistry): The connected clients of this server,
+            indexed by handler and by id.
+        clients(list): A snapshot list of connected clients. A client is a
+            dictionary like below.
                 {
                  'id'      : id,
                  'handler' : handler,
@@ -115,53 +408,254 @@ class WebsocketServer(ThreadingMixIn, TCPServer, API):
     allow_reuse_address = True
     daemon_threads = True  # comment to keep threads alive until finished
 
-    clients = []
-    id_counter = 0
-
-    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING):
+    def __init__(self, port, host='127.0.0.1', loglevel=logging.WARNING, **options):
         logger.setLevel(loglevel)
+        WebsocketServerBase.__init__(self, **options)
         TCPServer.__init__(self, (host, port), WebSocketHandler)
         self.port = self.socket.getsockname()[1]
+        if self.heartbeat is not None:
+            self.heartbeat.start_thread()
+        self.start_slow_consumer_thread()
 
-    def _message_received_(self, handler, msg):
-        self.message_received(self.handler_to_client(handler), self, msg)
 
-    def _ping_received_(self, handler, msg):
-        handler.send_pong(msg)
+class FrameHandlerMixin(object):
+    """
+    Frame-level logic that does not depend on how bytes reach the handler.
+    Subclasses provide the I/O: reading frames, and _write_frame(*parts) to
+    put all the given buffers on the wire, in order and in full.
+    """
 
-    def _pong_received_(self, handler, msg):
-        pass
+    def init_frame_state(self):
+        self.deflate = None
+        self._send_lock = threading.Lock()
+        # opcode and RSV1 of the first frame of the message being reassembled
+        self._message_opcode = None
+        self._message_compressed = False
+        self._fragments = None
+        self._congested_since = None
+        self.last_seen = time.time()
+        self.round_trip_time = None
+        # TRAFFIC_COUNTS: frames in are only counted by the thread reading them, and
+        # frames out under _send_lock, so no counting needs a lock of its own
+        self.messages_in = 0
+        self.bytes_in = 0
+        self.messages_out = 0
+        self.bytes_out = 0
+
+    def frame_header_ok(self, b1, b2):
+        """
+        Checks the first two bytes of a frame. Returns False if the frame
+        cannot be processed, in which case the connection is being closed.
+        """
+        opcode = b1 & OPCODE
+        masked = b2 & MASKED
+        rsv    = b1 & RSV
 
-    def _new_client_(self, handler):
-        self.id_counter += 1
-        client = {
-            'id': self.id_counter,
-            'handler': handler,
-            'address': handler.client_address
-        }
-        self.clients.append(client)
-        self.new_client(client, self)
+        if opcode == OPCODE_CLOSE_CONN:
+            logger.info("Client asked to close connection.")
+            self.send_close(CLOSE_STATUS_NORMAL)
+            return False
+        if not masked:
+            logger.warning("Client must always be masked.")
+            self.keep_alive = 0
+            return False
+        if opcode not in (OPCODE_CONTINUATION, OPCODE_TEXT, OPCODE_BINARY, OPCODE_PING, OPCODE_PONG):
+            logger.warning("Unknown opcode %#x." % opcode)
+            self.send_close(CLOSE_STATUS_PROTOCOL_ERROR)
+            return False
+        if rsv and not (rsv == RSV1 and self.deflate is not None and opcode in (OPCODE_TEXT, OPCODE_BINARY)):
+            logger.warning("Reserved bits %#x set without a negotiated extension." % rsv)
+            self.send_close(CLOSE_STATUS_PROTOCOL_ERROR)
+            return False
+        if opcode in CONTROL_OPCODES and not b1 & FIN:
+            logger.warning("Control frames must not be fragmented.")
+            self.send_close(CLOSE_STATUS_PROTOCOL_ERROR)
+            return False
+        if opcode == OPCODE_CONTINUATION and self._message_opcode is None:
+            logger.warning("Continuation frame without a message to continue.")
+            self.send_close(CLOSE_STATUS_PROTOCOL_ERROR)
+            return False
+        if opcode in (OPCODE_TEXT, OPCODE_BINARY) and self._message_opcode is not None:
+            logger.warning("New message started before the last one was finished.")
+            self.send_close(CLOSE_STATUS_PROTOCOL_ERROR)
+            return False
+        return True
 
-    def _client_left_(self, handler):
-        client = self.handler_to_client(handler)
-        self.client_left(client, self)
-        if client in self.clients:
-            self.clients.remove(client)
+    def payload_length_ok(self, b1, payload_length):
+        """
+        Checks a frame's payload length before any of the payload is read,
+        so a single huge frame cannot make us allocate unbounded memory.
+        """
+        if b1 & OPCODE in CONTROL_OPCODES:
+            if payload_length > 125:
+                logger.warning("Control frame payload too long.")
+                self.send_close(CLOSE_STATUS_PROTOCOL_ERROR)
+                return False
+            return True
+        buffered = len(self._fragments) if self._fragments is not None else 0
+        if buffered + payload_length > self.server.max_message_size:
+            logger.warning("Message exceeds %d bytes." % self.server.max_message_size)
+            self.send_close(CLOSE_STATUS_TOO_BIG)
+            return False
+        return True
 
-    def _unicast_(self, to_client, msg):
-        to_client['handler'].send_message(msg)
+    def frame_received(self, b1, payload):
+        """
+        Takes an unmasked frame payload. Control frames are handled at once;
+        data frames are reassembled into a MessageBuffer until FIN, then the
+        message is inflated if need be and passed to the server.
+        """
+        opcode = b1 & OPCODE
+        self.last_seen = time.time()
+        # the frame as it arrived, with the client's 4-byte masking key
+        self.bytes_in += frame_size(len(payload)) + 4
+        if opcode == OPCODE_PING:
+            self.server._ping_received_(self, payload)
+            return
+        if opcode == OPCODE_PONG:
+            self.server._pong_received_(self, payload)
+            return
 
-    def _multicast_(self, msg):
-        for client in self.clients:
-            self._unicast_(client, msg)
+        if opcode != OPCODE_CONTINUATION:
+            self._message_opcode = opcode
+            self._message_compressed = bool(b1 & RSV1)
+        if not b1 & FIN:
+            if self._fragments is None:
+                self._fragments = MessageBuffer(len(payload))
+            self._fragments.append(payload)
+            return
+        if self._fragments is not None:
+            self._fragments.append(payload)
+            payload = self._fragments.take()
+            self._fragments = None
+        opcode, compressed = self._message_opcode, self._message_compressed
+        self._message_opcode = None
+
+        if compressed:
+            payload = self.deflate.decompress(payload, self.server.max_message_size + 1)
+            if len(payload) > self.server.max_message_size:
+                logger.warning("Message exceeds %d bytes once decompressed." % self.server.max_message_size)
+                self.send_close(CLOSE_STATUS_TOO_BIG)
+                return
+        self.messages_in += 1
+        if opcode == OPCODE_BINARY:
+            self.server._binary_received_(self, bytes(payload))
+            return
+        try:
+            message = payload.decode('utf8')
+        except UnicodeDecodeError:
+            logger.warning("Text message is not valid UTF-8.")
+            self.send_close(CLOSE_STATUS_INVALID_DATA)
+            return
+        self.server._message_received_(self, message)
 
-    def handler_to_client(self, handler):
-        for client in self.clients:
-            if client['handler'] == handler:
-                return client
+    def send_message(self, message):
+        self.send_text(message)
+
+    def send_ping(self, message=b''):
+        self.send_text(message, OPCODE_PING)
+
+    def send_pong(self, message):
+        self.send_text(message, OPCODE_PONG)
+
+    def send_binary(self, data):
+        self.send_text(data, OPCODE_BINARY)
 
+    def send_close(self, status=CLOSE_STATUS_NORMAL, reason=''):
+        """Sends a close frame and stops reading from this client."""
+        self.keep_alive = 0
+        try:
+            self.send_text(struct.pack(">H", status) + encode_to_UTF8(reason), OPCODE_CLOSE_CONN)
+        except (SocketError, RuntimeError):
+            pass
 
-class WebSocketHandler(StreamRequestHandler):
+    def send_text(self, message, opcode=OPCODE_TEXT):
+        """
+        Sends message as a single frame. message may be a str, or bytes /
+        bytearray / memoryview that are already encoded (UTF-8 for text), in
+        which case they are sent without being copied or re-validated.
+
+        Important: Fragmented(=continuation) messages are not supported since
+        their usage cases are limited - when we don't know the payload length.
+        """
+        deflate = self.deflate if opcode in (OPCODE_TEXT, OPCODE_BINARY) else None
+        # compressing and writing happen under one lock, so frames reach the
+        # wire in the same order the shared deflate window saw them
+        with self._send_lock:
+            parts = encode_frame_parts(message, opcode, deflate)
+            if parts is None:
+                return False
+            self._write_frame(*parts)
+            if opcode in (OPCODE_TEXT, OPCODE_BINARY):
+                self.messages_out += 1
+            self.bytes_out += len(parts[0]) + len(parts[1])
+        return True
+
+    def send_frame(self, frame):
+        """Sends a complete frame built earlier with encode_frame."""
+        with self._send_lock:
+            self._write_frame(frame)
+            self.messages_out += 1
+            self.bytes_out += len(frame)
+
+    def check_backpressure(self, queued):
+        """
+        Called with the number of bytes queued for this client whenever it
+        changes, and every second by the server. A client that stays over the
+        high watermark for longer than slow_consumer_timeout is disconnected.
+        """
+        server = self.server
+        if queued > server.high_watermark:
+            now = time.time()
+            if self._congested_since is None:
+                self._congested_since = now
+            elif now - self._congested_since > server.slow_consumer_timeout:
+                self._evict_slow_consumer()
+        elif queued <= server.low_watermark:
+            self._congested_since = None
+
+    def check_slow_consumer(self, now):
+        """Called every second by the server, whether or not anything is being sent."""
+        self.check_backpressure(self.queued_bytes())
+
+    def _evict_slow_consumer(self):
+        self._congested_since = None
+        self.server._slow_consumer_(self)
+        self.disconnect()
+
+    def negotiate_extensions(self, headers):
+        """
+        Agrees permessage-deflate with the client if the server has it
+        enabled and the client offered it. Returns the value for the
+        Sec-WebSocket-Extensions response header, or None.
+        """
+        self.deflate = None
+        if self.server.deflate is not None:
+            self.deflate = self.server.deflate.negotiate(headers.get('sec-websocket-extensions'))
+        if self.deflate is not None:
+            return self.deflate.response_header()
+        return None
+
+    @classmethod
+    def make_handshake_response(cls, key, extensions=None):
+        response = \
+          'HTTP/1.1 101 Switching Protocols\r\n'\
+          'Upgrade: websocket\r\n'              \
+          'Connection: Upgrade\r\n'             \
+          'Sec-WebSocket-Accept: %s\r\n' % cls.calculate_response_key(key)
+        if extensions:
+            response += 'Sec-WebSocket-Extensions: %s\r\n' % extensions
+        return response + '\r\n'
+
+    @classmethod
+    def calculate_response_key(cls, key):
+        GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+        hash = sha1(key.encode() + GUID.encode())
+        response_key = b64encode(hash.digest()).strip()
+        return response_key.decode('ASCII')
+
+
+class WebSocketHandler(FrameHandlerMixin, StreamRequestHandler):
 
     def __init__(self, socket, addr, server):
         self.server = server
@@ -169,9 +663,21 @@ class WebSocketHandler(StreamRequestHandler):
 
     def setup(self):
         StreamRequestHandler.setup(self)
+        # our frames are small commands that should go out immediately, not
+        # wait on Nagle's algorithm for the previous segment to be acked
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.server.tcp_keepalive:
+            set_tcp_keepalive(self.request, *self.server.tcp_keepalive)
         self.keep_alive = True
         self.handshake_done = False
         self.valid_client = False
+        self.init_frame_state()
+        self.outbound = OutboundQueue()
+        # when the writer started the write it is in, if it is in one
+        self._writing_since = None
+        self._writer = threading.Thread(target=self._drain_outbound)
+        self._writer.daemon = True
+        self._writer.start()
 
     def handle(self):
         while self.keep_alive:
@@ -198,102 +704,84 @@ class WebSocketHandler(StreamRequestHandler):
                 return
             b1, b2 = 0, 0
         except ValueError as e:
-            b1, b2 = 0, 0
-
-        fin    = b1 & FIN
-        opcode = b1 & OPCODE
-        masked = b2 & MASKED
-        payload_length = b2 & PAYLOAD_LEN
-
-        if opcode == OPCODE_CLOSE_CONN:
-            logger.info("Client asked to close connection.")
+            # nothing left to read: the socket was closed under us
+            logger.info("Client closed connection.")
             self.keep_alive = 0
             return
-        if not masked:
-            logger.warn("Client must always be masked.")
-            self.keep_alive = 0
-            return
-        if opcode == OPCODE_CONTINUATION:
-            logger.warn("Continuation frames are not supported.")
-            return
-        elif opcode == OPCODE_BINARY:
-            logger.warn("Binary frames are not supported.")
-            return
-        elif opcode == OPCODE_TEXT:
-            opcode_handler = self.server._message_received_
-        elif opcode == OPCODE_PING:
-            opcode_handler = self.server._ping_received_
-        elif opcode == OPCODE_PONG:
-            opcode_handler = self.server._pong_received_
-        else:
-            logger.warn("Unknown opcode %#x." % opcode)
-            self.keep_alive = 0
+
+        if not self.frame_header_ok(b1, b2):
             return
+        payload_length = b2 & PAYLOAD_LEN
 
         if payload_length == 126:
             payload_length = struct.unpack(">H", self.rfile.read(2))[0]
         elif payload_length == 127:
             payload_length = struct.unpack(">Q", self.rfile.read(8))[0]
+        if not self.payload_length_ok(b1, payload_length):
+            return
 
         masks = self.read_bytes(4)
-        message_bytes = bytearray()
-        for message_byte in self.read_bytes(payload_length):
-            message_byte ^= masks[len(message_bytes) % 4]
-            message_bytes.append(message_byte)
-        opcode_handler(self, message_bytes.decode('utf8'))
-
-    def send_message(self, message):
-        self.send_text(message)
-
-    def send_pong(self, message):
-        self.send_text(message, OPCODE_PONG)
+        self.frame_received(b1, unmask(masks, self.read_bytes(payload_length)))
 
-    def send_text(self, message, opcode=OPCODE_TEXT):
-        """
-        Important: Fragmented(=continuation) messages are not supported since
-        their usage cases are limited - when we don't know the payload length.
-        """
+    def _write_frame(self, *parts):
+        # called from any thread; the frame is written by this client's
+        # writer thread, so the caller never waits on a slow socket
+        queued = self.outbound.put(parts)
+        if queued is not None:
+            self.check_backpressure(queued)
 
-        # Validate message
-        if isinstance(message, bytes):
-            message = try_decode_UTF8(message)  # this is slower but ensures we have UTF-8
-            if not message:
-                logger.warning("Can\'t send message, message is not valid UTF-8")
-                return False
-        elif sys.version_info < (3,0) and (isinstance(message, str) or isinstance(message, unicode)):
-            pass
-        elif isinstance(message, str):
-            pass
+    def _drain_outbound(self):
+        while True:
+            parts = self.outbound.get()
+            if parts is None:
+                return
+            self._writing_since = time.time()
+            try:
+                self._send_parts(parts)
+            except (SocketError, ValueError):
+                self.outbound.close()
+                self.disconnect()
+                return
+            finally:
+                self._writing_since = None
+            self.check_backpressure(self.outbound.done(parts))
+
+    def check_slow_consumer(self, now):
+        # a client that has stopped reading leaves the writer blocked in sendall, with
+        # perhaps too little queued behind it to count as congested
+        writing_since = self._writing_since
+        if writing_since is not None and now - writing_since > self.server.slow_consumer_timeout:
+            self._evict_slow_consumer()
         else:
-            logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
-            return False
+            self.check_backpressure(self.queued_bytes())
 
-        header  = bytearray()
-        payload = encode_to_UTF8(message)
-        payload_length = len(payload)
-
-        # Normal payload
-        if payload_length <= 125:
-            header.append(FIN | opcode)
-            header.append(payload_length)
+    def queued_bytes(self):
+        return self.outbound.size
 
-        # Extended payload
-        elif payload_length >= 126 and payload_length <= 65535:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT16)
-            header.extend(struct.pack(">H", payload_length))
-
-        # Huge extended payload
-        elif payload_length < 18446744073709551616:
-            header.append(FIN | opcode)
-            header.append(PAYLOAD_LEN_EXT64)
-            header.extend(struct.pack(">Q", payload_length))
+    def disconnect(self):
+        """Drops the connection; the reading thread then calls finish as usual."""
+        try:
+            self.request.shutdown(socket.SHUT_RDWR)
+        except (SocketError, ValueError):
+            pass
 
-        else:
-            raise Exception("Message is too big. Consider breaking it into chunks.")
+    def _send_parts(self, parts):
+        # socket.send may write only part of a frame when the socket buffer
+        # is full, so we always write until every byte of every part has gone.
+        # Small frames are cheaper to join and sendall than to scatter-gather.
+        size = sum(len(part) for part in parts)
+        if size < SCATTER_GATHER_THRESHOLD or not hasattr(self.request, 'sendmsg'):
+            self.request.sendall(b''.join(parts))
             return
-
-        self.request.send(header + payload)
+        views = [memoryview(part).cast('B') for part in parts if len(part)]
+        while views:
+            sent = self.request.sendmsg(views)
+            while sent:
+                if sent >= len(views[0]):
+                    sent -= len(views.pop(0))
+                else:
+                    views[0] = views[0][sent:]
+                    sent = 0
 
     def read_http_headers(self):
         headers = {}
@@ -310,11 +798,11 @@ class WebSocketHandler(StreamRequestHandler):
         return headers
 
     def handshake(self):
-        headers = self.read_http_headers()
-
         try:
+            headers = self.read_http_headers()
             assert headers['upgrade'].lower() == 'websocket'
-        except AssertionError:
+        except (AssertionError, KeyError, ValueError):
+            self.server._handshake_failed_(self.client_address, "not a websocket upgrade request")
             self.keep_alive = False
             return
 
@@ -322,34 +810,211 @@ class WebSocketHandler(StreamRequestHandler):
             key = headers['sec-websocket-key']
         except KeyError:
             logger.warning("Client tried to connect but was missing a key")
+            self.server._handshake_failed_(self.client_address, "no Sec-WebSocket-Key")
             self.keep_alive = False
             return
 
-        response = self.make_handshake_response(key)
-        self.handshake_done = self.request.send(response.encode())
+        extensions = self.negotiate_extensions(headers)
+        response = self.make_handshake_response(key, extensions)
+        try:
+            # send may write only part of the response, like any frame (see _send_parts)
+            self.request.sendall(response.encode())
+        except (SocketError, ValueError):
+            logger.info("Client closed connection during the handshake.")
+            self.keep_alive = False
+            return
+        self.handshake_done = True
         self.valid_client = True
         self.server._new_client_(self)
 
-    @classmethod
-    def make_handshake_response(cls, key):
-        return \
-          'HTTP/1.1 101 Switching Protocols\r\n'\
-          'Upgrade: websocket\r\n'              \
-          'Connection: Upgrade\r\n'             \
-          'Sec-WebSocket-Accept: %s\r\n'        \
-          '\r\n' % cls.calculate_response_key(key)
-
-    @classmethod
-    def calculate_response_key(cls, key):
-        GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
-        hash = sha1(key.encode() + GUID.encode())
-        response_key = b64encode(hash.digest()).strip()
-        return response_key.decode('ASCII')
-
     def finish(self):
+        # let anything already queued (e.g. a final EndExperiment) go out
+        self.outbound.close()
+        self._writer.join(DRAIN_TIMEOUT)
         self.server._client_left_(self)
 
 
+class OutboundQueue(object):
+    """
+    Frames waiting to be written to one client, drained by that client's
+    writer thread. Tracks the number of bytes queued for backpressure.
+    """
+
+    def __init__(self):
+        self._frames = deque()
+        self._not_empty = threading.Condition(threading.Lock())
+        self.size = 0
+        self.closed = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, parts):
+        """Queues a frame; returns the bytes now queued, or None if closed."""
+        with self._not_empty:
+            if self.closed:
+                return None
+            self._frames.append(parts)
+            self.size += sum(len(part) for part in parts)
+            self._not_empty.notify()
+            return self.size
+
+    def get(self):
+        """Waits for the next frame; None once the queue is closed and empty."""
+        with self._not_empty:
+            while not self._frames and not self.closed:
+                self._not_empty.wait()
+            if not self._frames:
+                return None
+            return self._frames.popleft()
+
+    def done(self, parts):
+        """Marks a frame from get() as written; returns the bytes still queued."""
+        with self._not_empty:
+            self.size -= sum(len(part) for part in parts)
+            return self.size
+
+    def close(self):
+        with self._not_empty:
+            self.closed = True
+            self._not_empty.notify_all()
+
+
+class MessageBuffer(object):
+    """
+    Reassembles a fragmented message. Space is allocated up front and doubled
+    when it runs out, so appending a fragment is a copy into existing memory
+    rather than a reallocation of everything received so far.
+    """
+
+    MIN_SIZE = 4096
+
+    def __init__(self, size_hint=0):
+        self._data = bytearray(max(self.MIN_SIZE, 2 * size_hint))
+        self._length = 0
+
+    def __len__(self):
+        return self._length
+
+    def append(self, chunk):
+        end = self._length + len(chunk)
+        if end > len(self._data):
+            self._data.extend(bytearray(max(end, 2 * len(self._data)) - len(self._data)))
+        self._data[self._length:end] = chunk
+        self._length = end
+
+    def take(self):
+        """Returns the reassembled message, leaving the buffer empty."""
+        data = self._data
+        del data[self._length:]
+        self._data = bytearray()
+        self._length = 0
+        return data
+
+
+# Frames at least this long are written with sendmsg straight from the
+# caller's buffers rather than copied into a single bytes object first.
+SCATTER_GATHER_THRESHOLD = 16384
+
+HEADER_SHORT = struct.Struct(">BB")
+HEADER_EXT16 = struct.Struct(">BBH")
+HEADER_EXT64 = struct.Struct(">BBQ")
+
+
+def encode_frame_header(opcode, payload_length):
+    """Header for an unmasked, unfragmented frame; opcode may include RSV1."""
+
+    # Normal payload
+    if payload_length <= 125:
+        return HEADER_SHORT.pack(FIN | opcode, payload_length)
+
+    # Extended payload
+    elif payload_length <= 65535:
+        return HEADER_EXT16.pack(FIN | opcode, PAYLOAD_LEN_EXT16, payload_length)
+
+    # Huge extended payload
+    elif payload_length < 18446744073709551616:
+        return HEADER_EXT64.pack(FIN | opcode, PAYLOAD_LEN_EXT64, payload_length)
+
+    else:
+        raise Exception("Message is too big. Consider breaking it into chunks.")
+
+
+def frame_size(payload_length):
+    """Bytes in an unmasked frame with a payload of payload_length."""
+    if payload_length <= 125:
+        return HEADER_SHORT.size + payload_length
+    elif payload_length <= 65535:
+        return HEADER_EXT16.size + payload_length
+    return HEADER_EXT64.size + payload_length
+
+
+def encode_frame_parts(message, opcode=OPCODE_TEXT, deflate=None):
+    """
+    Returns (header, payload) for an unmasked, unfragmented server frame, or
+    None if message is neither a string nor bytes.
+
+    bytes, bytearray and memoryview messages are taken to be already encoded
+    (for text frames: valid UTF-8) and are used as they are, without being
+    copied. If deflate (a PerMessageDeflate) is given and the payload is over
+    its threshold, the payload is compressed and RSV1 set.
+    """
+    if isinstance(message, (bytes, bytearray, memoryview)):
+        payload = message
+    elif sys.version_info < (3,0) and isinstance(message, unicode):
+        payload = encode_to_UTF8(message)
+    elif isinstance(message, str):
+        payload = encode_to_UTF8(message)
+    else:
+        logger.warning('Can\'t send message, message has to be a string or bytes. Given type is %s' % type(message))
+        return None
+
+    if deflate is not None and deflate.should_compress(payload):
+        payload = deflate.compress(payload)
+        opcode |= RSV1
+    return encode_frame_header(opcode, len(payload)), payload
+
+
+def encode_frame(message, opcode=OPCODE_TEXT, deflate=None):
+    """
+    Build a complete frame for message as one bytes object, e.g. to cache and
+    send repeatedly with send_frame. See encode_frame_parts.
+    """
+    parts = encode_frame_parts(message, opcode, deflate)
+    if parts is None:
+        return None
+    header, payload = parts
+    return header + bytes(payload)
+
+
+def unmask(masks, payload):
+    """
+    XOR a client payload with its 4-byte masking key.
+
+    Rather than working byte by byte, the key is tiled to the payload length
+    and the whole payload is XORed in one go, either as a numpy uint8 array
+    (large payloads, numpy installed) or as a single big integer.
+    """
+    payload_length = len(payload)
+    if payload_length == 0:
+        return bytearray()
+    if sys.version_info[0] < 3:
+        payload = list(payload)
+        return bytearray(b ^ masks[i % 4] for i, b in enumerate(payload))
+    masks = bytes(masks)
+    if numpy is not None and payload_length >= NUMPY_UNMASK_THRESHOLD:
+        unmasked = bytearray(payload)
+        n_words = payload_length // 4
+        words = numpy.frombuffer(unmasked, dtype=numpy.uint32, count=n_words)
+        words ^= numpy.frombuffer(masks, dtype=numpy.uint32)[0]
+        for i in range(n_words * 4, payload_length):
+            unmasked[i] ^= masks[i % 4]
+        return unmasked
+    key = masks * (payload_length // 4) + masks[:payload_length % 4]
+    unmasked = int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')
+    return bytearray(unmasked.to_bytes(payload_length, 'big'))
+
+
 def encode_to_UTF8(data):
     try:
         return data.encode('UTF-8')
@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+
+##############
+##### Generating trial lists in bulk
+##############
+
+# Makes many trial lists at once as NumPy integer arrays. It applies the same
+# constraints as make_design and trial_list in shapes_interaction_server_bs.py,
+# and the lists come out with the same distribution. This is for checking
+# properties of the design over millions of simulated pairs: foil balance, how
+# often each colour is a target, whether the shape-colour constraints hold. It
+# also lets you try meaning spaces larger than 7 shapes x 4 colours. The
+# server itself does not use it, and it needs numpy.
+
+# Meanings are integers:
+# - shapes index all_shapes;
+# - colours index colours;
+# - block 3 objects and emotions index objects or emotions.
+# Where a field does not apply it holds NONE. Block 0 items are white, so
+# their colour is NONE. Block 2 items are colour splats, so their shape is
+# NONE. Block 3 objects and emotions have neither, only an item.
+
+# benchmarks/check_batch_trials.py checks that this matches trial_list
+# statistically, and benchmarks/bench_batch_trials.py compares their speed.
+
+import numpy as np
+
+NONE = -1
+
+FIXED = 'fixed_associations'
+RANDOM = 'random_associations'
+BLOCK3_CONDITIONS = ('coloured_shapes', 'objects', 'emotions')
+
+
+class DesignSpace(object):
+    """
+    The sizes of everything a design is drawn from; the defaults are those of
+    shapes_interaction_server_bs.py. n_items is the number of objects (or of
+    emotions) in block 3.
+    """
+
+    def __init__(self, n_all_shapes=7, n_colours=4, n_items=4, n_shapes_per_pair=4,
+                 n_fixed_colours=4, n_foils=2, n_subblocks_per_block=4):
+        self.n_all_shapes = n_all_shapes
+        self.n_colours = n_colours
+        self.n_items = n_items
+        self.n_shapes_per_pair = n_shapes_per_pair
+        self.n_fixed_colours = n_fixed_colours
+        self.n_foils = n_foils
+        self.n_subblocks_per_block = n_subblocks_per_block
+
+    def block_lengths(self, block3_condition):
+        """Number of trials in blocks 0 to 3."""
+        S, R = self.n_shapes_per_pair, self.n_subblocks_per_block
+        n_block3_targets = self.n_colours if block3_condition == 'coloured_shapes' else self.n_items
+        return [S, S * R * 2, self.n_colours * R, n_block3_targets * R]
+
+
+class TrialBatch(object):
+    """
+    n trial lists of T trials, each with a target and n_foils foils.
+
+    shape, colour and item are (n, T, 1 + n_foils) arrays, where [:, :, 0] is
+    the target and [:, :, 1:] the foils; block is a length T array. The
+    designs they were made for are shapes, (n, n_shapes_per_pair), and
+    strict_colour, the same shape: each shape's fixed colour, or NONE if it
+    can be any colour. feasible is False for the lists where trial_list would
+    have failed, because no colour was left for some item (possible only when
+    a pair has both fixed and free shapes).
+    """
+    __slots__ = ('shapes', 'strict_colour', 'block3_condition', 'shape', 'colour', 'item', 'block', 'feasible')
+
+    def __init__(self, shapes, strict_colour, block3_condition, shape, colour, item, block, feasible):
+        self.shapes = shapes
+        self.strict_colour = strict_colour
+        self.block3_condition = block3_condition
+        self.shape = shape
+        self.colour = colour
+        self.item = item
+        self.block = block
+        self.feasible = feasible
+
+    def __len__(self):
+        return len(self.shape)
+
+    def trial_list(self, i, shape_names, colour_names, item_names):
+        """List i in the format trial_list returns, naming meanings from the lists given."""
+        trials = []
+        for t, block in enumerate(self.block):
+            items = []
+            for j in range(self.shape.shape[2]):
+                if block == 3 and self.block3_condition != 'coloured_shapes':
+                    items.append(item_names[self.item[i, t, j]])
+                else:
+                    shape = "splat" if block == 2 else shape_names[self.shape[i, t, j]]
+                    colour = "white" if block == 0 else colour_names[self.colour[i, t, j]]
+                    items.append({'shape': shape, 'colour': colour})
+            trials.append({'target': items[0], 'foils': items[1:], 'block': int(block)})
+        return trials
+
+
+def from_trial_lists(trial_lists, designs, block3_condition, shape_names, colour_names, item_names):
+    """
+    The inverse of TrialBatch.trial_list: packs trial lists made by
+    trial_list, and the (shapes, colour_shape_correspondences) each was made
+    for, into a TrialBatch.
+    """
+    shape_index = {name: i for i, name in enumerate(shape_names)}
+    colour_index = {name: i for i, name in enumerate(colour_names)}
+    item_index = {name: i for i, name in enumerate(item_names)}
+    n, T = len(trial_lists), len(trial_lists[0])
+    n_items = 1 + len(trial_lists[0][0]['foils'])
+    shape = np.full((n, T, n_items), NONE, dtype=np.int32)
+    colour = np.full((n, T, n_items), NONE, dtype=np.int32)
+    item = np.full((n, T, n_items), NONE, dtype=np.int32)
+    for i, trials in enumerate(trial_lists):
+        for t, trial in enumerate(trials):
+            for j, meaning in enumerate([trial['target']] + trial['foils']):
+                if isinstance(meaning, dict):
+                    if meaning['shape'] != "splat":
+                        shape[i, t, j] = shape_index[meaning['shape']]
+                    if meaning['colour'] != "white":
+                        colour[i, t, j] = colour_index[meaning['colour']]
+                else:
+                    item[i, t, j] = item_index[meaning]
+    shapes = np.array([[shape_index[s] for s in design[0]] for design in designs], dtype=np.int32)
+    strict_colour = np.array([[colour_index[design[1][s][0]] if len(design[1][s]) == 1 else NONE
+                               for s in design[0]] for design in designs], dtype=np.int32)
+    block = np.array([trial['block'] for trial in trial_lists[0]], dtype=np.int32)
+    return TrialBatch(shapes, strict_colour, block3_condition, shape, colour, item, block,
+                      np.ones(n, dtype=bool))
+
+
+# ----------------------------- sampling helpers -----------------------------
+
+def permutations(rng, shape, n):
+    """Independent uniform permutations of range(n), as an array of shape + (n,)."""
+    return rng.random(tuple(shape) + (n,), dtype=np.float32).argsort(axis=-1).astype(np.int32)
+
+
+def sample_excluding(rng, exclude, n_options, n):
+    """
+    For every element of exclude, n distinct options from range(n_options)
+    other than it, in random order; what n_random_with_taboo(options, n,
+    [exclude]) returns.
+    """
+    keys = rng.random(exclude.shape + (n_options,), dtype=np.float32)
+    np.put_along_axis(keys, exclude[..., None], 2.0, axis=-1)
+    return keys.argsort(axis=-1)[..., :n].astype(np.int32)
+
+
+def choose(rng, allowed):
+    """
+    A uniformly chosen index of a True entry along the last axis of allowed,
+    and whether there was one; what random_with_taboo does for a list of
+    options and taboos expressed as the boolean mask allowed.
+    """
+    keys = np.where(allowed, rng.random(allowed.shape, dtype=np.float32), np.float32(-1))
+    return keys.argmax(axis=-1).astype(np.int32), allowed.any(axis=-1)
+
+
+def gather(values, index):
+    """values[i, index[i, ...]] for each row i; values may have more axes after the second."""
+    extra_axes = values.ndim - 2
+    flat = index.reshape((len(index), -1) + (1,) * extra_axes)
+    return np.take_along_axis(values, flat, axis=1).reshape(index.shape + values.shape[2:])
+
+
+def every(ok):
+    """For each row, whether ok holds everywhere in it."""
+    return ok.reshape(len(ok), -1).all(axis=1)
+
+
+# ------------------------------- generation ---------------------------------
+
+def batch_designs(rng, n, condition, space=None):
+    """
+    The shapes and fixed colours of n pairs in condition, as make_design
+    chooses them: returns (shapes, strict_colour) as described in TrialBatch.
+    """
+    space = space or DesignSpace()
+    S = space.n_shapes_per_pair
+    shapes = permutations(rng, (n,), space.n_all_shapes)[:, :S]
+    n_fixed = space.n_fixed_colours if condition == FIXED else 0
+    strict_colour = np.full((n, S), NONE, dtype=np.int32)
+    if n_fixed:
+        selected_colours = permutations(rng, (n,), space.n_colours)[:, :n_fixed]
+        selected_positions = permutations(rng, (n,), S)[:, :n_fixed]
+        np.put_along_axis(strict_colour, selected_positions, selected_colours, axis=1)
+    return shapes, strict_colour
+
+
+def batch_trial_lists(rng, shapes, strict_colour, block3_condition, space=None):
+    """
+    One trial list for each design in (shapes, strict_colour), made as
+    trial_list(block3_condition, shapes, colour_shape_correspondences) would.
+    """
+    space = space or DesignSpace()
+    n, S = shapes.shape
+    C, F, R = space.n_colours, space.n_foils, space.n_subblocks_per_block
+    feasible = np.ones(n, dtype=bool)
+    # which colours each of the pair's shapes can appear in
+    strict = strict_colour != NONE
+    allowed_colours = np.where(strict[..., None], np.arange(C) == strict_colour[..., None], True)
+    blocks = []
+
+    # Every subblock has each target once, in a random order, and everything
+    # else about a trial depends only on its target; so the targets are
+    # permutations, and the rest is drawn for each target afterwards.
+
+    # block0 - white shapes, foils differ from target shape
+    target_position = permutations(rng, (n, 1), S)
+    positions = np.concatenate([target_position[..., None],
+                                sample_excluding(rng, target_position, S, F)], axis=-1)
+    blocks.append((gather(shapes, positions), np.full(positions.shape, NONE, np.int32), None))
+
+    # block1 - shapes in their characteristic colours, foils differ in shape
+    # and colour. Foil colours are picked in turn, each avoiding the colours
+    # already picked and, for a fixed target, the target's colour; a free
+    # target then avoids the foils' colours.
+    target_position = permutations(rng, (n, 2 * R), S)
+    positions = np.concatenate([target_position[..., None],
+                                sample_excluding(rng, target_position, S, F)], axis=-1)
+    target_strict = gather(strict, target_position)
+    target_colour = gather(strict_colour, target_position)
+    taboo = target_strict[..., None] & (np.arange(C) == target_colour[..., None])
+    colour = np.empty(positions.shape, dtype=np.int32)
+    for j in range(1, F + 1):
+        options = gather(allowed_colours, positions[..., j]) & ~taboo
+        colour[..., j], ok = choose(rng, options)
+        feasible &= every(ok)
+        taboo |= np.arange(C) == colour[..., j, None]
+    free_colour, ok = choose(rng, gather(allowed_colours, target_position) & ~taboo)
+    feasible &= every(ok | target_strict)
+    colour[..., 0] = np.where(target_strict, target_colour, free_colour)
+    blocks.append((gather(shapes, positions), colour, None))
+
+    # block2 - colour splats, foils differ in colour
+    target_colour = permutations(rng, (n, R), C)
+    colour = np.concatenate([target_colour[..., None], sample_excluding(rng, target_colour, C, F)], axis=-1)
+    blocks.append((np.full(colour.shape, NONE, np.int32), colour, None))
+
+    # block3
+    if block3_condition == 'coloured_shapes':
+        # each colour on a shape not fixed to that colour; foils are the same
+        # shape in other colours
+        target_colour = permutations(rng, (n, R), C)
+        target_ok = (strict_colour[:, None, None, :] != target_colour[..., None]) | ~strict[:, None, None, :]
+        target_position, ok = choose(rng, target_ok)
+        feasible &= every(ok)
+        colour = np.concatenate([target_colour[..., None], sample_excluding(rng, target_colour, C, F)], axis=-1)
+        shape = np.repeat(gather(shapes, target_position)[..., None], F + 1, axis=-1)
+        blocks.append((shape, colour, None))
+    else:
+        target_item = permutations(rng, (n, R), space.n_items)
+        item = np.concatenate([target_item[..., None], sample_excluding(rng, target_item, space.n_items, F)], axis=-1)
+        none = np.full(item.shape, NONE, np.int32)
+        blocks.append((none, none, item))
+
+    shape = np.concatenate([b[0].reshape(n, -1, F + 1) for b in blocks], axis=1)
+    colour = np.concatenate([b[1].reshape(n, -1, F + 1) for b in blocks], axis=1)
+    item = np.concatenate([(b[2] if b[2] is not None else np.full(b[0].shape, NONE, np.int32)).reshape(n, -1, F + 1)
+                           for b in blocks], axis=1)
+    block = np.repeat(np.arange(4, dtype=np.int32), space.block_lengths(block3_condition))
+    return TrialBatch(shapes, strict_colour, block3_condition, shape, colour, item, block, feasible)
+
+
+def batch(rng, n, condition, block3_condition, space=None):
+    """n trial lists, each for a new design in condition."""
+    shapes, strict_colour = batch_designs(rng, n, condition, space)
+    return batch_trial_lists(rng, shapes, strict_colour, block3_condition, space)
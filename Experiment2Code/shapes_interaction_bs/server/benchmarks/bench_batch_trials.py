@@ -0,0 +1,70 @@
+# Compares how fast trial lists are made by the server's make_design (two
+# lists per design, by rejection sampling in pure Python) and by
+# batch_trials.batch, for each condition x block3 condition and batch size.
+# Both include drawing the pair's design (shapes and shape-colour
+# correspondences). Reports trial lists/sec.
+#
+# Needs numpy, and the same files next to the server script as the server does.
+# Run from the server directory:
+#     python benchmarks/bench_batch_trials.py [--sizes 1000 10000 100000] [--scalar-seconds 2]
+
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SERVER_DIR)
+
+import batch_trials
+from batch_trials import FIXED, RANDOM, BLOCK3_CONDITIONS
+
+
+def scalar_rate(server, condition, block3_condition, seconds):
+    n = 0
+    start = time.time()
+    while time.time() - start < seconds:
+        server.make_design((condition, block3_condition))
+        n += 2
+    return n / (time.time() - start)
+
+
+def batch_rate(rng, n, condition, block3_condition, space):
+    start = time.time()
+    b = batch_trials.batch(rng, n, condition, block3_condition, space)
+    elapsed = time.time() - start
+    assert b.feasible.all()
+    return n / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--scalar-seconds', type=float, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    import shapes_interaction_server_bs as server
+    rng = np.random.default_rng(args.seed)
+    space = batch_trials.DesignSpace(n_all_shapes=len(server.all_shapes), n_colours=len(server.colours),
+                                     n_items=len(server.objects), n_shapes_per_pair=server.n_shapes_per_pair,
+                                     n_fixed_colours=server.n_fixed_colours, n_foils=server.n_foils,
+                                     n_subblocks_per_block=server.n_subblocks_per_block)
+    # numpy's first calls are slower
+    batch_trials.batch(rng, 100, FIXED, BLOCK3_CONDITIONS[0], space)
+
+    print('%-48s %12s' % ('', 'lists/sec'))
+    for condition in (FIXED, RANDOM):
+        for block3_condition in BLOCK3_CONDITIONS:
+            cell = '%s/%s' % (condition, block3_condition)
+            print('%-48s %12.0f' % (cell + ' make_design',
+                                    scalar_rate(server, condition, block3_condition, args.scalar_seconds)))
+            for n in args.sizes:
+                print('%-48s %12.0f' % ('%s batch %d' % (cell, n),
+                                        batch_rate(rng, n, condition, block3_condition, space)))
+
+
+if __name__ == '__main__':
+    main()
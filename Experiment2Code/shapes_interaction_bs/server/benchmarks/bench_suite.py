@@ -0,0 +1,352 @@
+# Microbenchmarks of the server's hot paths, to catch regressions when the
+# server changes:
+# - read_next_message decoding a client's (masked) frame, for several payload sizes
+# - send_text framing a message, for the same sizes
+# - calculate_response_key, and the whole handshake (with permessage-deflate offered)
+# - the codec's dumps of each command the server sends, and rendering the
+#   commands sent from templates (see message_codec.py)
+# - trial_list for each block3 condition, and shuffle_distinct
+# - one interaction trial, in-process: the Director's RESPONSE, the Matcher's
+#   RESPONSE and both FINISHED_FEEDBACKs going through message_received, i.e.
+#   handle_director_response -> handle_matcher_response -> swap_roles_and_progress
+#   -> start_interaction_trial, with frames written to nowhere
+#
+# Each benchmark is timed with timeit, best of --repeat runs, and the results
+# written as JSON to --output, along with the Python version, platform and codec
+# they were measured with. They are then compared with a baseline (by default
+# bench_baseline.json, next to this file): anything more than --threshold times
+# slower than its baseline is timed again (twice at most, keeping the best) and,
+# if it still is, reported as a regression, and the exit status is 1.
+# Baselines are only comparable on the same machine, so after a change that is
+# meant to make something faster (or on a new machine) save a new one with
+# --save-baseline.
+#
+# Needs the same files next to the server script as the server does.
+# Run from the server directory:
+#     python benchmarks/bench_suite.py [--filter read_next_message] [--output results.json]
+#                                      [--baseline PATH] [--save-baseline] [--threshold 1.25]
+
+import argparse
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SERVER_DIR)
+
+from websocket_server import WebsocketServerBase, WebSocketHandler, DeflateConfig
+from websocket_server import websocket_server
+from experiment_log import setup_logging
+from design_pool import DesignPool
+from interaction_engine import InteractionExperiment, CONSTANT_COMMANDS
+from message_codec import default_codec, MessageTemplate
+from session_state import Role
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json')
+
+PAYLOAD_SIZES = [32, 256, 4096, 65536]
+
+# Frames read per call of the read_next_message benchmarks
+FRAMES_PER_READ = 100
+
+CELL = ('fixed_associations', 'coloured_shapes')
+
+HANDSHAKE_REQUEST = ('GET / HTTP/1.1\r\n'
+                     'Host: localhost:9025\r\n'
+                     'Connection: Upgrade\r\n'
+                     'Upgrade: websocket\r\n'
+                     'Origin: https://localhost\r\n'
+                     'Sec-WebSocket-Version: 13\r\n'
+                     'User-Agent: Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0\r\n'
+                     'Sec-WebSocket-Key: dGhlIHNhbXBsZSBub25jZQ==\r\n'
+                     'Sec-WebSocket-Extensions: permessage-deflate; client_max_window_bits\r\n'
+                     '\r\n').encode()
+
+
+class NullSocket(object):
+    # the handshake's response is sent straight to the socket
+    def send(self, data):
+        return len(data)
+
+
+def discard(*parts):
+    pass
+
+
+# A WebSocketHandler of server with no connection: frames are read from rfile
+# and written nowhere
+def null_handler(server, rfile=None):
+    handler = WebSocketHandler.__new__(WebSocketHandler)
+    handler.server = server
+    handler.client_address = ('127.0.0.1', 0)
+    handler.request = NullSocket()
+    handler.rfile = rfile
+    handler.keep_alive = True
+    handler.handshake_done = False
+    handler.valid_client = False
+    handler.init_frame_state()
+    handler._write_frame = discard
+    return handler
+
+
+# A text frame as a browser sends it, masked
+def client_frame(payload):
+    header = websocket_server.encode_frame_header(websocket_server.OPCODE_TEXT, len(payload))
+    # the same masking bit, in the second byte, for every length
+    header = header[:1] + bytes([header[1] | websocket_server.MASKED]) + header[2:]
+    masks = os.urandom(4)
+    return header + masks + bytes(websocket_server.unmask(masks, payload))
+
+
+# The start of a RESPONSE, padded or cut to size bytes
+def text_payload(size):
+    text = b'{"response_type":"RESPONSE","role":"Director","response":"' + b'x' * size
+    return text[:size - 2] + b'"}'
+
+
+##############
+##### The benchmarks
+##############
+
+# Each returns a list of (name, fn, ops): one call of fn does ops of what is being timed
+
+def transport_benchmarks():
+    server = WebsocketServerBase(heartbeat_interval=None, max_message_size=2 * max(PAYLOAD_SIZES))
+    benchmarks = []
+    for size in PAYLOAD_SIZES:
+        frames = io.BytesIO(client_frame(text_payload(size)) * FRAMES_PER_READ)
+        handler = null_handler(server, frames)
+
+        def read(handler=handler, frames=frames):
+            frames.seek(0)
+            for _ in range(FRAMES_PER_READ):
+                handler.read_next_message()
+        benchmarks.append(('read_next_message/%d' % size, read, FRAMES_PER_READ))
+    for size in PAYLOAD_SIZES:
+        handler = null_handler(server)
+        message = text_payload(size).decode()
+        benchmarks.append(('send_text/%d' % size, lambda handler=handler, message=message: handler.send_text(message), 1))
+
+    key = 'dGhlIHNhbXBsZSBub25jZQ=='
+    benchmarks.append(('calculate_response_key', lambda: WebSocketHandler.calculate_response_key(key), 1))
+    # as the server scripts set it up
+    server.deflate = DeflateConfig(threshold=128)
+
+    def handshake():
+        handler = null_handler(server, io.BytesIO(HANDSHAKE_REQUEST))
+        handler.handshake()
+        server.registry.remove(handler)
+    benchmarks.append(('handshake', handshake, 1))
+    return benchmarks
+
+
+def command_benchmarks(script, codec):
+    random.seed(0)
+    design = script.make_design(CELL)
+    trial = design['trials'][0]
+    context_array = [trial['target']] + trial['foils']
+    fixed = {'max_trial_n': len(design['trials']), 'partner_id': 'participant_two', 'mapping': design['mappings'][0]}
+    varying = {
+        "Director": dict(target_meaning=trial['target'], context_array=context_array,
+                         block_n=trial['block'], trial_n=1),
+        "Matcher": dict(target_meaning=trial['target'], director_label=design['shapes'][:2],
+                        meaning_choices=context_array, block_n=trial['block'], trial_n=1),
+        "Feedback": dict(score=1, target=trial['target'], guess=trial['target'], break_allowed='false')}
+    templates = {"Director": MessageTemplate(codec, command_type="Director", label_choices=design['shapes'], **fixed),
+                 "Matcher": MessageTemplate(codec, command_type="Matcher", **fixed),
+                 "Feedback": MessageTemplate(codec, command_type="Feedback", mapping=fixed['mapping'])}
+    commands = list(CONSTANT_COMMANDS) + [{"command_type": "PairID", "pair_id": "participant_one_participant_two"},
+                                          dict(varying["Director"], command_type="Director",
+                                               label_choices=design['shapes'], **fixed),
+                                          dict(varying["Matcher"], command_type="Matcher", **fixed),
+                                          dict(varying["Feedback"], command_type="Feedback", mapping=fixed['mapping'])]
+    benchmarks = []
+    for command in commands:
+        benchmarks.append(('dumps/%s' % command['command_type'], lambda command=command: codec.dumps(command), 1))
+    for command_type, template in templates.items():
+        fields = varying[command_type]
+        benchmarks.append(('render/%s' % command_type, lambda template=template, fields=fields: template.render(**fields), 1))
+    return benchmarks
+
+
+def design_benchmarks(script):
+    random.seed(0)
+    design = script.make_design(CELL)
+    benchmarks = []
+    for block3_condition in script.block3_conditions:
+        make_list = lambda b=block3_condition: script.trial_list(b, design['shapes'], design['correspondences'])
+        benchmarks.append(('trial_list/%s' % block3_condition, same_draws(make_list, 20), 20))
+    mapping = script.shuffle(script.all_actual_shapes)
+    shuffle_distinct = lambda: script.shuffle_distinct(script.all_actual_shapes, mapping)
+    benchmarks.append(('shuffle_distinct', same_draws(shuffle_distinct, 500), 500))
+    return benchmarks
+
+
+# Calls fn n times, starting from the same random state every time, so that rejection
+# sampling takes the same number of tries on every call
+def same_draws(fn, n):
+    random.seed(0)
+    state = random.getstate()
+
+    def run():
+        random.setstate(state)
+        for _ in range(n):
+            fn()
+    return run
+
+
+def engine_benchmarks(script, log):
+    random.seed(0)
+    server = WebsocketServerBase(heartbeat_interval=None)
+    experiment = InteractionExperiment(log, DesignPool(script.make_design, [CELL]), lambda: CELL, script.describe_cell,
+                                       break_trials=script.break_trials, workers=0)
+    experiment.attach(server)
+    handlers = [null_handler(server) for _ in range(2)]
+    for n, handler in enumerate(handlers):
+        server._new_client_(handler)
+        server._message_received_(handler, json.dumps({"response_type": "CLIENT_INFO",
+                                                       "client_info": "participant_%d" % n}))
+    for handler in handlers:
+        server._message_received_(handler, json.dumps({"response_type": "INTERACTION_INSTRUCTIONS_COMPLETE"}))
+    participants = [experiment.participants[server.handler_to_client(handler)['id']] for handler in handlers]
+    pair = participants[0].pair
+    assert pair is not None and participants[0].role in (Role.DIRECTOR, Role.MATCHER)
+
+    director_response = json.dumps({"response_type": "RESPONSE", "role": "Director", "response": pair.shapes[:2]})
+    matcher_responses = [json.dumps({"response_type": "RESPONSE", "role": "Matcher", "response": trial['target']})
+                         for trial in pair.trial_list]
+    finished_feedback = json.dumps({"response_type": "FINISHED_FEEDBACK"})
+
+    def trial():
+        # the last trial would end the interaction, so go round the list again instead
+        if pair.trial_counter == len(pair.trial_list) - 1:
+            pair.trial_counter = 0
+        if participants[0].role is Role.DIRECTOR:
+            director, matcher = handlers
+        else:
+            matcher, director = handlers
+        server._message_received_(director, director_response)
+        server._message_received_(matcher, matcher_responses[pair.trial_counter])
+        server._message_received_(director, finished_feedback)
+        server._message_received_(matcher, finished_feedback)
+    return [('interaction_trial', trial, 1)]
+
+
+##############
+##### Running and comparing
+##############
+
+def time_benchmark(fn, ops, repeat):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    times = sorted(t / number / ops * 1e9 for t in timer.repeat(repeat=repeat, number=number))
+    return {'best_ns': round(times[0], 1), 'median_ns': round(times[len(times) // 2], 1)}
+
+
+def environment(codec):
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=SERVER_DIR,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit,
+            'python': platform.python_version(), 'implementation': platform.python_implementation(),
+            'platform': platform.platform(), 'machine': platform.machine(), 'codec': codec.name,
+            'numpy': websocket_server.numpy is not None}
+
+
+# Prints each result next to its baseline, returning the names of those more than threshold times slower
+def compare(results, baseline, threshold):
+    for key in ('python', 'codec', 'numpy', 'machine'):
+        if baseline['environment'].get(key) != results['environment'][key]:
+            print('NB the baseline was measured with %s %s, these with %s' %
+                  (key, baseline['environment'].get(key), results['environment'][key]))
+    regressions = []
+    print('%-36s %12s %12s %8s' % ('', 'ns/op', 'baseline', 'change'))
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None:
+            print('%-36s %12.1f %12s %8s' % (name, result['best_ns'], '-', 'new'))
+            continue
+        ratio = result['best_ns'] / before['best_ns']
+        flag = ''
+        if ratio > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-36s %12.1f %12.1f %+7.0f%%%s' % (name, result['best_ns'], before['best_ns'], (ratio - 1) * 100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--filter', help='only run benchmarks whose names contain this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='file to write the results to, as JSON')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='write the results to --baseline')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='report results more than this many times slower than the baseline')
+    args = parser.parse_args()
+
+    # the server script writes its log and designs where it runs, so import it from
+    # somewhere they can be thrown away
+    here = os.getcwd()
+    scratch = tempfile.TemporaryDirectory()
+    os.chdir(scratch.name)
+    try:
+        import shapes_interaction_server_bs as script
+        script.design_pool.path = None
+    finally:
+        os.chdir(here)
+    log = setup_logging('bench_suite', level=logging.WARNING, console=False)
+    codec = default_codec()
+
+    benchmarks = (transport_benchmarks() + command_benchmarks(script, codec) + design_benchmarks(script)
+                  + engine_benchmarks(script, log))
+    if args.filter:
+        benchmarks = [b for b in benchmarks if args.filter in b[0]]
+    results = {'environment': environment(codec), 'results': {}}
+    for name, fn, ops in benchmarks:
+        results['results'][name] = time_benchmark(fn, ops, args.repeat)
+        print('%-36s %12.1f ns/op' % (name, results['results'][name]['best_ns']), file=sys.stderr)
+
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        # timings of a microsecond or so vary a lot from run to run, so make sure anything slow really is
+        for _ in range(2):
+            for name, fn, ops in benchmarks:
+                before = baseline['results'].get(name)
+                if before is not None and results['results'][name]['best_ns'] > before['best_ns'] * args.threshold:
+                    again = time_benchmark(fn, ops, args.repeat)
+                    if again['best_ns'] < results['results'][name]['best_ns']:
+                        results['results'][name] = again
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=1)
+        print('Saved the baseline to %s' % args.baseline)
+        return 0
+    if baseline is None:
+        print('No baseline at %s; save one with --save-baseline' % args.baseline)
+        return 0
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+        print('%d regression(s) over %.2fx: %s' % (len(regressions), args.threshold, ', '.join(regressions)))
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,209 @@
+# Checks that batch_trials generates trial lists the way make_design and
+# trial_list in shapes_interaction_server_bs.py do.
+#
+# For every condition x block3 condition it makes --samples lists with each
+# generator and
+#   - checks every list of both against the design's constraints (foils differ
+#     from the target, fixed shapes appear in their colour, every target once
+#     per subblock...)
+#   - compares the distributions of a set of features - which shapes and
+#     colours are targets and foils, in which combinations and in which trial
+#     positions - with chi-square tests of homogeneity. Each feature is read
+#     from one randomly chosen trial per list, so that observations are
+#     independent. Shapes are compared by their position in the pair's list
+#     of shapes, since the pair's shapes differ from list to list.
+# It exits with status 1 if any check fails or any p-value is below
+# --alpha / the number of tests.
+#
+# Needs numpy, and the same files next to the server script as the server does.
+# Run from the server directory:
+#     python benchmarks/check_batch_trials.py [--samples 5000] [--seed 0]
+
+import argparse
+import math
+import os
+import random
+import sys
+
+import numpy as np
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, SERVER_DIR)
+
+import batch_trials
+from batch_trials import NONE, FIXED, RANDOM, BLOCK3_CONDITIONS
+
+
+def scalar_batch(server, n, condition, block3_condition):
+    """n lists from the server's own make_design, packed into a TrialBatch."""
+    trial_lists, designs = [], []
+    for _i in range(n):
+        design = server.make_design((condition, block3_condition))
+        # the design interleaves two lists made for the same pair; take the first
+        trial_lists.append(design['trials'][0::2])
+        designs.append((design['shapes'], design['correspondences']))
+    items = server.emotions if block3_condition == 'emotions' else server.objects
+    return batch_trials.from_trial_lists(trial_lists, designs, block3_condition,
+                                         list(server.all_shapes), server.colours, items)
+
+
+def relative_shapes(b):
+    """Each shape as its position in the pair's list of shapes, NONE where there is no shape."""
+    matches = b.shape[..., None] == b.shapes[:, None, None, :]
+    return np.where(matches.any(axis=-1), matches.argmax(axis=-1), NONE)
+
+
+def distinct(values):
+    """For each trial, whether the target's and foils' values are all different."""
+    ordered = np.sort(values, axis=-1)
+    return (np.diff(ordered, axis=-1) != 0).all(axis=-1)
+
+
+def constraint_failures(b, space):
+    """Names of the constraints some list in b breaks."""
+    failures = []
+    position = relative_shapes(b)
+    rows = np.arange(len(b))[:, None]
+    for block in range(4):
+        trials = b.block == block
+        shape, colour, item, pos = b.shape[:, trials], b.colour[:, trials], b.item[:, trials], position[:, trials]
+        if block in (0, 1):
+            if not distinct(pos).all() or (pos == NONE).any():
+                failures.append('block %d: foils are other shapes of the pair' % block)
+        if block == 1:
+            if not distinct(colour).all():
+                failures.append('block 1: target and foil colours all differ')
+            strict = b.strict_colour[rows[..., None], pos]
+            if ((strict != NONE) & (strict != colour)).any():
+                failures.append('block 1: fixed shapes appear in their colour')
+        if block == 2 or (block == 3 and b.block3_condition == 'coloured_shapes'):
+            if not distinct(colour).all():
+                failures.append('block %d: foils are other colours' % block)
+        if block == 3 and b.block3_condition == 'coloured_shapes':
+            if (shape != shape[..., :1]).any():
+                failures.append('block 3: foils are the target shape')
+            strict = b.strict_colour[rows, pos[..., 0]]
+            if (strict == colour[..., 0]).any():
+                failures.append('block 3: target shape is not fixed to the target colour')
+        if block == 3 and b.block3_condition != 'coloured_shapes':
+            if not distinct(item).all():
+                failures.append('block 3: foils are other items')
+        # every target once per subblock
+        target = {0: pos, 1: pos, 2: colour, 3: colour if b.block3_condition == 'coloured_shapes' else item}[block][..., 0]
+        n_targets = {0: space.n_shapes_per_pair, 1: space.n_shapes_per_pair, 2: space.n_colours,
+                     3: space.n_colours if b.block3_condition == 'coloured_shapes' else space.n_items}[block]
+        subblocks = np.sort(target.reshape(len(b), -1, n_targets), axis=-1)
+        if (subblocks != np.arange(n_targets)).any():
+            failures.append('block %d: every target once per subblock' % block)
+    return failures
+
+
+def features(b, rng):
+    """
+    {name: (n, k) array}: one row of k category values per list, read from a
+    trial chosen at random within the relevant block.
+    """
+    position = relative_shapes(b)
+    result = {}
+    rows = np.arange(len(b))
+    for block in range(4):
+        first = np.flatnonzero(b.block == block)[0]
+        length = (b.block == block).sum()
+
+        def at(values):
+            t = first + rng.integers(length, size=len(b))
+            return values[rows, t], t - first
+
+        if block in (0, 1):
+            pos, t = at(position)
+            result['block %d shapes' % block] = pos
+            result['block %d target by trial' % block] = np.column_stack([t, pos[:, 0]])
+        if block == 1:
+            pos, t = at(position)
+            colour = b.colour[rows, first + t]
+            result['block 1 colours'] = colour
+            result['block 1 target shape, colour'] = np.column_stack([pos[:, 0], colour[:, 0]])
+            result['block 1 foil shapes, colours'] = np.column_stack([pos[:, 1:], colour[:, 1:]])
+        if block == 2 or (block == 3 and b.block3_condition == 'coloured_shapes'):
+            colour, t = at(b.colour)
+            result['block %d colours' % block] = colour
+            result['block %d target by trial' % block] = np.column_stack([t, colour[:, 0]])
+        if block == 3 and b.block3_condition == 'coloured_shapes':
+            pos, t = at(position)
+            result['block 3 target shape, colour'] = np.column_stack([pos[:, 0], b.colour[rows, first + t, 0]])
+        if block == 3 and b.block3_condition != 'coloured_shapes':
+            item, t = at(b.item)
+            result['block 3 items'] = item
+            result['block 3 target by trial'] = np.column_stack([t, item[:, 0]])
+    result['design'] = b.strict_colour
+    return result
+
+
+def chi_square(a, b):
+    """Chi-square test of homogeneity of two samples of category rows: (statistic, df, p)."""
+    _categories, codes = np.unique(np.concatenate([a, b]), axis=0, return_inverse=True)
+    codes = codes.ravel()
+    k = codes.max() + 1
+    observed = np.array([np.bincount(codes[:len(a)], minlength=k),
+                         np.bincount(codes[len(a):], minlength=k)], dtype=float)
+    expected = observed.sum(axis=1, keepdims=True) * observed.sum(axis=0) / observed.sum()
+    statistic = ((observed - expected) ** 2 / expected).sum()
+    df = k - 1
+    return statistic, df, chi_square_p(statistic, df)
+
+
+def chi_square_p(statistic, df):
+    """Upper tail of the chi-square distribution, by the Wilson-Hilferty approximation."""
+    if df == 0:
+        return 1.0
+    z = ((statistic / df) ** (1 / 3.0) - (1 - 2 / (9.0 * df))) / math.sqrt(2 / (9.0 * df))
+    return 0.5 * math.erfc(z / math.sqrt(2))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--samples', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--alpha', type=float, default=0.01)
+    args = parser.parse_args()
+
+    import shapes_interaction_server_bs as server
+    random.seed(args.seed)
+    rng = np.random.default_rng(args.seed)
+    space = batch_trials.DesignSpace(n_all_shapes=len(server.all_shapes), n_colours=len(server.colours),
+                                     n_items=len(server.objects), n_shapes_per_pair=server.n_shapes_per_pair,
+                                     n_fixed_colours=server.n_fixed_colours, n_foils=server.n_foils,
+                                     n_subblocks_per_block=server.n_subblocks_per_block)
+
+    results, failures = [], []
+    for condition in (FIXED, RANDOM):
+        for block3_condition in BLOCK3_CONDITIONS:
+            cell = '%s/%s' % (condition, block3_condition)
+            scalar = scalar_batch(server, args.samples, condition, block3_condition)
+            vectorised = batch_trials.batch(rng, args.samples, condition, block3_condition, space)
+            if vectorised.shape.shape != scalar.shape.shape or (vectorised.block != scalar.block).any():
+                failures.append('%s: lists have a different layout' % cell)
+                continue
+            if not vectorised.feasible.all():
+                failures.append('%s: batch_trials marked lists infeasible' % cell)
+            for name, b in (('trial_list', scalar), ('batch_trials', vectorised)):
+                failures.extend('%s %s breaks "%s"' % (cell, name, f) for f in constraint_failures(b, space))
+            scalar_features, batch_features = features(scalar, rng), features(vectorised, rng)
+            for name in scalar_features:
+                results.append((cell, name) + chi_square(scalar_features[name], batch_features[name]))
+
+    threshold = args.alpha / len(results)
+    print('%-40s %-32s %10s %5s %8s' % ('cell', 'feature', 'chi2', 'df', 'p'))
+    for cell, name, statistic, df, p in results:
+        print('%-40s %-32s %10.1f %5d %8.4f%s' % (cell, name, statistic, df, p, ' *' if p < threshold else ''))
+        if p < threshold:
+            failures.append('%s: %s differs (p=%.2g)' % (cell, name, p))
+    print('')
+    for failure in failures:
+        print('FAIL', failure)
+    print('%d tests, %d failures' % (len(results), len(failures)))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
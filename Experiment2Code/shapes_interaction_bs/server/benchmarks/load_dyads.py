@@ -0,0 +1,423 @@
+# Load-tests a running server with synthetic participants, so that it can be
+# tried at the size of a recruitment wave before the real one.
+#
+# Each participant is an asyncio task on one event loop, with no browser: it
+# connects, sends CLIENT_INFO, reads the interaction instructions, then plays
+# Director and Matcher in turn through every trial until EndExperiment,
+# sending the same messages as shapes_interaction_bs.js and a Ping every 5
+# seconds as dyadic_interaction_utilities_bs.js does. How long it takes to
+# respond on each trial is drawn from participants' real response times (rt)
+# in Analysis/data, divided by --speed; the client's fixed screens (the 1 s
+# "You are SENDER", the 2.5 s of feedback) are shortened by the same factor.
+#
+# Reports dyads completed per minute, percentiles of how long each command
+# took to arrive after the response that triggered it (after the participant
+# who responded last, for commands that wait for both), the participants who
+# dropped out or were dropped, and the server's CPU and memory use, including
+# any processes it started (design pool, sharded workers), read from /proc
+# (Linux only).
+#
+# Start the server, then run from the server directory:
+#     python benchmarks/load_dyads.py --pairs 50 --speed 20 --server-pid <pid>
+# or have it started (and stopped again afterwards) for you:
+#     python benchmarks/load_dyads.py --pairs 50 --speed 20 --launch
+# Every participant gets a new participant_id, so the server's participant
+# index does not turn later runs away; note that the server logs, journals and
+# records them like anyone else, in the files next to the script.
+
+import argparse
+import asyncio
+import base64
+import csv
+import json
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+from collections import defaultdict, deque
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+SERVER_SCRIPT = 'shapes_interaction_server_bs.py'
+RT_CSV = os.path.join(SERVER_DIR, '..', '..', '..', 'Analysis', 'data', 'exp1_predicted_extension_data.csv')
+
+# What the client does, in seconds (dyadic_interaction_utilities_bs.js, shapes_interaction_bs.js)
+PING_INTERVAL = 5.0
+ROLE_SCREEN = 1.0
+FEEDBACK_SCREEN = 2.5
+# How long participants take to read the interaction instructions
+INSTRUCTIONS_TIME = 30.0
+
+# Commands that follow pairing rather than a response, so have no latency of their own
+UNTIMED_COMMANDS = ('PairID', 'Instructions')
+
+PERCENTILES = (50, 90, 99)
+
+
+# Response times in seconds by exp_trial_type (director, matcher), from the data the
+# analysis uses; if there are none for matchers, they are drawn from the directors'
+def load_rts(path):
+    rts = defaultdict(list)
+    with open(path, newline='') as f:
+        for row in csv.DictReader(f):
+            if row.get('rt') not in (None, '', 'NA'):
+                rts[row.get('exp_trial_type')].append(float(row['rt']) / 1000)
+    if not rts['director']:
+        raise ValueError("%s has no director rts" % path)
+    if not rts['matcher']:
+        rts['matcher'] = rts['director']
+    return rts
+
+
+class Connection(object):
+    """A websocket client connection: masked text frames out, answers pings."""
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, host, port):
+        reader, writer = await asyncio.open_connection(host, port)
+        key = base64.b64encode(os.urandom(16)).decode()
+        writer.write(('GET / HTTP/1.1\r\nHost: %s:%d\r\nUpgrade: websocket\r\n'
+                      'Connection: Upgrade\r\nSec-WebSocket-Key: %s\r\n'
+                      'Sec-WebSocket-Version: 13\r\n\r\n' % (host, port, key)).encode())
+        response = await reader.readuntil(b'\r\n\r\n')
+        if b' 101 ' not in response.split(b'\r\n', 1)[0]:
+            raise ConnectionError('handshake refused: %r' % response[:80])
+        return cls(reader, writer)
+
+    def send(self, message):
+        self._send_frame(0x1, json.dumps(message).encode())
+
+    def _send_frame(self, opcode, payload):
+        mask = os.urandom(4)
+        if len(payload) <= 125:
+            header = struct.pack('>BB', 0x80 | opcode, 0x80 | len(payload))
+        elif len(payload) <= 65535:
+            header = struct.pack('>BBH', 0x80 | opcode, 0x80 | 126, len(payload))
+        else:
+            header = struct.pack('>BBQ', 0x80 | opcode, 0x80 | 127, len(payload))
+        key = (mask * (len(payload) // 4 + 1))[:len(payload)]
+        masked = (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(len(payload), 'big')
+        self.writer.write(header + mask + masked)
+
+    async def receive(self):
+        """The next command from the server, or None once it closes the connection."""
+        while True:
+            b1, b2 = await self.reader.readexactly(2)
+            length = b2 & 0x7f
+            if length == 126:
+                length = struct.unpack('>H', await self.reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('>Q', await self.reader.readexactly(8))[0]
+            payload = await self.reader.readexactly(length)
+            opcode = b1 & 0x0f
+            if opcode == 0x9:
+                # a browser answers the server's heartbeat by itself
+                self._send_frame(0xA, payload)
+            elif opcode == 0x8:
+                return None
+            elif opcode == 0x1:
+                return json.loads(payload.decode())
+
+    def close(self):
+        self.writer.close()
+
+
+class LoadRun(object):
+    """Everything the participants of one run share, and what they found."""
+
+    def __init__(self, args, rts):
+        self.args = args
+        self.rts = rts
+        # latencies of each command_type, in seconds
+        self.latencies = defaultdict(list)
+        self.waits_for_partner = []
+        # when a response was last sent by either member of each pair, by pair_id
+        self.last_sent = {}
+        self.outcomes = defaultdict(int)
+        self.trials = defaultdict(int)
+        self.completed_at = []
+        self.started_at = None
+
+    def think(self, role):
+        return random.choice(self.rts[role]) / self.args.speed
+
+    def pause(self, seconds):
+        return asyncio.sleep(seconds / self.args.speed)
+
+
+class SyntheticParticipant(object):
+
+    def __init__(self, run, participant_id):
+        self.run = run
+        self.participant_id = participant_id
+        self.connection = None
+        self.pair_id = None
+        self.client_info_sent = None
+        self.last_sent = None
+        self.pings_sent = deque()
+        self.trials = 0
+        # whether they will leave part way through, and if so after which trial, chosen once
+        # they know how many trials there are
+        self.drops_out = random.random() < run.args.dropout
+        self.leaves_after = None
+
+    async def run_session(self):
+        args = self.run.args
+        try:
+            self.connection = await Connection.open(args.host, args.port)
+        except (OSError, asyncio.IncompleteReadError):
+            self.run.outcomes['could not connect'] += 1
+            return
+        self.client_info_sent = time.perf_counter()
+        self.respond({'response_type': 'CLIENT_INFO', 'client_info': self.participant_id})
+        pinger = asyncio.ensure_future(self.keep_alive())
+        try:
+            outcome = await self.play()
+        except (OSError, asyncio.IncompleteReadError):
+            outcome = 'connection lost'
+        finally:
+            pinger.cancel()
+            self.connection.close()
+        self.run.outcomes[outcome] += 1
+        if outcome == 'EndExperiment':
+            self.run.completed_at.append(time.perf_counter())
+            self.run.trials[self.trials] += 1
+
+    async def keep_alive(self):
+        while True:
+            await asyncio.sleep(PING_INTERVAL)
+            self.pings_sent.append(time.perf_counter())
+            self.connection.send({'response_type': 'Ping'})
+
+    def respond(self, message):
+        self.connection.send(message)
+        now = time.perf_counter()
+        if self.pair_id is None:
+            self.last_sent = now
+        else:
+            self.run.last_sent[self.pair_id] = now
+
+    def arrived(self, command_type):
+        now = time.perf_counter()
+        if command_type == 'Pong':
+            if self.pings_sent:
+                self.run.latencies['Pong'].append(now - self.pings_sent.popleft())
+        elif command_type == 'PairID':
+            if self.pair_id is None:
+                self.run.waits_for_partner.append(now - self.client_info_sent)
+        elif command_type not in UNTIMED_COMMANDS:
+            sent = self.last_sent if self.pair_id is None else self.run.last_sent.get(self.pair_id)
+            if sent is not None:
+                self.run.latencies[command_type].append(now - sent)
+
+    async def play(self):
+        run = self.run
+        while True:
+            command = await self.connection.receive()
+            if command is None:
+                return 'connection lost'
+            command_type = command['command_type']
+            self.arrived(command_type)
+            if command_type == 'PairID':
+                self.pair_id = command['pair_id']
+            elif command_type in ('EndExperiment', 'PartnerDropout', 'DuplicateParticipant'):
+                return command_type
+            elif command_type == 'Instructions':
+                await run.pause(INSTRUCTIONS_TIME)
+                self.respond({'response_type': 'INTERACTION_INSTRUCTIONS_COMPLETE'})
+            elif command_type == 'Director':
+                self.choose_when_to_leave(command)
+                await run.pause(ROLE_SCREEN)
+                await asyncio.sleep(run.think('director'))
+                label = random.choice(command['label_choices'])
+                self.respond({'response_type': 'RESPONSE', 'participant': self.participant_id,
+                              'partner': command['partner_id'], 'role': 'Director',
+                              'target_object': command['target_meaning'], 'response': [label]})
+            elif command_type == 'Matcher':
+                self.choose_when_to_leave(command)
+                await asyncio.sleep(run.think('matcher'))
+                if random.random() < run.args.accuracy:
+                    selected = command['target_meaning']
+                else:
+                    selected = random.choice(command['meaning_choices'])
+                self.respond({'response_type': 'RESPONSE', 'participant': self.participant_id,
+                              'partner': command['partner_id'], 'role': 'Matcher', 'response': selected})
+            elif command_type == 'Feedback':
+                self.trials += 1
+                if self.trials == self.leaves_after:
+                    return 'left (--dropout)'
+                await run.pause(FEEDBACK_SCREEN)
+                if command.get('break_allowed') == 'true':
+                    await asyncio.sleep(run.think('director'))
+                self.respond({'response_type': 'FINISHED_FEEDBACK'})
+
+
+    def choose_when_to_leave(self, command):
+        if self.drops_out and self.leaves_after is None:
+            self.leaves_after = random.randrange(1, command['max_trial_n'])
+
+
+class ProcessMonitor(object):
+    """CPU time and memory of a process and all its descendants, from /proc."""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.ticks = os.sysconf('SC_CLK_TCK')
+        self.peak_rss = 0
+        self.cpu_at_start = None
+        self.started = None
+
+    def processes(self):
+        children = defaultdict(list)
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                stat = read_stat(int(entry))
+                if stat is not None:
+                    children[stat[1]].append(int(entry))
+        tree = [self.pid]
+        for pid in tree:
+            tree.extend(children.get(pid, []))
+        return tree
+
+    def sample(self):
+        """Total CPU seconds used so far and RSS in bytes now, over the whole tree."""
+        cpu = 0.0
+        rss = 0
+        for pid in self.processes():
+            stat = read_stat(pid)
+            if stat is not None:
+                cpu += (stat[11] + stat[12]) / self.ticks
+                rss += stat[21] * os.sysconf('SC_PAGE_SIZE')
+        self.peak_rss = max(self.peak_rss, rss)
+        return cpu, rss
+
+    async def watch(self):
+        self.cpu_at_start, _rss = self.sample()
+        self.started = time.perf_counter()
+        while True:
+            await asyncio.sleep(1)
+            self.sample()
+
+    def report(self):
+        cpu, rss = self.sample()
+        elapsed = time.perf_counter() - self.started
+        return {'cpu_percent': 100 * (cpu - self.cpu_at_start) / elapsed, 'rss_mb': rss / 2.0**20,
+                'peak_rss_mb': self.peak_rss / 2.0**20}
+
+
+# The fields of /proc/<pid>/stat after the command name, as ints (state is left as it is),
+# or None if the process has gone; [1] is the parent's pid
+def read_stat(pid):
+    try:
+        with open('/proc/%d/stat' % pid) as f:
+            stat = f.read()
+    except OSError:
+        return None
+    fields = stat[stat.rindex(')') + 2:].split()
+    return [fields[0]] + [int(field) for field in fields[1:]]
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def run_load(args, run, monitor):
+    prefix = 'load%d' % int(time.time())
+    participants = [SyntheticParticipant(run, '%s_%d' % (prefix, i)) for i in range(2 * args.pairs)]
+    watcher = asyncio.ensure_future(monitor.watch()) if monitor is not None else None
+    run.started_at = time.perf_counter()
+    sessions = []
+    for participant in participants:
+        sessions.append(asyncio.ensure_future(participant.run_session()))
+        await asyncio.sleep(args.ramp / len(participants))
+    await asyncio.gather(*sessions)
+    if watcher is not None:
+        watcher.cancel()
+
+
+def report(args, run, monitor):
+    elapsed = time.perf_counter() - run.started_at
+    completed = len(run.completed_at) // 2
+    print('%d pairs (%d participants) in %.1f s, responses %gx real speed' %
+          (args.pairs, 2 * args.pairs, elapsed, args.speed))
+    if completed:
+        minutes = (max(run.completed_at) - run.started_at) / 60
+        print('completed dyads: %d, %.1f per minute' % (completed, completed / minutes))
+        print('trials per completed participant: %s' %
+              ', '.join('%d (x%d)' % item for item in sorted(run.trials.items())))
+    else:
+        print('completed dyads: 0')
+    print('outcomes: %s' % ', '.join('%s %d' % item for item in sorted(run.outcomes.items())))
+    print()
+    print('%-20s %8s %10s %10s %10s %10s' % ('latency (ms)', 'n', 'p50', 'p90', 'p99', 'max'))
+    rows = sorted(run.latencies.items())
+    if run.waits_for_partner:
+        rows.append(('(wait for partner)', run.waits_for_partner))
+    for command_type, values in rows:
+        values = sorted(values)
+        print('%-20s %8d %s %10.2f' % (command_type, len(values),
+                                       ' '.join('%10.2f' % (1000 * percentile(values, p)) for p in PERCENTILES),
+                                       1000 * values[-1]))
+    if monitor is not None:
+        print()
+        usage = monitor.report()
+        print('server (pid %d and its children): %.0f%% cpu, %.0f MB now, %.0f MB at most' %
+              (monitor.pid, usage['cpu_percent'], usage['rss_mb'], usage['peak_rss_mb']))
+
+
+def launch(args):
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT], cwd=SERVER_DIR,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            with socket.create_connection((args.host, args.port), timeout=1):
+                return server
+        except OSError:
+            if server.poll() is not None:
+                raise RuntimeError('%s exited with status %d' % (SERVER_SCRIPT, server.returncode))
+            time.sleep(0.2)
+    server.kill()
+    raise RuntimeError('%s did not start listening on port %d' % (SERVER_SCRIPT, args.port))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--pairs', type=int, default=10)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9025)
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='divide response times and screen durations by this')
+    parser.add_argument('--ramp', type=float, default=10.0, help='seconds over which participants connect')
+    parser.add_argument('--accuracy', type=float, default=0.8, help='chance a matcher picks the target')
+    parser.add_argument('--dropout', type=float, default=0.0,
+                        help='chance a participant leaves part way through')
+    parser.add_argument('--rts', default=RT_CSV, help='CSV with rt (ms) and exp_trial_type columns')
+    parser.add_argument('--server-pid', type=int, help='report this process\'s CPU and memory use')
+    parser.add_argument('--launch', action='store_true',
+                        help='start %s for the run, and report its CPU and memory use' % SERVER_SCRIPT)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    run = LoadRun(args, load_rts(args.rts))
+    server = launch(args) if args.launch else None
+    pid = server.pid if server is not None else args.server_pid
+    monitor = ProcessMonitor(pid) if pid is not None and os.path.exists('/proc/%d' % pid) else None
+    try:
+        asyncio.run(run_load(args, run, monitor))
+        report(args, run, monitor)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == '__main__':
+    main()
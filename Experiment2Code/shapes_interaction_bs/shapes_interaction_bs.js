@@ -525,6 +525,27 @@ function partner_dropout() {
   end_experiment("partner_dropout");
 }
 
+/*
+The server keeps its own list of everyone who has been paired, and checks it when we
+send CLIENT_INFO; if this participant is on it, they see the same message as when
+check_duplicates.php finds their data file.
+*/
+function duplicate_participant() {
+  jsPsych.endExperiment();
+  close_socket();
+  var duplicate_participant_trial = {
+    type: "html-button-response",
+    stimulus:
+      "<p style='text-align:left'>Sorry, but our records show that you have already completed this experiment \
+    (or one closely related to it). Please help us out and return the experiment. If you think you are seeing this message \
+    in error (e.g. because you re-loaded the experiment) please message us on Prolific or email Kenny (kenny.smith@ed.ac.uk).</p>",
+    choices: [],
+  };
+  jsPsych.init({
+    timeline: [duplicate_participant_trial],
+  });
+}
+
 /******************************************************************************/
 /*** End-of-experiment screens *************************************************/
 /******************************************************************************/